@@ -0,0 +1,138 @@
+# BufferUpload.py
+# Created by: Jason Sikes
+#
+# Uploads vertex arrays into new OpenGL buffers a slice at a time, so that
+# a large mesh can be streamed to the GPU over several frames while the
+# previous one is still drawn from its own buffers (double buffering).
+#
+# Each slice goes through a small ring of staging slots and is then
+# copied on the GPU into its buffer with glCopyBufferSubData(). Where
+# ARB_buffer_storage (core in OpenGL 4.4) is available, the staging buffer
+# is persistently mapped and every slot carries a fence, so a slot is only
+# rewritten once the GPU has finished copying out of it; the upload waits
+# for the next frame rather than for the GPU. Otherwise each slice orphans
+# the staging buffer with glBufferData() before writing it, which lets
+# the driver hand out fresh storage instead of stalling.
+
+import ctypes
+
+import numpy as np
+from OpenGL.GL import *
+
+# Size of one staging slot, and so of the largest slice.
+SLICE_BYTES = 4 << 20
+STAGING_SLOTS = 3
+
+# How much one step() uploads at most.
+STEP_BYTES = 16 << 20
+
+
+# Persistent mapping needs ARB_buffer_storage (core in OpenGL 4.4) for
+# glBufferStorage() and fences (core in 3.2).
+def isPersistentMappingSupported():
+    return bool(glBufferStorage) and bool(glFenceSync) and bool(glMapBufferRange)
+
+
+class StagingRing:
+    def __init__(self, slotBytes=SLICE_BYTES, slots=STAGING_SLOTS, persistent=None):
+        if persistent is None:
+            persistent = isPersistentMappingSupported()
+        self.persistent = persistent
+        self.slotBytes = slotBytes
+        self.slots = slots
+        self.fences = [None] * slots
+        self.next = 0
+        self.buffer = glGenBuffers(1)
+        glBindBuffer(GL_COPY_READ_BUFFER, self.buffer)
+        if persistent:
+            flags = GL_MAP_WRITE_BIT | GL_MAP_PERSISTENT_BIT | GL_MAP_COHERENT_BIT
+            glBufferStorage(GL_COPY_READ_BUFFER, slotBytes * slots, None, flags)
+            self.pointer = ctypes.c_void_p(glMapBufferRange(GL_COPY_READ_BUFFER, 0,
+                                                            slotBytes * slots, flags)).value
+        glBindBuffer(GL_COPY_READ_BUFFER, 0)
+
+    # Copies data (a contiguous uint8 array of at most slotBytes) to offset
+    # in buffer target. Returns False, and does nothing, if the next slot is
+    # still being read by the GPU.
+    def copy(self, data, target, offset):
+        slot = self.next
+        if self.fences[slot] is not None:
+            if glClientWaitSync(self.fences[slot], 0, 0) == GL_TIMEOUT_EXPIRED:
+                return False
+            glDeleteSync(self.fences[slot])
+            self.fences[slot] = None
+
+        glBindBuffer(GL_COPY_READ_BUFFER, self.buffer)
+        if self.persistent:
+            source = slot * self.slotBytes
+            ctypes.memmove(self.pointer + source, data.ctypes.data, data.nbytes)
+        else:
+            source = 0
+            glBufferData(GL_COPY_READ_BUFFER, self.slotBytes, None, GL_STREAM_DRAW)
+            glBufferSubData(GL_COPY_READ_BUFFER, 0, data.nbytes, data)
+        glBindBuffer(GL_COPY_WRITE_BUFFER, target)
+        glCopyBufferSubData(GL_COPY_READ_BUFFER, GL_COPY_WRITE_BUFFER, source, offset, data.nbytes)
+        glBindBuffer(GL_COPY_WRITE_BUFFER, 0)
+        glBindBuffer(GL_COPY_READ_BUFFER, 0)
+        if self.persistent:
+            self.fences[slot] = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        self.next = (slot + 1) % self.slots
+        return True
+
+    def delete(self):
+        for fence in self.fences:
+            if fence is not None:
+                glDeleteSync(fence)
+        self.fences = [None] * self.slots
+        if self.persistent:
+            glBindBuffer(GL_COPY_READ_BUFFER, self.buffer)
+            glUnmapBuffer(GL_COPY_READ_BUFFER)
+            glBindBuffer(GL_COPY_READ_BUFFER, 0)
+        glDeleteBuffers(1, [self.buffer])
+        self.buffer = 0
+
+
+# The upload of a list of arrays into as many new buffers. The buffers
+# can be drawn from once done() is true; commands issued after the last
+# copy see its data.
+class BufferUpload:
+    def __init__(self, arrays, ring):
+        self.ring = ring
+        self.arrays = [np.ascontiguousarray(a).reshape(-1).view(np.uint8) for a in arrays]
+        self.buffers = [int(b) for b in np.atleast_1d(glGenBuffers(len(arrays)))]
+        for data, buffer in zip(self.arrays, self.buffers):
+            glBindBuffer(GL_COPY_WRITE_BUFFER, buffer)
+            glBufferData(GL_COPY_WRITE_BUFFER, data.nbytes, None, GL_STATIC_DRAW)
+        glBindBuffer(GL_COPY_WRITE_BUFFER, 0)
+        self.current = 0   # Array being uploaded
+        self.offset = 0    # Bytes of it already uploaded
+        self.totalBytes = 0
+        for data in self.arrays:
+            self.totalBytes += data.nbytes
+        self.uploadedBytes = 0
+
+    def done(self):
+        return self.current == len(self.arrays)
+
+    # Uploads up to budget bytes, fewer if the staging ring is busy.
+    # Returns done().
+    def step(self, budget=STEP_BYTES):
+        while budget > 0 and not self.done():
+            data = self.arrays[self.current]
+            size = min(self.ring.slotBytes, budget, data.nbytes - self.offset)
+            if size > 0:
+                if not self.ring.copy(data[self.offset : self.offset + size],
+                                      self.buffers[self.current], self.offset):
+                    break
+                self.offset += size
+                self.uploadedBytes += size
+                budget -= size
+            if self.offset == data.nbytes:
+                self.current += 1
+                self.offset = 0
+        return self.done()
+
+    # Deletes the buffers, for an upload that is abandoned.
+    def delete(self):
+        glDeleteBuffers(len(self.buffers), self.buffers)
+        self.buffers = []
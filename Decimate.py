@@ -0,0 +1,194 @@
+# Decimate.py
+# Created by: Jason Sikes
+#
+# Garland-Heckbert quadric error decimation of a triangle Mesh. Every
+# vertex carries the sum of the squared-distance quadrics of the planes of
+# its faces (and, on a boundary, of planes through the boundary edges
+# perpendicular to their face, so open borders hold their shape). Edges
+# are collapsed cheapest first from a heap; the vertex that remains moves
+# to the position that minimizes the summed quadric.
+#
+# The quadrics and the initial costs are computed with numpy for the whole
+# mesh at once. The collapses themselves change the half-edge structure
+# one edge at a time.
+
+import heapq
+import numpy as np
+
+# Weight of the boundary constraint planes relative to the face planes.
+BOUNDARY_WEIGHT = 100.0
+
+# Collapses that turn a face's normal by more than this are rejected.
+MAX_NORMAL_TURN_COSINE = 0.0
+
+
+# Positions as an N x 3 array in vertex index order, and the vertex indices
+# of the triangles.
+def meshArrays(mesh):
+    positions = np.array([v.position for v in mesh.verts], dtype=np.float64)
+    faces = np.array(mesh.copyOfIndices(), dtype=np.int64).reshape(-1, 3)
+    return positions, faces
+
+# Fundamental quadrics (4 x 4) of planes with unit normals n through points
+# p, scaled by weight.
+def planeQuadrics(n, p, weight):
+    plane = np.concatenate([n, -np.einsum('ij,ij->i', n, p)[:, None]], axis=1)
+    return plane[:, :, None] * plane[:, None, :] * weight[:, None, None]
+
+# The quadric of every vertex, summed over its faces (weighted by area)
+# and its boundary edges.
+def vertexQuadrics(mesh):
+    positions, faces = meshArrays(mesh)
+    p = positions[faces]
+    cross = np.cross(p[:,1] - p[:,0], p[:,2] - p[:,0])
+    doubleArea = np.linalg.norm(cross, axis=1)
+    n = cross / np.where(doubleArea > 0, doubleArea, 1.0)[:, None]
+    faceQuadrics = planeQuadrics(n, p[:,0], doubleArea / 2.0)
+
+    quadrics = np.zeros((len(positions), 16))
+    for corner in range(3):
+        for k in range(16):
+            quadrics[:, k] += np.bincount(faces[:, corner], weights=faceQuadrics[:, k // 4, k % 4],
+                                          minlength=len(positions))
+
+    boundary = [e for e in mesh.edges if e.face is None]
+    if boundary:
+        ends = np.array([(e.vertex.index, e.nextEdge.vertex.index,
+                          e.symmetricEdge.previousEdge.vertex.index) for e in boundary])
+        p = positions[ends]
+        faceNormals = np.cross(p[:,0] - p[:,1], p[:,2] - p[:,1])
+        direction = p[:,1] - p[:,0]
+        length = np.linalg.norm(direction, axis=1)
+        side = np.cross(direction, faceNormals)
+        side /= np.maximum(np.linalg.norm(side, axis=1), 1e-300)[:, None]
+        edgeQuadrics = planeQuadrics(side, positions[ends[:,0]], BOUNDARY_WEIGHT * length * length)
+        for end in range(2):
+            for k in range(16):
+                quadrics[:, k] += np.bincount(ends[:, end], weights=edgeQuadrics[:, k // 4, k % 4],
+                                              minlength=len(positions))
+    return quadrics.reshape(-1, 4, 4)
+
+# Optimal positions and their errors for a batch of edges, given the
+# summed quadrics (K x 4 x 4) and the positions of both ends. Where the
+# quadric can't be inverted, the better of the two ends and the midpoint
+# is used instead.
+def collapseTargets(q, p0, p1):
+    a = q[:, :3, :3]
+    b = q[:, :3, 3]
+    positions = (p0 + p1) / 2.0
+    solvable = np.abs(np.linalg.det(a)) > 1e-12 * np.maximum(np.abs(a).max(axis=(1, 2)) ** 3, 1e-300)
+    if solvable.any():
+        positions[solvable] = np.linalg.solve(a[solvable], -b[solvable][:, :, None])[:, :, 0]
+
+    def error(x):
+        h = np.concatenate([x, np.ones((len(x), 1))], axis=1)
+        return np.einsum('ki,kij,kj->k', h, q, h)
+
+    errors = error(positions)
+    for candidate in (p0, p1):
+        candidateErrors = error(candidate)
+        better = ~solvable & (candidateErrors < errors)
+        positions[better] = candidate[better]
+        errors[better] = candidateErrors[better]
+    return positions, np.maximum(errors, 0.0)
+
+
+# Row-wise cross products, without np.cross()'s overhead on small batches.
+def crossRows(a, b):
+    return np.stack([a[:,1] * b[:,2] - a[:,2] * b[:,1],
+                     a[:,2] * b[:,0] - a[:,0] * b[:,2],
+                     a[:,0] * b[:,1] - a[:,1] * b[:,0]], axis=1)
+
+# Whether moving the ends of e to position turns any face that survives
+# the collapse over (or by more than MAX_NORMAL_TURN_COSINE allows).
+def foldsOver(e, position):
+    b = e.symmetricEdge
+    corners = []
+    for start in (e, b):
+        h = start
+        while True:
+            f = h.face
+            if (f is not None and f != e.face and f != b.face):
+                corners.append((h.vertex.position, h.nextEdge.vertex.position,
+                                h.previousEdge.vertex.position))
+            h = h.symmetricEdge.nextEdge
+            if (h == start):
+                break
+    if not corners:
+        return False
+    c = np.array(corners)
+    before = crossRows(c[:,1] - c[:,0], c[:,2] - c[:,0])
+    after = crossRows(c[:,1] - position, c[:,2] - position)
+    lengths = np.sqrt((before * before).sum(axis=1) * (after * after).sum(axis=1))
+    return bool(((lengths == 0) | ((before * after).sum(axis=1) <= MAX_NORMAL_TURN_COSINE * lengths)).any())
+
+
+# Collapses edges of mesh, cheapest first, until it has at most targetFaces
+# faces or the next collapse would cost more than maxError (a squared
+# distance). Either limit may be None. The mesh is compacted and its
+# normals and OpenGL arrays are rebuilt when next needed. Returns the
+# number of collapses.
+def decimate(mesh, targetFaces=None, maxError=None):
+    quadrics = vertexQuadrics(mesh)
+
+    # One half-edge per edge, on a face where there's a choice, else the one
+    # leaving the lower numbered vertex (so the order of equal-cost
+    # collapses is the same in every run).
+    edges = [e for e in mesh.edges
+             if e.face is not None and (e.symmetricEdge.face is None or
+                                        e.vertex.index < e.symmetricEdge.vertex.index)]
+    ends = np.array([(e.vertex.index, e.symmetricEdge.vertex.index) for e in edges]).reshape(-1, 2)
+    positions = np.array([v.position for v in mesh.verts], dtype=np.float64)
+    targets, errors = collapseTargets(quadrics[ends[:,0]] + quadrics[ends[:,1]],
+                                      positions[ends[:,0]], positions[ends[:,1]])
+
+    # Heap entries are (error, stamp, edge, position). An entry is stale
+    # once its edge has been removed or has a newer stamp in stamps, which
+    # holds the latest stamp of both half-edges of every edge.
+    heap = []
+    stamps = {}
+    stamp = 0
+    for e, error, target in zip(edges, errors.tolist(), targets):
+        stamps[e] = stamps[e.symmetricEdge] = stamp
+        heap.append((error, stamp, e, target))
+        stamp += 1
+    heapq.heapify(heap)
+
+    faceCount = len(mesh.faces)
+    collapses = 0
+    while heap and (targetFaces is None or faceCount > targetFaces):
+        error, entryStamp, e, target = heapq.heappop(heap)
+        if (e.removed or stamps[e] != entryStamp):
+            continue
+        if (maxError is not None and error > maxError):
+            break
+        if (not mesh.canCollapse(e) or foldsOver(e, target)):
+            continue
+
+        u = e.vertex
+        v = e.symmetricEdge.vertex
+        faceCount -= (e.face is not None) + (e.symmetricEdge.face is not None)
+        mesh.collapseEdge(e, target)
+        quadrics[u.index] += quadrics[v.index]
+        collapses += 1
+
+        # Every edge at u has a new cost.
+        ring = []
+        h = s = u.eminatingEdge
+        while True:
+            ring.append(h)
+            h = h.symmetricEdge.nextEdge
+            if (h == s):
+                break
+        others = np.array([h.symmetricEdge.vertex.index for h in ring])
+        ringTargets, ringErrors = collapseTargets(quadrics[u.index] + quadrics[others],
+                                                  np.tile(u.position, (len(ring), 1)),
+                                                  np.array([h.symmetricEdge.vertex.position for h in ring]))
+        for h, error, target in zip(ring, ringErrors.tolist(), ringTargets):
+            stamps[h] = stamps[h.symmetricEdge] = stamp
+            heapq.heappush(heap, (error, stamp, h, target))
+            stamp += 1
+
+    mesh.compact()
+    mesh.invalidate()
+    return collapses
@@ -0,0 +1,111 @@
+# FrameStats.py
+# Created by: Jason Sikes
+#
+# Frame-time instrumentation for the viewer: CPU time spent in display(),
+# GPU time measured with GL_TIME_ELAPSED queries, and the amount of geometry
+# drawn. Samples are kept in a rolling window that can be written to CSV.
+
+import csv
+import ctypes
+from collections import deque
+
+from OpenGL.GL import *
+from OpenGL.raw.GL.VERSION.GL_3_3 import glGetQueryObjectui64v
+
+
+CSV_FIELDS = ['frame', 'mesh', 'pipeline', 'vertexFormat', 'polygonMode', 'shading', 'texture',
+              'triangles', 'drawCalls', 'cpuMilliseconds', 'gpuMilliseconds']
+
+
+# One frame's worth of measurements. gpuMilliseconds stays None until the
+# GPU has finished the frame and its timer query has been read back.
+class FrameSample:
+    def __init__(self, frame, mesh, pipeline, vertexFormat, polygonMode, shading, texture, triangles):
+        self.frame = frame
+        self.mesh = mesh
+        self.pipeline = pipeline
+        self.vertexFormat = vertexFormat
+        self.polygonMode = polygonMode
+        self.shading = shading
+        self.texture = texture
+        self.triangles = triangles
+        self.drawCalls = 0
+        self.cpuMilliseconds = 0.0
+        self.gpuMilliseconds = None
+
+
+# A small ring of GL_TIME_ELAPSED queries. Results are read a few frames
+# late so that reading them never stalls the pipeline.
+class GpuTimer:
+    def __init__(self, depth=4):
+        self.free = deque(int(q) for q in glGenQueries(depth))
+        self.pending = deque()
+
+    # Timer queries are core in OpenGL 3.3.
+    def isSupported():
+        try:
+            version = (glGetIntegerv(GL_MAJOR_VERSION), glGetIntegerv(GL_MINOR_VERSION))
+        except GLError:
+            return False
+        return version >= (3, 3)
+    isSupported = staticmethod(isSupported)
+
+    # Returns False if every query is still in flight. In that case the
+    # frame is simply not timed on the GPU.
+    def begin(self, sample):
+        self.collect()
+        if not self.free:
+            return False
+        query = self.free.popleft()
+        glBeginQuery(GL_TIME_ELAPSED, query)
+        self.pending.append((query, sample))
+        return True
+
+    def end(self):
+        glEndQuery(GL_TIME_ELAPSED)
+
+    # Read back every query that has finished, oldest first.
+    def collect(self):
+        while self.pending:
+            query, sample = self.pending[0]
+            if not glGetQueryObjectiv(query, GL_QUERY_RESULT_AVAILABLE):
+                break
+            nanoseconds = ctypes.c_uint64()
+            glGetQueryObjectui64v(query, GL_QUERY_RESULT, ctypes.byref(nanoseconds))
+            sample.gpuMilliseconds = nanoseconds.value / 1.0e6
+            self.pending.popleft()
+            self.free.append(query)
+
+    def delete(self):
+        queries = list(self.free) + [query for query, sample in self.pending]
+        glDeleteQueries(len(queries), queries)
+        self.free.clear()
+        self.pending.clear()
+
+
+# Rolling window of the most recent frame samples.
+class FrameStats:
+    def __init__(self, capacity=300):
+        self.samples = deque(maxlen=capacity)
+        self.frameCount = 0
+
+    def add(self, sample):
+        self.samples.append(sample)
+        self.frameCount += 1
+
+    # Average and maximum of one field over the samples that have it.
+    def summary(self, field):
+        values = [getattr(s, field) for s in self.samples if getattr(s, field) is not None]
+        if not values:
+            return None, None
+        return sum(values) / len(values), max(values)
+
+    # Writes the rolling window to filename and returns the number of rows.
+    def writeCSV(self, filename):
+        with open(filename, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(CSV_FIELDS)
+            for s in self.samples:
+                writer.writerow([getattr(s, field) if getattr(s, field) is not None else ''
+                                 for field in CSV_FIELDS])
+        return len(self.samples)
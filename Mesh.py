@@ -3,33 +3,121 @@
 # 
 # A Python implementation of the Winged-Edge (or Half-Edge) data structure.
 
-from math import *
-from numpy import *
+from numpy import (add, arange, arccos, array, asarray, bincount, bool_, clip, concatenate, cos,
+                   cumsum, degrees, empty, float16, float32, float64, fmax, fromiter, int16, int32,
+                   int64, linalg, maximum, memmap, pi, repeat, rint, sin, sqrt, stack, uint32, where,
+                   zeros)
+from math import atan2
+import os
 import sys
 import copy
+import hashlib
+import tempfile
 from typing import List, Dict, Optional
 import numpy as np
 from numpy.typing import NDArray
 
 # Edge, Vertex, and Face classes have no methods. 
 # They are just data structures to store the mesh data.
+# Open meshes are bounded by loops of boundary edges, which have no face and
+# are linked to each other by nextEdge and previousEdge around each hole.
+# A boundary vertex always has its boundary edge as eminatingEdge.
 class Edge:
     vertex: 'Vertex'  # The vertex this edge points to
-    face: 'Face'      # The face this edge belongs to
+    face: Optional['Face']  # The face this edge belongs to, None on a boundary
     nextEdge: 'Edge'  # The next edge in the face's edge loop
     previousEdge: 'Edge'  # The previous edge in the face's edge loop
     symmetricEdge: 'Edge'  # The edge pointing in the opposite direction
     texCoord: NDArray[np.float32]  # Texture coordinates for this edge
     flatNormal: NDArray[np.float32]  # Normal for flat shading
     smoothNormal: NDArray[np.float32]  # Normal for smooth shading
+    removed: bool = False  # Set by collapseEdge() until compact() drops it
+    index: int  # Position in Mesh.edges, set by ringAdjacency()
 
 class Vertex:
     position: NDArray[np.float32]
     eminatingEdge: Optional['Edge']
     index: int
+    removed: bool = False
 
 class Face:
-    pass
+    removed: bool = False
+    vboIndex: int = -1  # Where the face is in the OpenGL arrays, -1 if not yet
+
+# The one-rings of all vertices in CSR form. The edges leaving vertex i are
+# edges[offsets[i]:offsets[i+1]] (indices into Mesh.edges), in ring order
+# starting at its eminatingEdge, and neighbors holds their far vertices.
+# Mesh.ringAdjacency() rebuilds it when the topology version has moved on.
+class RingAdjacency:
+    offsets: NDArray[np.int64]
+    edges: NDArray[np.int64]
+    neighbors: NDArray[np.int64]
+    valences: NDArray[np.int64]
+    boundary: NDArray[np.bool_]  # Whether each vertex lies on a boundary
+    version: int
+
+
+# The OpenGL arrays of a Mesh, and the suffixes of their files when they are
+# memory mapped (see Mesh.mapOpenGLArrays()). The files hold raw float32
+# data, so the number of triangles follows from their sizes.
+OPENGL_ARRAY_NAMES = ('vboVertices', 'vboSmoothNormals', 'vboFlatNormals', 'vboTexCoords')
+OPENGL_FILE_SUFFIXES = ('.vertices', '.smoothNormals', '.flatNormals', '.texCoords')
+OPENGL_ARRAY_WIDTHS = (9, 9, 9, 6)   # floats per triangle
+FLAT_NORMALS = OPENGL_ARRAY_NAMES.index('vboFlatNormals')
+
+
+# Packs unit vectors, given as an N x 3 array, into GL_INT_2_10_10_10_REV
+# words: three signed 10-bit components with x in the low bits. The
+# unused 2-bit w component is left at zero.
+def packNormals(normals):
+    q = rint(clip(normals, -1, 1) * 511).astype(int32) & 0x3FF
+    return (q[:,0] | (q[:,1] << 10) | (q[:,2] << 20)).astype(uint32)
+
+# The inverse of packNormals(), using OpenGL's signed normalized rule.
+def unpackNormals(packed):
+    q = stack([(packed >> shift) & 0x3FF for shift in (0, 10, 20)], axis=1).astype(int32)
+    q = where(q >= 512, q - 1024, q)
+    return maximum(q / 511.0, -1.0)
+
+
+# Creates a 2D numpy array of texture coordinates
+# For use with mesh objects: a cylindrical mapping around the x axis.
+def calculateTextureCoordinates(vertices, indices):
+    ssi  = 0 # Vertex component that is source for texture s component
+    tsi1 = 1 # Vertex component that is part 1 of source for texture t component (for atan2)
+    tsi2 = 2 # Vertex component that is part 2 of source for texture t component (for atan2)
+
+    retval = empty((len(indices), 3, 2), dtype = float32)
+    # This is a modified copy of Mesh.centroid(). Bad, I know.
+    centroid = zeros(3)
+    for vert in vertices:
+        centroid += vert
+    centroid /= len(vertices)
+
+    maxssi = max( [vert[ssi] for vert in vertices] ) * 1.01
+    minssi = min( [vert[ssi] for vert in vertices] ) * 1.01
+
+    retvalIndex = 0
+    for f in range(len(indices)):
+        isInQ1 = False
+        isInQ4 = False
+        for v in range(len(indices[f])):
+            vertex = vertices[indices[f][v]]
+            # s is simply the normalized component
+            retval[f,v,0] = (vertex[ssi] - minssi) / (maxssi - minssi)
+            # t is derived from atan2
+            retval[f,v,1] = atan2(vertex[tsi1] - centroid[tsi1], vertex[tsi2] - centroid[tsi2]) / pi / 2.0 + 0.5
+            if retval[f,v,1] < 0.25:
+                isInQ1 = True
+            if retval[f,v,1] > 0.75:
+                isInQ4 = True
+
+        # Check for texture wrap-around
+        if isInQ1 and isInQ4:
+            for v in range(len(indices[f])):
+                if retval[f,v,1] < 0.25:
+                    retval[f,v,1] += 1
+    return retval
 
 
 class Mesh:
@@ -38,10 +126,17 @@ class Mesh:
     # Each subarray describes a face by its vertex index.
     # For example:faces = [[0,1,2], [1,3,2]] describes two adjacent triangles
     # textureCoordinates is a N x 3 x 2 Numpy array
+    # The faces don't need to close the surface: edges used by only one face
+    # become boundary edges.
+    # With triangulate=False the faces stay polygons (for Catmull-Clark);
+    # they are only cut into triangles in the OpenGL arrays.
 
-    def __init__(self, verts, faces, texCoords):
+    def __init__(self, verts, faces, texCoords, triangulate=True):
+        edgeCount = 0
+        for f in faces:
+            edgeCount += len(f)
         self.faces = [Face() for x in range(len(faces))]
-        self.edges = [Edge() for x in range((2*(len(faces) + len(verts) - 2)))]
+        self.edges = [Edge() for x in range(edgeCount)]
         self.verts = [None for x in range(len(verts))]
         edgeMap = {}
 
@@ -70,7 +165,7 @@ class Mesh:
                 e.previousEdge = self.edges[firstEdgeOfFace + previousIndex]
                 e.texCoord = texCoords[faceIndex,vertexIndex,:]
 
-                symmetricEdge = edgeMap.get((v1, v0))
+                symmetricEdge = edgeMap.pop((v1, v0), None)
                 if (symmetricEdge):
                     e.symmetricEdge = symmetricEdge # Symmetric edge already processed
                     symmetricEdge.symmetricEdge = e
@@ -79,24 +174,70 @@ class Mesh:
 
             firstEdgeOfFace += countOfVertices
 
+        # Whatever is left in the map lies on a boundary
+        self.createBoundaryEdges(edgeMap.values())
+
         i = 0
         for v in self.verts:
             v.index = i
             i += 1
 
-        self.triangulate()
-        self.computeNormals()
-        self.createOpenGLArrays()
+        self.needsCompact = False
+        # Bumped by every change to the connectivity
+        self.topologyVersion = 0
+        self.adjacency = None
+        # Faces and vertices touched by the local edits since the last
+        # updateNormals(), and the faces updateOpenGLArrays() must rewrite.
+        self.touchedFaces = set()
+        self.touchedVerts = set()
+        self.changedFaces = set()
+        self.releasedFaces = []
+        # Where the OpenGL arrays are memory mapped, None if in memory
+        self.vboBasename = None
+        # Derived data, computed when first needed: the normals by
+        # ensureNormals(), the OpenGL arrays when one of them is read, and
+        # (centroid, lower corner, upper corner) by centroid() and bounds().
+        # invalidate() marks it all stale. The flat-normal array is only
+        # built when it is read itself, since the GLSL path doesn't use it.
+        self.normalsValid = False
+        self.openGLArraysValid = False
+        self.flatNormalArrayValid = False
+        self.extent = None
+
+        if (triangulate):
+            self.triangulate()
+
+
+    # Gives each of the given edges a symmetric boundary edge, and links the
+    # boundary edges into loops. Each boundary vertex must have exactly one
+    # boundary edge leaving it (MeshArrays.repairMesh() ensures that).
+    def createBoundaryEdges(self, edges):
+        boundaryFrom = {}
+        for e in edges:
+            b = Edge()
+            b.vertex = e.nextEdge.vertex
+            b.face = None
+            b.symmetricEdge = e
+            b.texCoord = e.nextEdge.texCoord
+            e.symmetricEdge = b
+            b.vertex.eminatingEdge = b
+            boundaryFrom[b.vertex] = b
+            self.edges.append(b)
 
+        for b in boundaryFrom.values():
+            b.nextEdge = boundaryFrom[b.symmetricEdge.vertex]
+            b.nextEdge.previousEdge = b
 
     # Create arrays of vertices and faces appropriate for creating new meshes
     def copyOfVertices(self):
+        self.compact()
         retval = empty((len(self.verts), 3), dtype=float32)
         for i in range(len(self.verts)):
             retval[i,:] = self.verts[i].position.copy()
         return retval
 
     def copyOfIndices(self):
+        self.compact()
         retval = []
         for f in self.faces:
             fi = []
@@ -109,6 +250,28 @@ class Mesh:
             retval.append(fi)
         return retval
 
+    # Texture coordinates of the faces' corners, in the order of
+    # copyOfIndices(). The faces must be triangles.
+    def copyOfTexCoords(self):
+        self.compact()
+        retval = empty((len(self.faces), 3, 2), dtype=float32)
+        for i in range(len(self.faces)):
+            e = self.faces[i].edge
+            for j in range(3):
+                retval[i,j,:] = e.texCoord
+                e = e.nextEdge
+        return retval
+
+    # Average length of the edges in the mesh. Every edge is seen once from
+    # each of its half-edges, which doesn't change the average.
+    def averageEdgeLength(self):
+        self.compact()
+        total = 0.0
+        for e in self.edges:
+            d = e.nextEdge.vertex.position - e.vertex.position
+            total += sqrt(d[0] * d[0] + d[1] * d[1] + d[2] * d[2])
+        return total / len(self.edges)
+
     def normalize(self, d):
         dd = sqrt(d[0] * d[0] + d[1] * d[1] + d[2] * d[2])
         if (dd > 0):
@@ -123,6 +286,7 @@ class Mesh:
             e3 = e2.nextEdge
             if (e == e3):
                 break
+            self.topologyVersion += 1
 
 
             v1 = e1.vertex
@@ -161,7 +325,24 @@ class Mesh:
     def triangulate(self):
         for face in self.faces:
             self.triangulateFace(face)
-        self.computeNormals()
+        self.invalidate()
+
+    # Number of edges (and corners) of f
+    def faceSize(self, f):
+        n = 0
+        e = s = f.edge
+        while True:
+            n += 1
+            e = e.nextEdge
+            if (e == s):
+                break
+        return n
+
+    def isTriangulated(self):
+        for f in self.faces:
+            if (f.edge.nextEdge.nextEdge.nextEdge != f.edge):
+                return False
+        return True
 
 
     def Tetrahedron(a):
@@ -188,7 +369,8 @@ class Mesh:
     Tetrahedron = staticmethod(Tetrahedron)
 
 
-    def Cube(a):
+    # With triangulate=False the cube keeps its six quads
+    def Cube(a, triangulate=True):
         vertices = array([[0,0,0],
                           [a,0,0],
                           [a,a,0],
@@ -230,41 +412,52 @@ class Mesh:
                              [0.99, 0.99],
                              [2 * d3, 0.99] ] ], dtype = float32)
 
-        return Mesh(vertices, faces, texCoord)
+        return Mesh(vertices, faces, texCoord, triangulate)
     Cube = staticmethod(Cube)
 
 
+    # The half-edges subdivision puts new vertices on: of each edge the one
+    # leaving the lower numbered vertex, sorted by their two vertices. The
+    # new vertices are numbered in this order, so the numbering depends only
+    # on the old one.
+    def splitEdgeList(self):
+        edges = [e for e in self.edges if e.vertex.index < e.symmetricEdge.vertex.index]
+        edges.sort(key = lambda e: (e.vertex.index, e.symmetricEdge.vertex.index))
+        return edges
+
     def oddLoopVertices(self):
         vMap = {}
-        for e in self.edges:
-            if (e > e.symmetricEdge): # Associate vertex with the smaller edge pointer
-                continue
-            pos = (e.vertex.position + e.symmetricEdge.vertex.position) * (3.0/8) +\
-                (e.previousEdge.vertex.position + e.symmetricEdge.previousEdge.vertex.position) * (1.0/8)
+        for e in self.splitEdgeList():
+            if (e.face is None or e.symmetricEdge.face is None):
+                # Boundary edges are split at their midpoint
+                pos = (e.vertex.position + e.symmetricEdge.vertex.position) * 0.5
+            else:
+                pos = (e.vertex.position + e.symmetricEdge.vertex.position) * (3.0/8) +\
+                    (e.previousEdge.vertex.position + e.symmetricEdge.previousEdge.vertex.position) * (1.0/8)
             vMap[e] = pos
         return vMap
 
     def evenLoopVertices(self):
-        vMap = {}
-        for v in self.verts:
-            n = 0
-            pos = zeros((3))
-            e = s = v.eminatingEdge
-            while True:
-                pos += e.symmetricEdge.vertex.position
-                n += 1
-                e = e.symmetricEdge.nextEdge
-                if (e == s):
-                    break
-            if n == 3:
-                beta = 3.0/16
-            else:
-                beta = 3.0/(8*n)
-            pos = pos * beta + v.position * (1 - n * beta)
-            vMap[v] = pos
-        return vMap
+        adjacency = self.ringAdjacency()
+        positions = self.positions()
+        n = adjacency.valences[:, None]
+        beta = where(n == 3, 3.0/16, 3.0/(8 * n))
+        newPositions = self.ringSum(positions) * beta + positions * (1 - n * beta)
+        self.applyBoundaryRule(positions, newPositions)
+        return dict(zip(self.verts, newPositions))
+
+    # Boundary vertices only follow their two boundary neighbors, which are
+    # the first and last of their ring. Both Loop and Catmull-Clark use
+    # this rule; it overwrites their rows of newPositions.
+    def applyBoundaryRule(self, positions, newPositions):
+        adjacency = self.ringAdjacency()
+        b = adjacency.boundary
+        first = adjacency.neighbors[adjacency.offsets[:-1][b]]
+        last = adjacency.neighbors[adjacency.offsets[1:][b] - 1]
+        newPositions[b] = positions[b] * (3.0/4) + (positions[first] + positions[last]) * (1.0/8)
 
     def splitEdge(self, e, pos):
+        self.topologyVersion += 1
         e0 = Edge()
         e1 = Edge()
         v0 = Vertex()
@@ -272,6 +465,8 @@ class Mesh:
         v0.index = len(self.verts)
         v0.position = pos
         v0.eminatingEdge = e0
+        if (e.symmetricEdge.face is None):
+            v0.eminatingEdge = e1   # Keep boundary vertices on their boundary edge
 
         e0.vertex = v0
         e0.face = e.face
@@ -303,104 +498,1036 @@ class Mesh:
             self.splitEdge(e,vmap[e])
 
     def loopSubdivide(self):
+        self.compact()
+        if (not self.isTriangulated()):
+            self.triangulate()
+        self.canonicalize()
         oddVertMap = self.oddLoopVertices()
         evenVertMap = self.evenLoopVertices()
         for v in self.verts:
             v.position = evenVertMap[v]
         self.splitAllEdges(oddVertMap)
         self.triangulate()
-        self.computeNormals()
-        self.createOpenGLArrays()
+        self.canonicalize()
+        self.invalidate()
 
-    def butterflySubdivide(self):
-        vMap = {}
-        for e in self.edges:
-            if (id(e) > id(e.symmetricEdge)): # Associate vertex with smaller edge pointer
-                continue
-            p1 = e.vertex.position
-            p2 = e.symmetricEdge.vertex.position
-            p3 = e.nextEdge.symmetricEdge.vertex.position
-            p4 = e.symmetricEdge.nextEdge.symmetricEdge.vertex.position
-            q1 = e.symmetricEdge.nextEdge.symmetricEdge.nextEdge.symmetricEdge.vertex.position
-            q2 = e.symmetricEdge.previousEdge.symmetricEdge.previousEdge.vertex.position
-            q3 = e.nextEdge.symmetricEdge.nextEdge.symmetricEdge.vertex.position
-            q4 = e.previousEdge.symmetricEdge.nextEdge.symmetricEdge.vertex.position
+    # The new vertex for edge e in butterfly subdivision. Boundary edges use
+    # the four-point rule along the boundary. Interior edges whose eight-point
+    # stencil runs into a boundary fall back to the Loop rule.
+    def butterflyVertex(self, e):
+        if (e.face is None):
+            e = e.symmetricEdge
+        b = e.symmetricEdge
+        p1 = e.vertex.position
+        p2 = b.vertex.position
+        if (b.face is None):
+            return (9.0 * (p1 + p2) - (b.previousEdge.vertex.position +
+                                       b.nextEdge.nextEdge.vertex.position)) / 16.0
 
-            pos = (8.0 * (p1 + p2) + 2.0 * (p3 + p4) - (q1 + q2 + q3 + q4)) / 16.0
+        p3 = e.nextEdge.symmetricEdge.vertex.position
+        p4 = b.nextEdge.symmetricEdge.vertex.position
+        if (e.nextEdge.symmetricEdge.face is None or e.previousEdge.symmetricEdge.face is None or
+            b.nextEdge.symmetricEdge.face is None or b.previousEdge.symmetricEdge.face is None):
+            return (3.0 * (p1 + p2) + (p3 + p4)) / 8.0
 
-            vMap[e] = pos
+        q1 = b.nextEdge.symmetricEdge.nextEdge.symmetricEdge.vertex.position
+        q2 = b.previousEdge.symmetricEdge.previousEdge.vertex.position
+        q3 = e.nextEdge.symmetricEdge.nextEdge.symmetricEdge.vertex.position
+        q4 = e.previousEdge.symmetricEdge.nextEdge.symmetricEdge.vertex.position
+
+        return (8.0 * (p1 + p2) + 2.0 * (p3 + p4) - (q1 + q2 + q3 + q4)) / 16.0
+
+    def butterflySubdivide(self):
+        self.compact()
+        if (not self.isTriangulated()):
+            self.triangulate()
+        self.canonicalize()
+        vMap = {}
+        for e in self.splitEdgeList():
+            vMap[e] = self.butterflyVertex(e)
 
         self.splitAllEdges(vMap)
         self.triangulate()
-        self.computeNormals()
-        self.createOpenGLArrays()
+        self.canonicalize()
+        self.invalidate()
 
+    # Positions of the vertices on the limit surface of Loop subdivision
+    # (with the weights evenLoopVertices() uses): an interior vertex of
+    # valence n goes to (1 - n c) P + c R, c = 1 / (3 / (8 beta) + n), where
+    # R is the sum of its neighbors; a boundary vertex to 2/3 P + 1/6 of its
+    # two boundary neighbors.
+    def loopLimitPositions(self):
+        adjacency = self.ringAdjacency()
+        positions = self.positions()
+        n = adjacency.valences[:, None]
+        beta = where(n == 3, 3.0/16, 3.0/(8 * n))
+        c = 1.0 / (3.0 / (8 * beta) + n)
+        limit = self.ringSum(positions) * c + positions * (1 - n * c)
 
-    def computeNormals(self):
-        # Calculate the flat shading normals
+        b = adjacency.boundary
+        first = adjacency.neighbors[adjacency.offsets[:-1][b]]
+        last = adjacency.neighbors[adjacency.offsets[1:][b] - 1]
+        limit[b] = positions[b] * (2.0/3) + (positions[first] + positions[last]) * (1.0/6)
+        return limit
+
+    # Unit normals of the Loop limit surface at the vertices, from the
+    # closed-form tangent masks. Inside, the tangents weight the ring by
+    # cos(2 pi i / n) and sin(2 pi i / n). On a boundary with neighbors
+    # p0 ... pk in ring order, one tangent runs along the boundary and the
+    # other across it, pointing inward (Hoppe et al. 1994): p0 + pk - 2 P
+    # for k = 1, 2 p1 - p0 - p2 for k = 2, and otherwise
+    # (2 - 2 cos(t)) sum sin(i t) pi - sin(t) (p0 + pk) with t = pi / k.
+    def loopLimitNormals(self):
+        adjacency = self.ringAdjacency()
+        positions = self.positions()
+        i, n = self.ringPositions()
+        owner = repeat(arange(len(self.verts)), adjacency.valences)
+        onBoundary = adjacency.boundary[owner]
+
+        angle = 2 * pi * i / n
+        first = self.ringSum(positions, where(onBoundary, 0.0, cos(angle)))
+        second = self.ringSum(positions, where(onBoundary, 0.0, sin(angle)))
+
+        k = n - 1
+        theta = pi / maximum(k, 1)
+        end = (i == 0) | (i == k)
+        across = where(end, -sin(theta), (2 - 2 * cos(theta)) * sin(i * theta))
+        across = where(k == 1, 1.0, across)
+        across = where(k == 2, where(end, -1.0, 2.0), across)
+        across = self.ringSum(positions, where(onBoundary, across, 0.0))
+        b = adjacency.boundary
+        across[b] -= 2 * positions[b] * (adjacency.valences[b] == 2)[:, None]
+        p0 = adjacency.neighbors[adjacency.offsets[:-1][b]]
+        pk = adjacency.neighbors[adjacency.offsets[1:][b] - 1]
+        first[b] = positions[p0] - positions[pk]
+        second[b] = across[b]
+
+        normals = stack([second[:,1] * first[:,2] - second[:,2] * first[:,1],
+                         second[:,2] * first[:,0] - second[:,0] * first[:,2],
+                         second[:,0] * first[:,1] - second[:,1] * first[:,0]], axis = 1)
+        lengths = sqrt((normals * normals).sum(axis = 1))
+        return normals / where(lengths > 0, lengths, 1.0)[:, None]
+
+    # Moves every vertex onto the Loop limit surface and shades it with the
+    # exact limit normals, so a mesh subdivided once or twice looks like one
+    # subdivided many times. The mesh is no longer the control mesh after
+    # this: do it last, on a copy if more levels may be needed.
+    def projectToLoopLimit(self):
+        self.compact()
+        if (not self.isTriangulated()):
+            self.triangulate()
+        normals = self.loopLimitNormals()
+        positions = self.loopLimitPositions()
+        for v in self.verts:
+            v.position = positions[v.index]
+        self.setSmoothNormals(normals)
+
+    # Catmull-Clark subdivision. Works on any polygons and leaves only
+    # quads: every face gets a vertex at its centroid, every edge a vertex
+    # from its ends and the two face points (its midpoint on a boundary),
+    # and the old vertices move to (F + R + (n - 2) P) / n, where F is the
+    # average of their face points and R of their neighbors.
+    def catmullClarkSubdivide(self):
+        self.canonicalize()
+        vertexCount = len(self.verts)
+        faceCount = len(self.faces)
+        facePoints, faceCoords = self.faceCenters()
+
+        vMap = {}
+        for e in self.splitEdgeList():
+            b = e.symmetricEdge
+            if (e.face is None or b.face is None):
+                vMap[e] = (e.vertex.position + b.vertex.position) * 0.5
+            else:
+                vMap[e] = (e.vertex.position + b.vertex.position +
+                           facePoints[e.face] + facePoints[b.face]) * 0.25
+
+        positions = self.positions()
+        n = self.valences()[:, None].astype(float64)
+        noPoint = zeros((3))
+        edgeFacePoints = array([noPoint if e.face is None else facePoints[e.face] for e in self.edges])
+        newPositions = (self.ringEdgeSum(edgeFacePoints) / n + self.ringMean(positions) +
+                        positions * (n - 2)) / n
+        self.applyBoundaryRule(positions, newPositions)
+        for v in self.verts:
+            v.position = newPositions[v.index]
+
+        self.splitAllEdges(vMap)
+        for f in self.faces[:faceCount]:
+            self.splitFaceAtCenter(f, facePoints[f], faceCoords[f], vertexCount)
+        self.canonicalize()
+        self.invalidate()
+
+    # The centroid and the average texture coordinate of every face, as two
+    # dicts keyed by face.
+    def faceCenters(self):
+        facePoints = {}
+        faceCoords = {}
         for f in self.faces:
-            # First, calculate the normal
-            normal = zeros((3))
+            pos = zeros((3))
+            coord = zeros((2))
+            n = 0
             e = s = f.edge
+            while True:
+                pos += e.vertex.position
+                coord += e.texCoord
+                n += 1
+                e = e.nextEdge
+                if (e == s):
+                    break
+            facePoints[f] = pos / n
+            faceCoords[f] = (coord / n).astype(float32)
+        return facePoints, faceCoords
+
+    # Subdivides the mesh's topology as scheme ('butterfly', 'loop' or
+    # 'catmullclark') does, but takes every vertex position, old and new,
+    # from positions (indexed the way that subdivision numbers the vertices)
+    # instead of computing it. The result is the mesh that subdivision would
+    # have made if positions are the ones it computed. MultiresMesh.py
+    # rebuilds its levels this way.
+    def refine(self, scheme, positions):
+        if (scheme == 'catmullclark'):
+            self.canonicalize()
+        else:
+            self.compact()
+            if (not self.isTriangulated()):
+                self.triangulate()
+            self.canonicalize()
+        vertexCount = len(self.verts)
+        faceCount = len(self.faces)
+        if (scheme == 'catmullclark'):
+            facePoints, faceCoords = self.faceCenters()
+        edges = self.splitEdgeList()
+        for v in self.verts:
+            v.position = positions[v.index]
 
-            while(True):
-                v = e.vertex.position
-                vNext = e.nextEdge.vertex.position
-                normal += array([(v[1] - vNext[1]) * (v[2] + vNext[2]),
-                                 (v[2] - vNext[2]) * (v[0] + vNext[0]),
-                                 (v[0] - vNext[0]) * (v[1] + vNext[1])])
+        self.splitAllEdges(dict((e, positions[vertexCount + i]) for i, e in enumerate(edges)))
+        if (scheme == 'catmullclark'):
+            first = vertexCount + len(edges)
+            for i, f in enumerate(self.faces[:faceCount]):
+                self.splitFaceAtCenter(f, positions[first + i], faceCoords[f], vertexCount)
+        else:
+            self.triangulate()
+        self.canonicalize()
+        self.invalidate()
+
+    # Joins a new vertex at position to every other corner of f, which
+    # has alternating old vertices (index below firstNewVertex) and edge
+    # vertices, turning f into one quad per old vertex.
+    def splitFaceAtCenter(self, f, position, texCoord, firstNewVertex):
+        self.topologyVersion += 1
+        s = f.edge
+        if (s.vertex.index >= firstNewVertex):
+            s = s.nextEdge
+        corners = []   # Edges from old vertices to edge vertices
+        e = s
+        while True:
+            corners.append(e)
+            e = e.nextEdge.nextEdge
+            if (e == s):
+                break
+        backs = [e.nextEdge for e in corners]   # Edges from edge vertices to old vertices
+
+        c = Vertex()
+        c.index = len(self.verts)
+        c.position = position
+        self.verts.append(c)
+        inward = []
+        outward = []
+        for e in backs:
+            a = Edge()
+            b = Edge()
+            a.vertex = e.vertex
+            a.texCoord = e.texCoord
+            b.vertex = c
+            b.texCoord = texCoord
+            a.symmetricEdge = b
+            b.symmetricEdge = a
+            inward.append(a)
+            outward.append(b)
+            self.edges.append(a)
+            self.edges.append(b)
+        c.eminatingEdge = outward[0]
+
+        for i in range(len(corners)):
+            if (i == 0):
+                face = f
+            else:
+                face = Face()
+                self.faces.append(face)
+            loop = [corners[i], inward[i], outward[i - 1], backs[i - 1]]
+            for j in range(4):
+                loop[j].face = face
+                loop[j].nextEdge = loop[(j + 1) % 4]
+                loop[(j + 1) % 4].previousEdge = loop[j]
+            face.edge = corners[i]
+
+
+    # Vertices joined to v by an edge
+    def neighbors(self, v):
+        retval = set()
+        e = s = v.eminatingEdge
+        while True:
+            retval.add(e.symmetricEdge.vertex)
+            e = e.symmetricEdge.nextEdge
+            if (e == s):
+                break
+        return retval
+
+    # Whether collapsing the edge of e leaves a manifold triangle mesh. This
+    # is the link condition: the only vertices adjacent to both ends may be
+    # the ones opposite the edge. Also refuses to pinch two boundaries
+    # together, to close a lone triangle or to flatten a tetrahedron.
+    def canCollapse(self, e):
+        b = e.symmetricEdge
+        u = e.vertex
+        v = b.vertex
+        onBoundary = e.face is None or b.face is None
+        if (not onBoundary and u.eminatingEdge.face is None and v.eminatingEdge.face is None):
+            return False
+        opposite = set()
+        for h in (e, b):
+            if (h.face is not None):
+                if (h.nextEdge.symmetricEdge.face is None and h.previousEdge.symmetricEdge.face is None):
+                    return False
+                opposite.add(h.previousEdge.vertex)
+        uNeighbors = self.neighbors(u)
+        vNeighbors = self.neighbors(v)
+        if ((uNeighbors & vNeighbors) != opposite):
+            return False
+        return onBoundary or len(uNeighbors) > 3 or len(vNeighbors) > 3
+
+    # Collapses the edge of e, from u = e.vertex to v, into u, which moves
+    # to position. The faces on both sides of the edge go away and their
+    # other two edges are joined. Removed faces, edges and vertices are
+    # only flagged; compact() takes them out of the lists. Texture
+    # coordinates are kept as they are. canCollapse(e) must be true.
+    def collapseEdge(self, e, position):
+        self.topologyVersion += 1
+        b = e.symmetricEdge
+        u = e.vertex
+        v = b.vertex
+
+        # Every edge leaving v now leaves u
+        h = s = v.eminatingEdge
+        while True:
+            h.vertex = u
+            h = h.symmetricEdge.nextEdge
+            if (h == s):
+                break
+
+        for h in (e, b):
+            if (h.face is None):
+                # Take it out of its boundary loop
+                h.previousEdge.nextEdge = h.nextEdge
+                h.nextEdge.previousEdge = h.previousEdge
+                start = h.nextEdge
+            else:
+                n = h.nextEdge
+                p = h.previousEdge
+                n.symmetricEdge.symmetricEdge = p.symmetricEdge
+                p.symmetricEdge.symmetricEdge = n.symmetricEdge
+                if (p.vertex.eminatingEdge == p):
+                    p.vertex.eminatingEdge = n.symmetricEdge
+                h.face.removed = n.removed = p.removed = True
+                start = p.symmetricEdge
+            h.removed = True
+        v.removed = True
+        self.needsCompact = True
+
+        u.position = position
+        u.eminatingEdge = h = start
+        while True:
+            if (h.face is None):
+                u.eminatingEdge = h
+                break
+            h = h.symmetricEdge.nextEdge
+            if (h == start):
+                break
+
+    # Puts the faces, the edges and the vertices' eminating edges in an order
+    # that depends only on the vertex numbering and on which vertices each
+    # face has: every face starts at its lowest numbered vertex, the faces
+    # are sorted by their vertex lists, the edges follow the faces (boundary
+    # edges last, sorted by their vertices), and an interior vertex's
+    # eminatingEdge leads to its lowest numbered neighbor. Subdivision
+    # canonicalizes before and after, so equal meshes subdivide to byte-
+    # identical results whatever their history. The normals stay valid and
+    # the OpenGL arrays are left as they are; after invalidate() they are
+    # laid out in the new order.
+    def canonicalize(self):
+        self.compact()
+        keys = {}
+        for f in self.faces:
+            corners = []
+            e = s = f.edge
+            while True:
+                corners.append(e)
                 e = e.nextEdge
                 if (e == s):
                     break
-            self.normalize(normal)
+            indices = [c.vertex.index for c in corners]
+            first = indices.index(min(indices))
+            f.edge = corners[first]
+            keys[f] = tuple(indices[first:] + indices[:first])
+        self.faces.sort(key = keys.get)
 
-            # Now, apply the normal to all of the edges
+        edges = []
+        for f in self.faces:
             e = s = f.edge
-            while(True):
-                e.flatNormal = normal
+            while True:
+                edges.append(e)
                 e = e.nextEdge
                 if (e == s):
                     break
+        boundary = [e for e in self.edges if e.face is None]
+        boundary.sort(key = lambda e: (e.vertex.index, e.symmetricEdge.vertex.index))
+        self.edges = edges + boundary
 
-        # Calculate the smooth shading normals
         for v in self.verts:
-            normal = zeros((3))
-            e = s = v.eminatingEdge
-            while(True):
-                normal += e.flatNormal
-                e = e.previousEdge.symmetricEdge
-                if (e == s):
+            if (v.eminatingEdge.face is None):
+                continue
+            best = h = s = v.eminatingEdge
+            while True:
+                if (h.symmetricEdge.vertex.index < best.symmetricEdge.vertex.index):
+                    best = h
+                h = h.symmetricEdge.nextEdge
+                if (h == s):
                     break
-            self.normalize(normal)
+            v.eminatingEdge = best
+        self.topologyVersion += 1
 
-            # Apply to all of the edges
-            while (True):
-                e.smoothNormal = normal
-                e = e.previousEdge.symmetricEdge
+    # A SHA-256 hex digest of the canonical mesh: vertex positions, the
+    # faces' vertices and their texture coordinates. Equal meshes hash
+    # equally whatever their history, so the hash can key caches of meshes
+    # and their subdivisions. Canonicalizes the mesh.
+    def contentHash(self):
+        self.canonicalize()
+        sizes = []
+        indices = []
+        texCoords = []
+        for f in self.faces:
+            e = s = f.edge
+            while True:
+                indices.append(e.vertex.index)
+                texCoords.append(e.texCoord)
+                e = e.nextEdge
                 if (e == s):
                     break
+            sizes.append(self.faceSize(f))
+        digest = hashlib.sha256()
+        digest.update(array([len(self.verts), len(sizes), len(indices)], dtype = '<i8').tobytes())
+        digest.update(self.positions().astype('<f8').tobytes())
+        digest.update(array(sizes, dtype = '<i8').tobytes())
+        digest.update(array(indices, dtype = '<i8').tobytes())
+        digest.update(array(texCoords, dtype = '<f8').tobytes())
+        return digest.hexdigest()
+
+    # Vertex positions as a V x 3 array in vertex index order
+    def positions(self):
+        self.compact()
+        return array([v.position for v in self.verts], dtype = float64)
+
+    # The one-ring adjacency of every vertex (see RingAdjacency), built in
+    # one pass over the edges and cached until the topology changes.
+    def ringAdjacency(self):
+        self.compact()
+        if (self.adjacency is not None and self.adjacency.version == self.topologyVersion):
+            return self.adjacency
+        i = 0
+        for e in self.edges:
+            e.index = i
+            i += 1
+        edgeCount = len(self.edges)
+        origin = fromiter((e.vertex.index for e in self.edges), int64, edgeCount)
+        destination = fromiter((e.symmetricEdge.vertex.index for e in self.edges), int64, edgeCount)
+        rotation = fromiter((e.symmetricEdge.nextEdge.index for e in self.edges), int64, edgeCount)
+        start = fromiter((v.eminatingEdge.index for v in self.verts), int64, len(self.verts))
+        onBoundary = fromiter((e.face is None for e in self.edges), bool_, edgeCount)
+
+        # Rank every edge in its ring by pointer jumping: dist counts the
+        # steps left to the edge just before the ring's start.
+        isStart = zeros(edgeCount, dtype = bool_)
+        isStart[start] = True
+        last = isStart[rotation]
+        successor = where(last, arange(edgeCount), rotation)
+        dist = (~last).astype(int64)
+        valences = bincount(origin, minlength = len(self.verts))
+        steps = 1
+        while steps < valences.max(initial = 1):
+            dist += dist[successor]
+            successor = successor[successor]
+            steps *= 2
+
+        adjacency = RingAdjacency()
+        adjacency.offsets = zeros(len(self.verts) + 1, dtype = int64)
+        cumsum(valences, out = adjacency.offsets[1:])
+        order = empty(edgeCount, dtype = int64)
+        order[adjacency.offsets[origin] + valences[origin] - 1 - dist] = arange(edgeCount)
+        adjacency.edges = order
+        adjacency.neighbors = destination[order]
+        adjacency.valences = valences
+        adjacency.boundary = onBoundary[start]
+        adjacency.version = self.topologyVersion
+        self.adjacency = adjacency
+        return adjacency
+
+    # Number of edges at every vertex
+    def valences(self):
+        return self.ringAdjacency().valences
+
+    # Sums over the one-ring of every vertex. values holds one row per
+    # vertex; the result holds, for each vertex, the sum of its neighbors'.
+    # weights, if given, scales each ring entry (in adjacency order).
+    def ringSum(self, values, weights = None):
+        adjacency = self.ringAdjacency()
+        terms = asarray(values)[adjacency.neighbors]
+        if (weights is not None):
+            terms = terms * weights.reshape((-1,) + (1,) * (terms.ndim - 1))
+        return add.reduceat(terms, adjacency.offsets[:-1], axis = 0)
+
+    # For every ring entry, its position in the ring (0 for the edge at
+    # eminatingEdge) and the valence of the ring's vertex.
+    def ringPositions(self):
+        adjacency = self.ringAdjacency()
+        valences = repeat(adjacency.valences, adjacency.valences)
+        return arange(len(adjacency.edges)) - repeat(adjacency.offsets[:-1], adjacency.valences), valences
+
+    def ringMean(self, values):
+        valences = self.ringAdjacency().valences
+        sums = self.ringSum(values)
+        return sums / valences.reshape((-1,) + (1,) * (sums.ndim - 1))
+
+    # Like ringSum(), but values holds one row per edge (in Mesh.edges
+    # order) and each vertex sums the rows of the edges leaving it.
+    def ringEdgeSum(self, values):
+        adjacency = self.ringAdjacency()
+        return add.reduceat(asarray(values)[adjacency.edges], adjacency.offsets[:-1], axis = 0)
+
+    # Drops the faces, edges and vertices collapseEdge() removed and
+    # renumbers the vertices. Operations on the whole mesh call this first.
+    def compact(self):
+        if (not self.needsCompact):
+            return
+        self.needsCompact = False
+        self.topologyVersion += 1
+        self.faces = [f for f in self.faces if not f.removed]
+        self.edges = [e for e in self.edges if not e.removed]
+        self.verts = [v for v in self.verts if not v.removed]
+        i = 0
+        for v in self.verts:
+            v.index = i
+            i += 1
+
+
+    # Local edits. Each one records the faces and vertices it touches;
+    # updateNormals() and updateOpenGLArrays() then redo only those.
+    # flipEdge(), split() and collapse() need a triangulated mesh.
+
+    # Faces around v
+    def facesAround(self, v):
+        retval = []
+        e = s = v.eminatingEdge
+        while True:
+            if (e.face is not None):
+                retval.append(e.face)
+            e = e.symmetricEdge.nextEdge
+            if (e == s):
+                break
+        return retval
+
+    def moveVertex(self, v, position):
+        v.position = array(position, dtype = float64)
+        self.extent = None
+        self.touchedFaces.update(self.facesAround(v))
+        self.touchedVerts.add(v)
+
+    # Replaces the edge of e, the diagonal of the two triangles on its
+    # sides, by the other diagonal. Returns False, and changes nothing, on
+    # a boundary or if the other diagonal is already an edge.
+    def flipEdge(self, e):
+        b = e.symmetricEdge
+        if (e.face is None or b.face is None):
+            return False
+        u = e.vertex
+        v = b.vertex
+        w = e.previousEdge.vertex
+        x = b.previousEdge.vertex
+        if (w == x or x in self.neighbors(w)):
+            return False
+
+        # (u, v, w) and (v, u, x) become (u, x, w) and (x, v, w)
+        self.topologyVersion += 1
+        f = e.face
+        g = b.face
+        en = e.nextEdge
+        ep = e.previousEdge
+        bn = b.nextEdge
+        bp = b.previousEdge
+
+        e.vertex = x
+        e.texCoord = bp.texCoord
+        b.vertex = w
+        b.texCoord = ep.texCoord
+        bn.nextEdge = e
+        e.nextEdge = ep
+        ep.nextEdge = bn
+        bp.nextEdge = en
+        en.nextEdge = b
+        b.nextEdge = bp
+        for h in (e, ep, bn, b, bp, en):
+            h.nextEdge.previousEdge = h
+        bn.face = e.face = ep.face = f
+        bp.face = en.face = b.face = g
+        f.edge = e
+        g.edge = b
+        if (u.eminatingEdge == e):
+            u.eminatingEdge = bn
+        if (v.eminatingEdge == b):
+            v.eminatingEdge = en
+
+        self.touchedFaces.update((f, g))
+        return True
+
+    # Splits the edge of e at position and splits the triangles on its
+    # sides in two. Returns the new vertex.
+    def split(self, e, position):
+        b = e.symmetricEdge
+        self.splitEdge(e, array(position, dtype = float64))
+        self.extent = None
+        for h in (e, b):
+            if (h.face is not None):
+                faceCount = len(self.faces)
+                h.face.edge = h
+                self.triangulateFace(h.face)
+                self.touchedFaces.add(h.face)
+                self.touchedFaces.update(self.faces[faceCount:])
+        return e.nextEdge.vertex
+
+    # collapseEdge() as a local edit. Returns False, and changes nothing, if
+    # canCollapse(e) is false.
+    def collapse(self, e, position):
+        if (not self.canCollapse(e)):
+            return False
+        u = e.vertex
+        for h in (e, e.symmetricEdge):
+            if (h.face is not None):
+                self.releasedFaces.append(h.face)
+                self.changedFaces.discard(h.face)
+        self.collapseEdge(e, array(position, dtype = float64))
+        self.extent = None
+        self.releasedFaces = [f for f in self.releasedFaces if f.vboIndex >= 0]
+        self.touchedFaces.update(self.facesAround(u))
+        self.touchedVerts.add(u)
+        return True
+
+
+    # Flat shading normal of f, applied to all of its edges
+    def computeFaceNormal(self, f):
+        normal = zeros((3))
+        e = s = f.edge
+
+        while(True):
+            v = e.vertex.position
+            vNext = e.nextEdge.vertex.position
+            normal += array([(v[1] - vNext[1]) * (v[2] + vNext[2]),
+                             (v[2] - vNext[2]) * (v[0] + vNext[0]),
+                             (v[0] - vNext[0]) * (v[1] + vNext[1])])
+            e = e.nextEdge
+            if (e == s):
+                break
+        self.normalize(normal)
+
+        # Now, apply the normal to all of the edges
+        e = s = f.edge
+        while(True):
+            e.flatNormal = normal
+            e = e.nextEdge
+            if (e == s):
+                break
+
+    # Smooth shading normal of v, from the flat normals of its faces
+    def computeVertexNormal(self, v):
+        normal = zeros((3))
+        e = s = v.eminatingEdge
+        while(True):
+            if (e.face is not None):
+                normal += e.flatNormal
+            e = e.previousEdge.symmetricEdge
+            if (e == s):
+                break
+        self.normalize(normal)
+
+        # Apply to all of the edges
+        while (True):
+            e.smoothNormal = normal
+            e = e.previousEdge.symmetricEdge
+            if (e == s):
+                break
+
+    # Marks the derived data stale after the positions or the topology have
+    # changed in bulk: the normals, the OpenGL arrays, the centroid and the
+    # bounds are computed again when next needed. The local edits don't
+    # need it; updateNormals() and updateOpenGLArrays() keep up with them.
+    def invalidate(self):
+        self.normalsValid = False
+        self.openGLArraysValid = False
+        self.extent = None
+
+    # Computes the normals (Edge.flatNormal, Edge.smoothNormal) unless they
+    # are up to date.
+    def ensureNormals(self):
+        if (not self.normalsValid):
+            self.computeNormals()
+
+    # Shades the mesh with the given smooth normals (V x 3, by vertex index)
+    # and its own flat normals, for normals that don't follow from the
+    # faces, such as the Loop limit normals.
+    def setSmoothNormals(self, normals):
+        self.compact()
+        self.invalidate()
+        for f in self.faces:
+            self.computeFaceNormal(f)
+        for e in self.edges:
+            e.smoothNormal = normals[e.vertex.index]
+        self.touchedFaces = set()
+        self.touchedVerts = set()
+        self.normalsValid = True
+
+    # The average of the vertex positions
+    def centroid(self):
+        return self.computeExtent()[0].copy()
+
+    # The lower and upper corners of the bounding box
+    def bounds(self):
+        extent = self.computeExtent()
+        return extent[1].copy(), extent[2].copy()
+
+    def computeExtent(self):
+        if (self.extent is None):
+            positions = self.positions()
+            self.extent = (positions.mean(axis = 0), positions.min(axis = 0), positions.max(axis = 0))
+        return self.extent
+
+    # The smooth pass sums each vertex's face normals over its ring at once;
+    # computeVertexNormal() does the same for one vertex.
+    def computeNormals(self):
+        self.compact()
+        for f in self.faces:
+            self.computeFaceNormal(f)
+        noNormal = zeros((3))
+        flatNormals = array([noNormal if e.face is None else e.flatNormal for e in self.edges])
+        normals = self.ringEdgeSum(flatNormals)
+        lengths = sqrt((normals * normals).sum(axis = 1))
+        normals /= where(lengths > 0, lengths, 1.0)[:, None]
+        for e in self.edges:
+            e.smoothNormal = normals[e.vertex.index]
+        self.touchedFaces = set()
+        self.touchedVerts = set()
+        self.normalsValid = True
 
 
     # Fetch all vertex coordinates and store them in
     # numpy arrays (for OpenGL VBOs)
-    # Note that we are creating triangles so
-    # triangulate() must be called shortly before this.
+    # Polygons are cut into triangle fans here, so each face takes
+    # faceSize(f) - 2 consecutive triangles starting at f.vboIndex.
+    # vboFlatNormals waits for createFlatNormalArray() unless the arrays
+    # are memory mapped, as other processes may open the files.
     def createOpenGLArrays(self):
-        self.vboVertices = empty((3 * 3 * len(self.faces)), dtype = float32)
-        self.vboSmoothNormals = empty((3 * 3 * len(self.faces)), dtype = float32)
-        self.vboFlatNormals = empty((3 * 3 * len(self.faces)), dtype = float32)
-        self.vboTexCoords = empty((3 * 2 * len(self.faces)), dtype = float32)
+        self.ensureNormals()
+        self.compact()
+        self.openGLArraysValid = True
+        self.flatNormalArrayValid = self.vboBasename is not None
+        triangles = 0
+        for f in self.faces:
+            triangles += self.faceSize(f) - 2
+        for i in range(4):
+            if (i == FLAT_NORMALS and not self.flatNormalArrayValid):
+                self.vboFlatNormals = None
+                continue
+            self.newOpenGLArray(i, OPENGL_ARRAY_WIDTHS[i] * triangles)
+        self.freeVboIndices = []
 
         i = 0
-
         for f in self.faces:
-            s = e = f.edge
-            while(True):
-                self.vboVertices[i * 3 : i * 3 + 3] = e.vertex.position
-                self.vboSmoothNormals[i * 3 : i * 3 + 3] = e.smoothNormal
-                self.vboFlatNormals[i * 3 : i * 3 + 3] = e.flatNormal
-                self.vboTexCoords[i * 2 : i * 2 + 2] = e.texCoord
+            f.vboIndex = i
+            i += self.writeOpenGLFace(f)
+        self.changedFaces = set()
+        self.releasedFaces = []
+
+    # Writes the triangle fan of f, from its first corner, at f.vboIndex.
+    # Returns the number of triangles.
+    def writeOpenGLFace(self, f):
+        flat = self.flatNormalArrayValid
+        i = f.vboIndex * 3
+        s = f.edge
+        e = s.nextEdge
+        while(e.nextEdge != s):
+            for c in (s, e, e.nextEdge):
+                self.vboVertices[i * 3 : i * 3 + 3] = c.vertex.position
+                self.vboSmoothNormals[i * 3 : i * 3 + 3] = c.smoothNormal
+                if (flat):
+                    self.vboFlatNormals[i * 3 : i * 3 + 3] = c.flatNormal
+                self.vboTexCoords[i * 2 : i * 2 + 2] = c.texCoord
                 i += 1
+            e = e.nextEdge
+        return i // 3 - f.vboIndex
+
+    # Builds vboFlatNormals to match the other OpenGL arrays. Faces the
+    # local edits have added or changed since are written by
+    # updateOpenGLArrays(), as they are in the other arrays.
+    def createFlatNormalArray(self):
+        self.flatNormalArrayValid = True
+        self.newOpenGLArray(FLAT_NORMALS, len(self.vboVertices))
+        flatNormals = self.vboFlatNormals
+        flatNormals[:] = 0
+        for f in self.faces:
+            if (f.removed or f.vboIndex < 0):
+                continue
+            i = f.vboIndex * 3
+            s = f.edge
+            e = s.nextEdge
+            while(e.nextEdge != s):
+                for c in (s, e, e.nextEdge):
+                    flatNormals[i * 3 : i * 3 + 3] = c.flatNormal
+                    i += 1
+                e = e.nextEdge
+
+    # Recomputes the normals the local edits since the last call have made
+    # stale: the flat normals of the touched faces and the smooth normals
+    # of their vertices. Every face using one of those vertices then needs
+    # its OpenGL arrays rewritten.
+    def updateNormals(self):
+        if (not self.normalsValid):
+            self.computeNormals()
+            return
+        verts = set(self.touchedVerts)
+        for f in self.touchedFaces:
+            if (f.removed):
+                continue
+            self.computeFaceNormal(f)
+            e = s = f.edge
+            while True:
+                verts.add(e.vertex)
                 e = e.nextEdge
                 if (e == s):
                     break
+        for v in verts:
+            if (v.removed):
+                continue
+            self.computeVertexNormal(v)
+            e = s = v.eminatingEdge
+            while True:
+                if (e.face is not None):
+                    self.changedFaces.add(e.face)
+                e = e.symmetricEdge.nextEdge
+                if (e == s):
+                    break
+        self.touchedFaces = set()
+        self.touchedVerts = set()
+
+    # Brings the OpenGL arrays up to date after updateNormals(). Faces
+    # removed by an edit leave a degenerate triangle behind, and new faces
+    # take those places first. Returns the ranges of the arrays that
+    # changed, as (first triangle, triangle count) pairs for
+    # glBufferSubData(), or None if the arrays had to grow or be built
+    # again and are new.
+    def updateOpenGLArrays(self):
+        if (not self.openGLArraysValid):
+            self.createOpenGLArrays()
+            return None
+        for f in self.releasedFaces:
+            i = f.vboIndex
+            self.vboVertices[i * 9 : i * 9 + 9] = 0
+            self.vboSmoothNormals[i * 9 : i * 9 + 9] = 0
+            if (self.flatNormalArrayValid):
+                self.vboFlatNormals[i * 9 : i * 9 + 9] = 0
+            self.vboTexCoords[i * 6 : i * 6 + 6] = 0
+            self.freeVboIndices.append(i)
+        indices = [f.vboIndex for f in self.releasedFaces]
+
+        grown = False
+        for f in self.changedFaces:
+            if (f.vboIndex < 0):
+                if (not self.freeVboIndices):
+                    self.growOpenGLArrays()
+                    grown = True
+                f.vboIndex = self.freeVboIndices.pop()
+            count = self.writeOpenGLFace(f)
+            indices.extend(range(f.vboIndex, f.vboIndex + count))
+        self.changedFaces = set()
+        self.releasedFaces = []
+        if (grown):
+            return None
+
+        ranges = []
+        for i in sorted(set(indices)):
+            if (ranges and ranges[-1][0] + ranges[-1][1] == i):
+                ranges[-1][1] += 1
+            else:
+                ranges.append([i, 1])
+        return [(first, count) for first, count in ranges]
+
+    # Makes room for half as many triangles again
+    def growOpenGLArrays(self):
+        count = len(self.vboVertices) // 9
+        extra = count // 2 + 1
+        for i in range(4):
+            if (i == FLAT_NORMALS and not self.flatNormalArrayValid):
+                continue
+            name = OPENGL_ARRAY_NAMES[i]
+            old = getattr(self, name)
+            if (self.vboBasename is None):
+                setattr(self, name, concatenate([old, zeros(extra * OPENGL_ARRAY_WIDTHS[i], dtype = float32)]))
+                continue
+            # Files grow in place, with zeros
+            old.flush()
+            size = len(old) + extra * OPENGL_ARRAY_WIDTHS[i]
+            setattr(self, name, None)
+            del old
+            filename = self.vboBasename + OPENGL_FILE_SUFFIXES[i]
+            with open(filename, 'r+b') as f:
+                f.truncate(size * 4)
+            setattr(self, name, memmap(filename, dtype = float32, mode = 'r+', shape = (size,)))
+        self.freeVboIndices.extend(range(count + extra - 1, count - 1, -1))
+
+    # Sets OpenGL array i (in OPENGL_ARRAY_NAMES order) to a new array of
+    # size floats, in memory or in its file.
+    def newOpenGLArray(self, i, size):
+        name = OPENGL_ARRAY_NAMES[i]
+        if (self.vboBasename is None):
+            setattr(self, name, empty((size), dtype = float32))
+            return
+        # Drop the old mapping before its file is truncated under it. An
+        # empty file can't be mapped, so an empty array maps one float.
+        setattr(self, name, None)
+        array = memmap(self.vboBasename + OPENGL_FILE_SUFFIXES[i], dtype = float32,
+                       mode = 'w+', shape = (size if size > 0 else 1,))
+        setattr(self, name, array if size > 0 else array[:0])
+
+    # A deep copy with memory-mapped OpenGL arrays gets in-memory copies of
+    # them. Sharing the original's files would let the copy rewrite them,
+    # for example when it is subdivided.
+    def __deepcopy__(self, memo):
+        result = Mesh.__new__(Mesh)
+        memo[id(self)] = result
+        for key, value in self.__dict__.items():
+            if (self.vboBasename is not None and key in OPENGL_ARRAY_NAMES and value is not None):
+                result.__dict__[key] = array(value)
+            else:
+                result.__dict__[key] = copy.deepcopy(value, memo)
+        result.vboBasename = None
+        return result
+
+    # Moves the OpenGL arrays into memory-mapped files, basename plus each
+    # of OPENGL_FILE_SUFFIXES, which they stay in from now on (subdividing
+    # rewrites them there). Without a basename the files go into a new
+    # scratch directory. The OS pages the arrays, glBufferData() takes them
+    # as they are, and loadOpenGLArrays() opens them again later. Returns
+    # the basename. A deep copy of the mesh has its arrays in memory (see
+    # __deepcopy__()); map it to files of its own if it should have them.
+    def mapOpenGLArrays(self, basename = None):
+        if (basename is None):
+            basename = os.path.join(tempfile.mkdtemp(prefix = 'MeshViewer'), 'mesh')
+        self.vboBasename = basename
+        self.createOpenGLArrays()
+        for name in OPENGL_ARRAY_NAMES:
+            getattr(self, name).flush()
+        return basename
+
+    # Compact versions of the OpenGL arrays, a little under half their size:
+    #   vboCompactVertices: int16 positions relative to the bounding box,
+    #       decoded as position = q * compactPositionScale + compactPositionOffset.
+    #       The scale is the same on all axes, so the decoding is a similarity
+    #       transform and doesn't bend normals. Each vertex is padded to four
+    #       shorts, the last one being 1, to keep it 4-byte aligned and to
+    #       let the fixed-function pipeline decode it with a matrix.
+    #   vboCompactSmoothNormals, vboCompactFlatNormals: one
+    #       GL_INT_2_10_10_10_REV word per normal. Without flatNormals
+    #       (for the GLSL path) there are no flat normals, packed or not.
+    #   vboCompactTexCoords: half floats.
+    # A Mesh builds its OpenGL arrays first if need be. Returns a report of
+    # the sizes and of the largest error each encoding introduces.
+    def createCompactOpenGLArrays(self, flatNormals = True):
+        positions = self.vboVertices.reshape(-1, 3).astype(float64)
+        lower = positions.min(axis=0)
+        upper = positions.max(axis=0)
+        halfExtent = (upper - lower).max() / 2.0
+        if halfExtent == 0:
+            halfExtent = 1.0
+        self.compactPositionOffset = (upper + lower) / 2.0
+        self.compactPositionScale = halfExtent / 32767.0
+
+        q = rint((positions - self.compactPositionOffset) / self.compactPositionScale)
+        self.vboCompactVertices = empty((len(positions), 4), dtype = int16)
+        self.vboCompactVertices[:,:3] = q
+        self.vboCompactVertices[:,3] = 1
+        self.vboCompactVertices = self.vboCompactVertices.reshape(-1)
+
+        smoothNormals = self.vboSmoothNormals.reshape(-1, 3)
+        self.vboCompactSmoothNormals = packNormals(smoothNormals)
+        normalArrays = [(smoothNormals, self.vboCompactSmoothNormals)]
+        floatArrays = [self.vboVertices, self.vboSmoothNormals, self.vboTexCoords]
+        self.vboCompactFlatNormals = None
+        if flatNormals:
+            normals = self.vboFlatNormals.reshape(-1, 3)
+            self.vboCompactFlatNormals = packNormals(normals)
+            normalArrays.append((normals, self.vboCompactFlatNormals))
+            floatArrays.append(self.vboFlatNormals)
+        self.vboCompactTexCoords = self.vboTexCoords.astype(float16)
+
+        decoded = q * self.compactPositionScale + self.compactPositionOffset
+        normalError = 0.0
+        for normals, packed in normalArrays:
+            unpacked = unpackNormals(packed)
+            lengths = linalg.norm(normals, axis=1) * linalg.norm(unpacked, axis=1)
+            valid = lengths > 0
+            cosines = (normals * unpacked).sum(axis=1)[valid] / lengths[valid]
+            if len(cosines):
+                normalError = fmax(normalError, degrees(arccos(clip(cosines, -1, 1)).max()))
+
+        return {
+            'bytes': sum(a.nbytes for a in floatArrays),
+            'compactBytes': sum(packed.nbytes for normals, packed in normalArrays) +
+                            self.vboCompactVertices.nbytes + self.vboCompactTexCoords.nbytes,
+            'positionError': linalg.norm(decoded - positions, axis=1).max(),
+            'normalErrorDegrees': normalError,
+            'texCoordError': abs(self.vboCompactTexCoords.astype(float64) - self.vboTexCoords).max(),
+        }
+
+
+# A Mesh's OpenGL arrays are built when one of them is first read after
+# invalidate(), and vboFlatNormals when it is first read itself.
+def openGLArrayProperty(name):
+    def get(self):
+        if (not self.openGLArraysValid):
+            self.createOpenGLArrays()
+        if (name == 'vboFlatNormals' and not self.flatNormalArrayValid):
+            self.createFlatNormalArray()
+        return self.__dict__[name]
+    def set(self, value):
+        self.__dict__[name] = value
+    return property(get, set)
+
+for name in OPENGL_ARRAY_NAMES:
+    setattr(Mesh, name, openGLArrayProperty(name))
+
+
+# OpenGL arrays without the mesh they came from, as loadOpenGLArrays()
+# opens them: enough to draw, and to make the compact arrays from.
+class OpenGLArrays:
+    verts = []
+
+    createCompactOpenGLArrays = Mesh.createCompactOpenGLArrays
+
+# Opens the OpenGL arrays saved by Mesh.mapOpenGLArrays() or
+# StreamSubdivide.writeOpenGLFiles() as read-only memory maps.
+def loadOpenGLArrays(basename):
+    arrays = OpenGLArrays()
+    for name, suffix in zip(OPENGL_ARRAY_NAMES, OPENGL_FILE_SUFFIXES):
+        filename = basename + suffix
+        if (os.path.getsize(filename) < 4 * OPENGL_ARRAY_WIDTHS[OPENGL_ARRAY_NAMES.index(name)]):
+            setattr(arrays, name, zeros((0), dtype = float32))
+        else:
+            setattr(arrays, name, memmap(filename, dtype = float32, mode = 'r'))
+    return arrays
@@ -0,0 +1,502 @@
+# MeshArrays.py
+# Created by: Jason Sikes
+#
+# Vectorized operations on plain vertex/face arrays, for use before the
+# data is turned into a half-edge Mesh. Mesh assumes a clean, closed,
+# consistently wound manifold; repairMesh() turns raw scanned triangle
+# data into something that satisfies those assumptions. There is also an
+# array version of butterfly subdivision for meshes too large for Mesh.
+#
+# Conventions: verts is an N x 3 array, faces an F x 3 array of vertex
+# indices (triangles only) and texCoords, when given, an F x 3 x 2 array
+# of per-corner texture coordinates like Mesh takes. Half-edge h = 3*f + i
+# runs from faces[f, i] to faces[f, (i+1) % 3]; corner h is the corner of
+# face f at faces[f, i].
+
+import numpy as np
+
+
+# Origins and destinations of all half-edges.
+def halfEdges(faces):
+    return faces.reshape(-1), np.roll(faces, -1, axis=1).reshape(-1)
+
+# One integer per undirected edge, equal for both of its half-edges.
+def edgeKeys(origin, destination, vertexCount):
+    return np.minimum(origin, destination) * vertexCount + np.maximum(origin, destination)
+
+# Returns the half-edges sorted by edge key, the sorted keys, and for every
+# position in that order how many half-edges of the same edge come before it.
+def sortedEdgeGroups(faces, vertexCount):
+    origin, destination = halfEdges(faces)
+    keys = edgeKeys(origin, destination, vertexCount)
+    order = np.argsort(keys, kind='stable')
+    sortedKeys = keys[order]
+    positions = np.arange(len(keys))
+    groupStart = np.ones(len(keys), dtype=bool)
+    groupStart[1:] = sortedKeys[1:] != sortedKeys[:-1]
+    rank = positions - np.maximum.accumulate(np.where(groupStart, positions, 0))
+    return order, sortedKeys, rank
+
+# For every half-edge, the other half-edge on the same edge, or -1 on the
+# boundary. Only valid when no edge has more than two faces. The two may
+# point the same way if the winding is inconsistent.
+def halfEdgeMates(faces, vertexCount):
+    order, sortedKeys, rank = sortedEdgeGroups(faces, vertexCount)
+    mate = np.full(len(order), -1, dtype=np.int64)
+    paired = np.nonzero(sortedKeys[1:] == sortedKeys[:-1])[0]
+    mate[order[paired]] = order[paired + 1]
+    mate[order[paired + 1]] = order[paired]
+    return mate
+
+# Labels each element of a set of cycles, given as a successor array, with
+# the smallest index on its cycle. Uses pointer jumping, so it takes
+# log2(longest cycle) passes.
+def cycleLabels(successor):
+    label = np.arange(len(successor))
+    jump = successor.copy()
+    span = 1
+    while span < len(successor):
+        label = np.minimum(label, label[jump])
+        jump = jump[jump]
+        span *= 2
+    return label
+
+# Labels each of count elements with the smallest element in its connected
+# component, given the links between them as two index arrays. Every pass
+# hooks the labels at the ends of each still-split link to the smaller one
+# and then jumps pointers until every label is its own label, so a pass
+# at least halves the number of labels in a component.
+def componentLabels(count, a, b):
+    label = np.arange(count)
+    while True:
+        la = label[a]
+        lb = label[b]
+        split = la != lb
+        if (not split.any()):
+            return label
+        np.minimum.at(label, np.maximum(la, lb)[split], np.minimum(la, lb)[split])
+        while True:
+            jumped = label[label]
+            if (np.array_equal(jumped, label)):
+                break
+            label = jumped
+
+# Returns the indices into a CSR array for all entries of the given rows.
+def csrEntries(offsets, rows):
+    starts = offsets[rows]
+    counts = offsets[rows + 1] - starts
+    firsts = np.cumsum(counts) - counts
+    return np.repeat(starts - firsts, counts) + np.arange(counts.sum()), counts
+
+
+def degenerateFaces(verts, faces):
+    repeated = ((faces[:,0] == faces[:,1]) | (faces[:,1] == faces[:,2]) |
+                (faces[:,0] == faces[:,2]))
+    p = verts[faces]
+    area = np.linalg.norm(np.cross(p[:,1] - p[:,0], p[:,2] - p[:,0]), axis=1)
+    return repeated | (area == 0)
+
+# Faces that use the same three vertices as an earlier face, whatever the
+# order or winding.
+def duplicateFaces(faces):
+    unique, first = np.unique(np.sort(faces, axis=1), axis=0, return_index=True)
+    duplicate = np.ones(len(faces), dtype=bool)
+    duplicate[first] = False
+    return duplicate
+
+# Faces that make an edge non-manifold: on every edge with more than two
+# faces, all faces after the first two.
+def nonManifoldFaces(faces, vertexCount):
+    order, sortedKeys, rank = sortedEdgeGroups(faces, vertexCount)
+    rankOfHalfEdge = np.empty(len(order), dtype=np.int64)
+    rankOfHalfEdge[order] = rank
+    return (rankOfHalfEdge.reshape(-1, 3) >= 2).any(axis=1)
+
+# Returns verts and faces without the vertices no face uses.
+def removeUnreferencedVertices(verts, faces):
+    used, inverse = np.unique(faces, return_inverse=True)
+    return verts[used], inverse.reshape(-1, 3), len(verts) - len(used)
+
+
+# Returns, for every face, whether it has to be reversed to agree with its
+# neighbors, the connected component it belongs to, and the number of
+# edges whose faces still disagree (only nonzero for non-orientable
+# surfaces). Faces are visited breadth first from one face per component,
+# and each component then keeps the orientation most of its faces had.
+def orientFaces(faces, vertexCount):
+    origin, destination = halfEdges(faces)
+    mate = halfEdgeMates(faces, vertexCount)
+    h = np.nonzero(mate > np.arange(len(mate)))[0]
+    first = h // 3
+    second = mate[h] // 3
+    sameDirection = (origin[h] == origin[mate[h]]).astype(np.int8)
+
+    # Face adjacency in CSR form, with the parity of each connection.
+    source = np.concatenate([first, second])
+    target = np.concatenate([second, first])
+    parity = np.concatenate([sameDirection, sameDirection])
+    order = np.argsort(source, kind='stable')
+    target = target[order]
+    parity = parity[order]
+    offsets = np.zeros(len(faces) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(source, minlength=len(faces)), out=offsets[1:])
+
+    # Each component is labelled with its smallest face, and the breadth
+    # first search runs from all of those roots at once.
+    component = componentLabels(len(faces), first, second)
+
+    flip = np.full(len(faces), -1, dtype=np.int8)
+    frontier = np.nonzero(component == np.arange(len(faces)))[0]
+    flip[frontier] = 0
+    while len(frontier):
+        entries, counts = csrEntries(offsets, frontier)
+        neighbors = target[entries]
+        neighborFlip = np.repeat(flip[frontier], counts) ^ parity[entries]
+        new = flip[neighbors] < 0
+        neighbors, firstSeen = np.unique(neighbors[new], return_index=True)
+        flip[neighbors] = neighborFlip[new][firstSeen]
+        frontier = neighbors
+
+    flipped = np.bincount(component, weights=flip, minlength=len(faces))
+    size = np.bincount(component, minlength=len(faces))
+    flip ^= (2 * flipped > size)[component].astype(np.int8)
+
+    conflicts = np.count_nonzero((flip[first] ^ flip[second]) != sameDirection)
+    return flip.astype(bool), component, int(conflicts)
+
+# Reverses faces (and their texture coordinates) where reverse is set.
+def reverseFaces(faces, texCoords, reverse):
+    faces = faces.copy()
+    faces[reverse] = faces[reverse][:, ::-1]
+    if texCoords is not None:
+        texCoords = texCoords.copy()
+        texCoords[reverse] = texCoords[reverse][:, ::-1]
+    return faces, texCoords
+
+# Signed volume enclosed by each component's faces. Positive when the
+# faces wind counterclockwise seen from outside.
+def componentVolumes(verts, faces, component):
+    p = verts[faces]
+    volumes = np.einsum('ij,ij->i', p[:,0], np.cross(p[:,1], p[:,2])) / 6.0
+    return np.bincount(component, weights=volumes, minlength=len(faces))
+
+
+# Gives every fan of faces around a vertex its own vertex. A vertex whose
+# faces form more than one fan ("bowtie") can't be represented with
+# half-edges. Returns the new verts and faces and the number of vertices
+# added.
+def splitNonManifoldVertices(verts, faces):
+    origin, destination = halfEdges(faces)
+    mate = halfEdgeMates(faces, len(verts))
+    corners = np.nonzero(mate >= 0)[0]
+    m = mate[corners]
+    # The corner at the same vertex on the far side of each edge.
+    otherCorner = np.where(origin[m] == origin[corners], m, 3 * (m // 3) + (m % 3 + 1) % 3)
+
+    label = componentLabels(len(origin), corners, otherCorner)
+
+    fans, inverse = np.unique(label, return_inverse=True)
+    fanVertex = origin[fans]
+    order = np.argsort(fanVertex, kind='stable')
+    firstFan = np.ones(len(order), dtype=bool)
+    firstFan[1:] = fanVertex[order][1:] != fanVertex[order][:-1]
+    extra = order[~firstFan]
+    newIndex = fanVertex.copy()
+    newIndex[extra] = len(verts) + np.arange(len(extra))
+    verts = np.concatenate([verts, verts[fanVertex[extra]]])
+    return verts, newIndex[inverse].reshape(-1, 3), len(extra)
+
+# Closes every hole with a fan of triangles around a new vertex at the
+# hole's centroid. Returns the new verts, faces and texCoords and the
+# number of holes filled.
+def fillHoles(verts, faces, texCoords):
+    origin, destination = halfEdges(faces)
+    mate = halfEdgeMates(faces, len(verts))
+    boundary = np.nonzero(mate < 0)[0]
+    if len(boundary) == 0:
+        return verts, faces, texCoords, 0
+
+    # Hole edges run opposite to the boundary half-edges. After
+    # splitNonManifoldVertices every boundary vertex starts exactly one.
+    holeOrigin = destination[boundary]
+    holeDestination = origin[boundary]
+    byOrigin = np.argsort(holeOrigin)
+    successor = byOrigin[np.searchsorted(holeOrigin[byOrigin], holeDestination)]
+    holes, hole = np.unique(cycleLabels(successor), return_inverse=True)
+
+    counts = np.bincount(hole)
+    centers = np.stack([np.bincount(hole, weights=verts[holeOrigin, axis]) for axis in range(3)],
+                       axis=1) / counts[:, None]
+    centerIndex = len(verts) + hole
+    verts = np.concatenate([verts, centers.astype(verts.dtype)])
+    faces = np.concatenate([faces, np.stack([holeOrigin, holeDestination, centerIndex], axis=1)])
+
+    if texCoords is not None:
+        corners = texCoords.reshape(-1, 2)
+        face = boundary // 3
+        atOrigin = corners[3 * face + (boundary % 3 + 1) % 3]
+        atDestination = corners[boundary]
+        centerCoords = np.stack([np.bincount(hole, weights=atOrigin[:, axis]) for axis in range(2)],
+                                axis=1) / counts[:, None]
+        newCoords = np.stack([atOrigin, atDestination, centerCoords[hole]], axis=1)
+        texCoords = np.concatenate([texCoords, newCoords.astype(texCoords.dtype)])
+    return verts, faces, texCoords, len(holes)
+
+
+# Sorts points by the grid cube they are in, given their integer cube
+# coordinates (an N x 3 array). Returns the sort order and the position in
+# it where each occupied cube starts. Large grids are sorted by a hash of
+# the coordinates; a hash collision can only split a cube, never join two.
+def cubeGroups(cubes):
+    cubes = cubes - cubes.min(axis=0)
+    extent = cubes.max(axis=0) + 1
+    if np.prod(extent.astype(np.float64)) < 2.0**62:
+        keys = (cubes[:,0] * extent[1] + cubes[:,1]) * extent[2] + cubes[:,2]
+    else:
+        c = cubes.astype(np.uint64)
+        keys = ((c[:,0] * np.uint64(73856093)) ^ (c[:,1] * np.uint64(19349663)) ^
+                (c[:,2] * np.uint64(83492791)))
+    order = np.argsort(keys)
+    sortedCubes = cubes[order]
+    changed = (sortedCubes[1:] != sortedCubes[:-1]).any(axis=1)
+    return order, np.concatenate([[0], np.nonzero(changed)[0] + 1])
+
+# Merges vertices that lie within tolerance of each other, as in triangle
+# soups where every face has its own copy of each corner. Positions are
+# hashed into cubes of side tolerance on eight grids, offset from each
+# other by half a cube along each axis, so two vertices less than
+# tolerance/2 apart on every axis always share a cube on at least one
+# grid. Vertices sharing a cube are merged into the one with the lowest
+# index, which stands in for all of them on the following grids.
+# tolerance defaults to a millionth of the bounding box diagonal. Returns
+# the welded verts and faces and the number of vertices removed. Faces
+# that collapse are left for repairMesh().
+def weldVertices(verts, faces, tolerance=None):
+    verts = np.asarray(verts, dtype=np.float64)
+    faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)
+    if tolerance is None:
+        tolerance = 1.0e-6 * np.linalg.norm(verts.max(axis=0) - verts.min(axis=0))
+    if len(verts) == 0 or tolerance <= 0:
+        return verts, faces, 0
+
+    # Only the surviving vertices are hashed on each grid, so the later
+    # grids are much cheaper than the first one. Cycling through the grids
+    # stops once eight passes in a row have merged nothing.
+    scaled = (verts - verts.min(axis=0)) / tolerance
+    label = np.arange(len(verts))
+    survivors = label
+    shift = 0
+    quietPasses = 0
+    while quietPasses < 8:
+        offset = np.array([shift & 1, (shift >> 1) & 1, (shift >> 2) & 1]) * 0.5
+        order, starts = cubeGroups(np.floor(scaled[survivors] + offset).astype(np.int64))
+        if len(starts) == len(survivors):
+            quietPasses += 1
+        else:
+            quietPasses = 1
+            smallest = np.minimum.reduceat(survivors[order], starts)
+            merged = np.arange(len(verts))
+            merged[survivors[order]] = np.repeat(smallest, np.diff(np.append(starts, len(order))))
+            label = merged[label]
+            survivors = np.nonzero(label == np.arange(len(verts)))[0]
+        shift = (shift + 1) % 8
+
+    newIndex = np.zeros(len(verts), dtype=np.int64)
+    newIndex[survivors] = np.arange(len(survivors))
+    return verts[survivors], newIndex[label[faces]], len(verts) - len(survivors)
+
+
+# Finds and fixes the defects that keep raw triangle data from becoming a
+# Mesh: degenerate and duplicate faces, edges with more than two faces,
+# unreferenced vertices, bowtie vertices, inconsistent winding and holes.
+# Closed components are also turned to face outwards. Returns the
+# repaired verts, faces and texCoords (None if none were given) and a
+# report with the number of defects of each kind. Triangle soups need a
+# weldTolerance (see weldVertices()) to be welded first.
+def repairMesh(verts, faces, texCoords=None, closeHoles=True, weldTolerance=None):
+    verts = np.asarray(verts, dtype=np.float64)
+    faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)
+    if texCoords is not None:
+        texCoords = np.asarray(texCoords)
+    report = {}
+
+    report['weldedVertices'] = 0
+    if weldTolerance is not None:
+        verts, faces, report['weldedVertices'] = weldVertices(verts, faces, weldTolerance)
+
+    def keep(mask):
+        if texCoords is None:
+            return faces[mask], None
+        return faces[mask], texCoords[mask]
+
+    remove = degenerateFaces(verts, faces)
+    report['degenerateFaces'] = int(remove.sum())
+    faces, texCoords = keep(~remove)
+
+    remove = duplicateFaces(faces)
+    report['duplicateFaces'] = int(remove.sum())
+    faces, texCoords = keep(~remove)
+
+    remove = nonManifoldFaces(faces, len(verts))
+    report['nonManifoldFaces'] = int(remove.sum())
+    faces, texCoords = keep(~remove)
+
+    verts, faces, report['unreferencedVertices'] = removeUnreferencedVertices(verts, faces)
+
+    reverse, component, report['nonOrientableEdges'] = orientFaces(faces, len(verts))
+    faces, texCoords = reverseFaces(faces, texCoords, reverse)
+    flipped = reverse
+
+    reverse = insideOutFaces(verts, faces, component)
+    faces, texCoords = reverseFaces(faces, texCoords, reverse)
+    report['flippedFaces'] = int((flipped ^ reverse).sum())
+
+    verts, faces, report['splitVertices'] = splitNonManifoldVertices(verts, faces)
+
+    report['holes'] = 0
+    if closeHoles:
+        verts, faces, texCoords, report['holes'] = fillHoles(verts, faces, texCoords)
+
+    return verts, faces, texCoords, report
+
+# Faces of closed components with a negative volume, which are inside out.
+def insideOutFaces(verts, faces, component):
+    openComponents = np.unique(component[np.nonzero(halfEdgeMates(faces, len(verts)) < 0)[0] // 3])
+    inverted = componentVolumes(verts, faces, component) < 0
+    inverted[openComponents] = False
+    return inverted[component]
+
+# Counts the defects repairMesh() would fix, with the same report keys,
+# but only runs the passes that find them. Boundaries are not defects, as
+# Mesh supports open surfaces, so there is no hole count: an input is
+# valid when every count is zero.
+def validateMesh(verts, faces):
+    verts = np.asarray(verts, dtype=np.float64)
+    faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)
+    report = {'weldedVertices': 0}
+
+    remove = degenerateFaces(verts, faces)
+    report['degenerateFaces'] = int(remove.sum())
+    faces = faces[~remove]
+
+    remove = duplicateFaces(faces)
+    report['duplicateFaces'] = int(remove.sum())
+    faces = faces[~remove]
+
+    remove = nonManifoldFaces(faces, len(verts))
+    report['nonManifoldFaces'] = int(remove.sum())
+    faces = faces[~remove]
+
+    report['unreferencedVertices'] = len(verts) - len(np.unique(faces))
+
+    reverse, component, report['nonOrientableEdges'] = orientFaces(faces, len(verts))
+    faces = reverseFaces(faces, None, reverse)[0]
+    report['flippedFaces'] = int((reverse ^ insideOutFaces(verts, faces, component)).sum())
+
+    report['splitVertices'] = splitNonManifoldVertices(verts, faces)[2]
+    return report
+
+# Numbers the undirected edges from 0 in edge key order. Returns the edge
+# of every half-edge and the number of edges.
+def edgeIndices(faces, vertexCount):
+    order, sortedKeys, rank = sortedEdgeGroups(faces, vertexCount)
+    edge = np.empty(len(order), dtype=np.int64)
+    edge[order] = np.cumsum(rank == 0) - 1
+    return edge, int(np.count_nonzero(rank == 0))
+
+def nextHalfEdge(h):
+    return h - h % 3 + (h + 1) % 3
+
+def previousHalfEdge(h):
+    return h - h % 3 + (h + 2) % 3
+
+# Butterfly subdivision positions for the edges of the half-edges h, with
+# the same rules as Mesh.butterflyVertex(): the eight-point stencil, the
+# Loop mask where that stencil runs into a boundary, and the four-point
+# rule on boundary edges. h holds one half-edge per edge.
+def butterflyEdgeVertices(verts, faces, mate, h):
+    corner = faces.reshape(-1)
+    b = mate[h]
+    p1 = verts[corner[h]]
+    p2 = verts[corner[nextHalfEdge(h)]]
+    positions = np.empty((len(h), 3), dtype=verts.dtype)
+
+    # Four-point rule along the boundary. Every boundary vertex starts and
+    # ends exactly one boundary half-edge.
+    boundary = b < 0
+    boundaryHalfEdges = np.nonzero(mate < 0)[0]
+    startingAt = np.full(len(verts), -1, dtype=np.int64)
+    startingAt[corner[boundaryHalfEdges]] = boundaryHalfEdges
+    endingAt = np.full(len(verts), -1, dtype=np.int64)
+    endingAt[corner[nextHalfEdge(boundaryHalfEdges)]] = boundaryHalfEdges
+    hb = h[boundary]
+    beyondP1 = corner[endingAt[corner[hb]]]
+    beyondP2 = corner[nextHalfEdge(startingAt[corner[nextHalfEdge(hb)]])]
+    positions[boundary] = (9.0 * (p1[boundary] + p2[boundary]) -
+                           (verts[beyondP2] + verts[beyondP1])) / 16.0
+
+    interior = ~boundary
+    hi = h[interior]
+    bi = b[interior]
+    p1 = p1[interior]
+    p2 = p2[interior]
+    p3 = verts[corner[previousHalfEdge(hi)]]
+    p4 = verts[corner[previousHalfEdge(bi)]]
+    wings = np.stack([mate[nextHalfEdge(bi)], mate[previousHalfEdge(bi)],
+                      mate[nextHalfEdge(hi)], mate[previousHalfEdge(hi)]])
+    complete = (wings >= 0).all(axis=0)
+    interiorPositions = (3.0 * (p1 + p2) + (p3 + p4)) / 8.0
+
+    w = wings[:, complete]
+    q = verts[corner[previousHalfEdge(w)]]
+    interiorPositions[complete] = (8.0 * (p1[complete] + p2[complete]) +
+                                   2.0 * (p3[complete] + p4[complete]) -
+                                   (q[0] + q[1] + q[2] + q[3])) / 16.0
+    positions[interior] = interiorPositions
+    return positions
+
+# Splits every triangle into four, given the index of each half-edge's edge
+# and the index the first new (edge) vertex gets. Texture coordinates of
+# the new corners are the midpoints of the old ones.
+def splitFaces(faces, texCoords, edge, firstEdgeVertex):
+    m = firstEdgeVertex + edge.reshape(-1, 3)
+    a, b, c = faces[:,0], faces[:,1], faces[:,2]
+    newFaces = np.stack([np.stack([a, m[:,0], m[:,2]], axis=1),
+                         np.stack([b, m[:,1], m[:,0]], axis=1),
+                         np.stack([c, m[:,2], m[:,1]], axis=1),
+                         m], axis=1).reshape(-1, 3)
+    if texCoords is None:
+        return newFaces, None
+    t = texCoords
+    mid = (t + np.roll(t, -1, axis=1)) / 2.0
+    newCoords = np.stack([np.stack([t[:,0], mid[:,0], mid[:,2]], axis=1),
+                          np.stack([t[:,1], mid[:,1], mid[:,0]], axis=1),
+                          np.stack([t[:,2], mid[:,2], mid[:,1]], axis=1),
+                          mid], axis=1).reshape(-1, 3, 2)
+    return newFaces, newCoords.astype(texCoords.dtype)
+
+# The half-edges that stand for their edge: the lower-numbered vertex's
+# half-edge on interior edges, the only half-edge on boundary edges.
+# globalVertex maps the vertices of faces to the numbering that decides.
+def canonicalHalfEdges(faces, mate, globalVertex=None):
+    origin, destination = halfEdges(faces)
+    if globalVertex is not None:
+        origin = globalVertex[origin]
+        destination = globalVertex[destination]
+    return (mate < 0) | (origin < destination)
+
+# One level of butterfly subdivision on arrays. Gives the same positions as
+# Mesh.butterflySubdivide(); the vertices of the input keep their indices
+# and edge vertices follow in edgeIndices() order.
+def butterflySubdivideArrays(verts, faces, texCoords=None):
+    verts = np.asarray(verts, dtype=np.float64)
+    faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)
+    edge, edgeCount = edgeIndices(faces, len(verts))
+    mate = halfEdgeMates(faces, len(verts))
+    h = np.nonzero(canonicalHalfEdges(faces, mate))[0]
+    newVerts = np.empty((len(verts) + edgeCount, 3))
+    newVerts[:len(verts)] = verts
+    newVerts[len(verts) + edge[h]] = butterflyEdgeVertices(verts, faces, mate, h)
+    newFaces, newCoords = splitFaces(faces, texCoords, edge, len(verts))
+    return newVerts, newFaces, newCoords
+
@@ -0,0 +1,336 @@
+#! /usr/bin/env python3
+#
+# MeshService.py
+# Created by: Jason Sikes
+#
+
+import io
+import sys
+import json
+import argparse
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+
+HELP_TEXT = """
+Serves subdivided meshes over HTTP on localhost, so that the viewer, batch
+scripts and notebooks share one set of results instead of each
+subdividing the same meshes again. GET /mesh?mesh=X&scheme=Y&level=N
+returns level N of mesh X under scheme Y as an .npz file (see
+meshArrays()), with the mesh's content hash (Mesh.contentHash()) as its
+ETag, so that clients can revalidate with If-None-Match; GET /stats
+returns the cache and request counters as JSON.
+Subdivision runs on a pool of worker processes. Identical requests that
+arrive while one is being computed wait for that one, and results are
+kept in an LRU cache of limited size. ViewMesh.py fetches its meshes from
+the service when the MESH_SERVICE environment variable holds its URL, for
+example http://127.0.0.1:8642.
+"""
+
+DEFAULT_PORT = 8642
+CACHE_BYTES = 512 << 20
+MAX_LEVEL = 6
+
+
+# Base meshes, built in the worker processes when first needed. The bunny
+# has the texture coordinates ViewMesh gives it.
+def bunnyMesh():
+    from Bunny import Bunny
+    from Mesh import Mesh, calculateTextureCoordinates
+    return Mesh(Bunny.bunnyVertices, Bunny.bunnyIndices,
+                calculateTextureCoordinates(Bunny.bunnyVertices, Bunny.bunnyIndices))
+
+def tetrahedronMesh():
+    from Mesh import Mesh
+    return Mesh.Tetrahedron(1)
+
+def cubeMesh():
+    from Mesh import Mesh
+    return Mesh.Cube(1)
+
+def quadCubeMesh():
+    from Mesh import Mesh
+    return Mesh.Cube(1, triangulate=False)
+
+MESHES = {
+    'bunny': bunnyMesh,
+    'tetrahedron': tetrahedronMesh,
+    'cube': cubeMesh,
+    'quadcube': quadCubeMesh,
+}
+
+# Each level of a scheme is a copy of the level before, subdivided once.
+# 'looplimit' is the exception: its level N is the Loop subdivided control
+# mesh of level N projected onto the limit surface, as ViewMesh's Loop
+# Limit Bunny does it.
+SCHEMES = ('butterfly', 'loop', 'catmullclark', 'looplimit')
+SUBDIVIDE = {
+    'butterfly': 'butterflySubdivide',
+    'loop': 'loopSubdivide',
+    'catmullclark': 'catmullClarkSubdivide',
+}
+
+
+# Raises ValueError if mesh, scheme and level don't make a request.
+def checkRequest(mesh, scheme, level):
+    if (mesh not in MESHES):
+        raise ValueError("Unknown mesh %r; known are %s" % (mesh, ', '.join(sorted(MESHES))))
+    if (scheme not in SCHEMES):
+        raise ValueError("Unknown scheme %r; known are %s" % (scheme, ', '.join(SCHEMES)))
+    if (not 0 <= level <= MAX_LEVEL):
+        raise ValueError("level must be 0 to %i" % MAX_LEVEL)
+
+
+# The arrays that describe a Mesh: positions (V x 3), faceSizes (F),
+# indices (the vertices of each face in turn), texCoords (one pair per
+# entry of indices) and the smooth normals (V x 3), which don't always
+# follow from the rest (see Mesh.projectToLoopLimit()). Faces may be
+# polygons.
+def meshArrays(mesh):
+    mesh.compact()
+    mesh.ensureNormals()
+    indices = []
+    texCoords = []
+    faceSizes = []
+    for f in mesh.faces:
+        e = s = f.edge
+        while True:
+            indices.append(e.vertex.index)
+            texCoords.append(e.texCoord)
+            e = e.nextEdge
+            if (e == s):
+                break
+        faceSizes.append(mesh.faceSize(f))
+    return {'positions': mesh.positions(),
+            'faceSizes': np.array(faceSizes, dtype=np.int64),
+            'indices': np.array(indices, dtype=np.int64),
+            'texCoords': np.array(texCoords, dtype=np.float64).reshape(-1, 2),
+            'normals': np.array([v.eminatingEdge.smoothNormal for v in mesh.verts]).reshape(-1, 3)}
+
+# The inverse of meshArrays(): a new Mesh with the same vertices, faces,
+# texture coordinates and smooth normals.
+def meshFromArrays(arrays):
+    from Mesh import Mesh
+    sizes = arrays['faceSizes']
+    starts = np.concatenate([[0], np.cumsum(sizes)])
+    faces = [arrays['indices'][starts[i]:starts[i + 1]].tolist() for i in range(len(sizes))]
+    width = int(sizes.max()) if len(sizes) else 3
+    texCoords = np.zeros((len(sizes), width, 2), dtype=np.float32)   # As Mesh keeps them
+    corner = np.arange(len(arrays['indices'])) - np.repeat(starts[:-1], sizes)
+    texCoords[np.repeat(np.arange(len(sizes)), sizes), corner] = arrays['texCoords']
+    mesh = Mesh(arrays['positions'], faces, texCoords, triangulate=False)
+    mesh.setSmoothNormals(arrays['normals'])
+    return mesh
+
+def encodeArrays(arrays):
+    data = io.BytesIO()
+    np.savez(data, **arrays)
+    return data.getvalue()
+
+def decodeArrays(data):
+    with np.load(io.BytesIO(data)) as npz:
+        return {name: npz[name] for name in npz.files}
+
+
+def initWorker():
+    sys.setrecursionlimit(10000)
+
+# A result: the encoded arrays of mesh and its content hash.
+def meshResult(mesh):
+    contentHash = mesh.contentHash()
+    return (encodeArrays(meshArrays(mesh)), contentHash)
+
+# Worker process function: levels 0 to level of mesh under scheme, as
+# ((mesh, scheme, level), result) pairs. Every level is computed
+# from the base mesh, so a result never depends on what was cached.
+def computeLevels(mesh, scheme, level):
+    import copy
+    from Mesh import Mesh
+    base = MESHES[mesh]()
+    results = []
+    if (scheme == 'looplimit'):
+        control = Mesh(base.copyOfVertices(), base.copyOfIndices(), base.copyOfTexCoords())
+        for i in range(level + 1):
+            limit = Mesh(control.copyOfVertices(), control.copyOfIndices(), control.copyOfTexCoords())
+            limit.projectToLoopLimit()
+            results.append(((mesh, scheme, i), meshResult(limit)))
+            if (i < level):
+                control.loopSubdivide()
+        return results
+
+    m = base
+    results.append(((mesh, scheme, 0), meshResult(m)))
+    for i in range(1, level + 1):
+        m = copy.deepcopy(m)
+        getattr(m, SUBDIVIDE[scheme])()
+        results.append(((mesh, scheme, i), meshResult(m)))
+    return results
+
+
+# The results cache and the worker pool behind the HTTP handler.
+class MeshService:
+    def __init__(self, workers=None, cacheBytes=CACHE_BYTES):
+        self.pool = ProcessPoolExecutor(workers, initializer=initWorker)
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()   # Request -> result, oldest use first
+        self.cacheBytes = cacheBytes
+        self.cachedBytes = 0
+        self.pending = {}            # Request -> Future of computeLevels()
+        self.counts = {'requests': 0, 'hits': 0, 'misses': 0, 'deduplicated': 0}
+
+    # The result of request (mesh, scheme, level), (encoded arrays, content
+    # hash), from the cache, from a computation already under way, or from
+    # a new one.
+    def get(self, request):
+        checkRequest(*request)
+        with self.lock:
+            self.counts['requests'] += 1
+            if (request in self.cache):
+                self.counts['hits'] += 1
+                self.cache.move_to_end(request)
+                return self.cache[request]
+            future = self.pending.get(request)
+            owner = future is None
+            if (owner):
+                self.counts['misses'] += 1
+                future = self.pool.submit(computeLevels, *request)
+                self.pending[request] = future
+            else:
+                self.counts['deduplicated'] += 1
+        try:
+            results = dict(future.result())
+        except BaseException:
+            if (owner):
+                with self.lock:
+                    del self.pending[request]
+            raise
+        # Cached before the request stops being pending, so that no one in
+        # between starts it again.
+        if (owner):
+            with self.lock:
+                for key, result in results.items():
+                    self.store(key, result)
+                del self.pending[request]
+        return results[request]
+
+    # Caches result for key, dropping the least recently used entries to
+    # stay within cacheBytes. Must be called with the lock held.
+    def store(self, key, result):
+        if (key in self.cache or len(result[0]) > self.cacheBytes):
+            return
+        self.cache[key] = result
+        self.cachedBytes += len(result[0])
+        while self.cachedBytes > self.cacheBytes:
+            oldKey, oldResult = self.cache.popitem(last=False)
+            self.cachedBytes -= len(oldResult[0])
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts)
+            stats['cachedResults'] = len(self.cache)
+            stats['cachedBytes'] = self.cachedBytes
+            stats['pending'] = len(self.pending)
+        return stats
+
+    def shutdown(self):
+        self.pool.shutdown(cancel_futures=True)
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        try:
+            if (url.path == '/mesh'):
+                request = (query.get('mesh', [''])[0], query.get('scheme', ['butterfly'])[0],
+                           int(query.get('level', ['0'])[0]))
+                data, contentHash = self.server.service.get(request)
+                etag = '"%s"' % contentHash
+                if (etag in self.headers.get('If-None-Match', '')):
+                    self.reply(304, None, b'', etag)
+                else:
+                    self.reply(200, 'application/octet-stream', data, etag)
+            elif (url.path == '/stats'):
+                self.reply(200, 'application/json', json.dumps(self.server.service.stats()).encode())
+            else:
+                self.reply(404, 'text/plain', b"Unknown path\n")
+        except ValueError as error:
+            self.reply(400, 'text/plain', ("%s\n" % error).encode())
+        except Exception as error:
+            # A failed worker (a broken pool, a subdivision that ran out of
+            # stack) still gets the client an answer.
+            self.reply(500, 'text/plain', ("%s: %s\n" % (type(error).__name__, error)).encode())
+
+    def reply(self, status, contentType, body, etag=None):
+        self.send_response(status)
+        if (contentType is not None):
+            self.send_header('Content-Type', contentType)
+        if (etag is not None):
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if (self.server.verbose):
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+# Client side: the arrays of level of mesh under scheme from the service at
+# url (for example http://127.0.0.1:8642). Raises OSError if the service
+# can't be reached, ValueError if it rejects the request and RuntimeError
+# if computing the mesh failed there.
+def fetchArrays(url, mesh, scheme, level, timeout=None):
+    query = urllib.parse.urlencode({'mesh': mesh, 'scheme': scheme, 'level': level})
+    try:
+        with urllib.request.urlopen("%s/mesh?%s" % (url.rstrip('/'), query), timeout=timeout) as reply:
+            return decodeArrays(reply.read())
+    except urllib.error.HTTPError as error:
+        if (error.code == 400):
+            raise ValueError(error.read().decode().strip())
+        if (error.code == 500):
+            raise RuntimeError("Mesh service failed: %s" % error.read().decode().strip())
+        raise
+
+# The same, as a new Mesh.
+def fetchMesh(url, mesh, scheme, level, timeout=None):
+    return meshFromArrays(fetchArrays(url, mesh, scheme, level, timeout))
+
+
+def parseArguments():
+    parser = argparse.ArgumentParser(description=HELP_TEXT)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--workers', type=int, default=None,
+                        help="worker processes (default: one per CPU)")
+    parser.add_argument('--cache-mb', type=int, default=CACHE_BYTES >> 20,
+                        help="size of the result cache in megabytes")
+    parser.add_argument('--verbose', action='store_true', help="log every request")
+    return parser.parse_args()
+
+
+def main():
+    args = parseArguments()
+    server = ThreadingHTTPServer((args.host, args.port), RequestHandler)
+    server.daemon_threads = True
+    server.service = MeshService(args.workers, args.cache_mb << 20)
+    server.verbose = args.verbose
+    print("Serving meshes on http://%s:%i" % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.service.shutdown()
+
+
+if __name__ == '__main__':
+    main()
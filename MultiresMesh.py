@@ -0,0 +1,138 @@
+#! /usr/bin/env python3
+#
+# MultiresMesh.py
+# Created by: Jason Sikes
+#
+
+import sys
+import argparse
+
+import numpy as np
+
+from MeshService import MESHES, encodeArrays, meshArrays, meshFromArrays
+
+
+HELP_TEXT = """
+Stores every subdivision level of a mesh in one .npz file that holds the
+base mesh once and, for each level, only vertex positions. Subdivision
+numbers vertices and faces canonically, so the faces and texture
+coordinates of level k+1 follow from level k and don't need storing; each
+level's positions are all it adds. Butterfly subdivision leaves the old
+vertices where they are, so its levels store only the new vertices. Writes
+the file and compares its size with storing each level as a complete
+mesh.
+"""
+
+FORMAT = 'MULTIRES1'
+SCHEMES = ('butterfly', 'loop', 'catmullclark')
+SUBDIVIDE = {
+    'butterfly': 'butterflySubdivide',
+    'loop': 'loopSubdivide',
+    'catmullclark': 'catmullClarkSubdivide',
+}
+# Schemes that keep the old vertices' positions.
+INTERPOLATING = ('butterfly',)
+
+
+# A base mesh and its levels under one subdivision scheme. base is the
+# base mesh as MeshService.meshArrays() arrays; levelPositions[k - 1] is
+# what level k adds: the positions of all its vertices, or only of the new
+# ones for an interpolating scheme.
+class MultiresMesh:
+    def __init__(self, scheme, base, levelPositions):
+        if (scheme not in SCHEMES):
+            raise ValueError("Unknown scheme %r; known are %s" % (scheme, ', '.join(SCHEMES)))
+        self.scheme = scheme
+        self.base = base
+        self.levelPositions = levelPositions
+
+    # Subdivides a copy of mesh levels times under scheme and keeps what
+    # each level adds. mesh itself is canonicalized but not changed
+    # otherwise.
+    def fromMesh(mesh, scheme, levels):
+        mesh.canonicalize()
+        base = meshArrays(mesh)
+        levelPositions = []
+        m = meshFromArrays(base)
+        for level in range(levels):
+            vertexCount = len(m.verts)
+            getattr(m, SUBDIVIDE[scheme])()
+            positions = m.positions()
+            if (scheme in INTERPOLATING):
+                positions = positions[vertexCount:]
+            levelPositions.append(positions)
+        return MultiresMesh(scheme, base, levelPositions)
+    fromMesh = staticmethod(fromMesh)
+
+    def levelCount(self):
+        return len(self.levelPositions)
+
+    # Meshes for levels 0 to last (default: all of them) in turn. There is
+    # only one Mesh, refined in place from one level to the next, so a
+    # caller that keeps a level must copy it before asking for the next.
+    def levels(self, last=None):
+        if (last is None):
+            last = self.levelCount()
+        mesh = meshFromArrays(self.base)
+        yield mesh
+        for positions in self.levelPositions[:last]:
+            if (self.scheme in INTERPOLATING):
+                positions = np.concatenate([mesh.positions(), positions])
+            else:
+                positions = np.array(positions, dtype=np.float64)
+            mesh.refine(self.scheme, positions)
+            yield mesh
+
+    # A new Mesh for one level.
+    def level(self, level):
+        if (not 0 <= level <= self.levelCount()):
+            raise ValueError("level must be 0 to %i" % self.levelCount())
+        for mesh in self.levels(level):
+            pass
+        return mesh
+
+    def save(self, path):
+        arrays = dict(('base_' + name, a) for name, a in self.base.items())
+        for i, positions in enumerate(self.levelPositions):
+            arrays['level%i' % (i + 1)] = positions
+        np.savez(path, format=np.array(FORMAT), scheme=np.array(self.scheme),
+                 levels=np.array(len(self.levelPositions)), **arrays)
+
+    def load(path):
+        with np.load(path) as npz:
+            if (str(npz.get('format', '')) != FORMAT):
+                raise ValueError("%s is not a multiresolution mesh" % path)
+            base = dict((name[len('base_'):], npz[name]) for name in npz.files if name.startswith('base_'))
+            levelPositions = [npz['level%i' % (i + 1)] for i in range(int(npz['levels']))]
+            return MultiresMesh(str(npz['scheme']), base, levelPositions)
+    load = staticmethod(load)
+
+
+def parseArguments():
+    parser = argparse.ArgumentParser(description=HELP_TEXT)
+    parser.add_argument('--mesh', choices=sorted(MESHES), default='bunny')
+    parser.add_argument('--scheme', choices=SCHEMES, default='butterfly')
+    parser.add_argument('--levels', type=int, default=3)
+    parser.add_argument('--output', default='multires.npz')
+    return parser.parse_args()
+
+
+def main():
+    args = parseArguments()
+    sys.setrecursionlimit(10000)
+    multires = MultiresMesh.fromMesh(MESHES[args.mesh](), args.scheme, args.levels)
+    multires.save(args.output)
+    with open(args.output, 'rb') as f:
+        size = len(f.read())
+    separate = 0
+    for level, mesh in enumerate(multires.levels()):
+        length = len(encodeArrays(meshArrays(mesh)))
+        separate += length
+        print("level %i: %i vertices, %i faces, %i bytes as a complete mesh" %
+              (level, len(mesh.verts), len(mesh.faces), length))
+    print("%s: %i bytes, %.1f%% of the %i bytes of the levels stored separately" %
+          (args.output, size, 100.0 * size / separate, separate))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+# ParallelNormals.py
+# Created by: Jason Sikes
+#
+# Normals and OpenGL arrays of plain vertex/face arrays, computed on a
+# thread pool. The faces are cut into fixed ranges of chunkFaces, and each
+# range is handled by the same numpy code as StreamSubdivide's serial
+# functions; numpy releases the GIL in its gathers and arithmetic, so the
+# ranges run on several cores at once. Per-face and per-corner values
+# don't depend on how the faces are cut, so the results are bit-identical
+# to the serial functions for any number of workers.
+#
+# The one sum across faces, each vertex's sum of face normals, is not cut
+# into ranges: adding partial sums would change the order of the
+# additions, and with it the last bits. It stays one np.bincount() over
+# all corners in order, as in StreamSubdivide.vertexNormals(), with the
+# three coordinates as three tasks.
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from StreamSubdivide import faceNormals as serialFaceNormals
+
+# Faces per task. Large enough that the per-task overhead doesn't show,
+# small enough that a chunk's temporaries stay in cache.
+CHUNK_FACES = 1 << 16
+
+
+# Runs function(start, end) for consecutive ranges of count items, chunk
+# at a time, on pool, and waits for all of them.
+def forRanges(pool, function, count, chunk):
+    starts = range(0, count, chunk)
+    list(pool.map(lambda start: function(start, min(start + chunk, count)), starts))
+
+def threadPool(workers):
+    if workers is None:
+        workers = os.cpu_count() or 1
+    return ThreadPoolExecutor(workers)
+
+
+def faceNormalsOnPool(pool, verts, faces, chunkFaces):
+    normals = np.empty((len(faces), 3))
+    def chunk(start, end):
+        normals[start:end] = serialFaceNormals(verts, faces[start:end])
+    forRanges(pool, chunk, len(faces), chunkFaces)
+    return normals
+
+def vertexNormalsOnPool(pool, verts, faces, chunkFaces):
+    n = faceNormalsOnPool(pool, verts, faces, chunkFaces)
+    corners = faces.reshape(-1)
+    normals = np.zeros((len(verts), 3))
+    def axisSum(axis):
+        normals[:, axis] = np.bincount(corners, weights=np.repeat(n[:, axis], 3),
+                                       minlength=len(verts))
+    list(pool.map(axisSum, range(3)))
+
+    def normalize(start, end):
+        lengths = np.linalg.norm(normals[start:end], axis=1)
+        normals[start:end] /= np.where(lengths > 0, lengths, 1.0)[:, None]
+    forRanges(pool, normalize, len(verts), chunkFaces)
+    return normals
+
+
+# Unit normals of triangles, like StreamSubdivide.faceNormals(). workers
+# defaults to the number of CPUs.
+def faceNormals(verts, faces, workers=None, chunkFaces=CHUNK_FACES):
+    verts = np.asarray(verts, dtype=np.float64)
+    faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)
+    with threadPool(workers) as pool:
+        return faceNormalsOnPool(pool, verts, faces, chunkFaces)
+
+# Smooth vertex normals, like StreamSubdivide.vertexNormals().
+def vertexNormals(verts, faces, workers=None, chunkFaces=CHUNK_FACES):
+    verts = np.asarray(verts, dtype=np.float64)
+    faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)
+    with threadPool(workers) as pool:
+        return vertexNormalsOnPool(pool, verts, faces, chunkFaces)
+
+# The OpenGL arrays of chunk = (positions, faces, normals, texCoords), like
+# StreamSubdivide.openGLArrays(). normals may be None, in which case the
+# smooth normals are computed here too. The arrays are written into out
+# (four float32 arrays of the right sizes, for example slices of
+# np.memmap arrays) if it is given.
+def openGLArrays(chunk, workers=None, chunkFaces=CHUNK_FACES, out=None):
+    positions, faces, normals, texCoords = chunk
+    positions = np.asarray(positions, dtype=np.float64)
+    faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)
+    if out is None:
+        out = [np.empty(9 * len(faces), dtype=np.float32) for i in range(3)]
+        out.append(np.empty(6 * len(faces), dtype=np.float32))
+    vertices, smoothNormals, flatNormals, coords = [a.reshape(len(faces), 3, -1) for a in out]
+
+    with threadPool(workers) as pool:
+        if normals is None:
+            normals = vertexNormalsOnPool(pool, positions, faces, chunkFaces)
+        def chunk(start, end):
+            f = faces[start:end]
+            vertices[start:end] = positions[f]
+            smoothNormals[start:end] = normals[f]
+            flatNormals[start:end] = serialFaceNormals(positions, f)[:, None, :]
+            if texCoords is None:
+                coords[start:end] = 0
+            else:
+                coords[start:end] = texCoords[start:end]
+        forRanges(pool, chunk, len(faces), chunkFaces)
+    return out
@@ -0,0 +1,153 @@
+# ParallelSubdivide.py
+# Created by: Jason Sikes
+#
+# Butterfly subdivision of large meshes across worker processes. The faces
+# are sorted along a Morton curve and cut into spatially coherent patches.
+# Each worker subdivides the edges of one patch, seeing the patch plus a
+# one-ring halo of neighboring faces, which holds every stencil the patch's
+# edges need. The inputs and the result live in shared memory, so no mesh
+# data is pickled. New edge vertices are numbered once, globally, by
+# MeshArrays.edgeIndices(), and each edge is computed by exactly one patch,
+# so the patches need no stitching beyond writing into the same array.
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from Mesh import Mesh
+from MeshArrays import (butterflyEdgeVertices, canonicalHalfEdges, csrEntries, edgeIndices,
+                        halfEdgeMates, splitFaces)
+
+
+# Arrays the workers attach to, by name.
+workerArrays = {}
+workerBlocks = []
+
+
+# Numpy arrays backed by shared memory blocks, which worker processes open
+# by name.
+class SharedArrays:
+    def __init__(self):
+        self.blocks = []
+        self.arrays = {}
+        self.specs = {}
+
+    def add(self, name, shape, dtype, value=None):
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape)) * dtype.itemsize
+        block = shared_memory.SharedMemory(create=True, size=size if size > 0 else 1)
+        self.blocks.append(block)
+        array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        if value is not None:
+            array[...] = value
+        self.arrays[name] = array
+        self.specs[name] = (block.name, shape, dtype.str)
+        return array
+
+    def close(self):
+        self.arrays = {}
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+
+# Process pool initializer: opens the shared arrays.
+def attachArrays(specs):
+    for name, (blockName, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=blockName)
+        workerBlocks.append(block)
+        workerArrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+
+
+# Interleaves the bits of 10-bit integer coordinates.
+def mortonCodes(points):
+    lower = points.min(axis=0)
+    extent = (points.max(axis=0) - lower).max()
+    if extent == 0:
+        extent = 1.0
+    q = np.minimum((points - lower) / extent * 1024, 1023).astype(np.int64)
+    codes = np.zeros(len(points), dtype=np.int64)
+    for bit in range(10):
+        for axis in range(3):
+            codes |= ((q[:, axis] >> bit) & 1) << (3 * bit + axis)
+    return codes
+
+
+# Worker: computes the edge vertices owned by the faces order[start:end].
+# An edge belongs to the face of its canonical half-edge.
+def subdividePatch(start, end):
+    verts = workerArrays['verts']
+    faces = workerArrays['faces']
+    owned = np.sort(workerArrays['order'][start:end])
+
+    # The patch plus every face sharing a vertex with it.
+    entries, counts = csrEntries(workerArrays['vertexFaceOffsets'], np.unique(faces[owned]))
+    local = np.unique(workerArrays['vertexFaces'][entries])
+    localVertices, localFaces = np.unique(faces[local], return_inverse=True)
+    localFaces = localFaces.reshape(-1, 3)
+
+    mate = halfEdgeMates(localFaces, len(localVertices))
+    isOwned = np.repeat(np.isin(local, owned, assume_unique=True), 3)
+    h = np.nonzero(canonicalHalfEdges(localFaces, mate, localVertices) & isOwned)[0]
+    positions = butterflyEdgeVertices(verts[localVertices], localFaces, mate, h)
+    edge = workerArrays['edge'][3 * local[h // 3] + h % 3]
+    workerArrays['newVerts'][len(verts) + edge] = positions
+    return len(h)
+
+
+# One level of butterfly subdivision on arrays, like
+# MeshArrays.butterflySubdivideArrays() and with bit-identical results.
+# workers defaults to the number of CPUs; the faces are cut into
+# patchesPerWorker patches per worker to balance the load.
+def parallelButterflySubdivide(verts, faces, texCoords=None, workers=None, patchesPerWorker=4):
+    verts = np.asarray(verts, dtype=np.float64)
+    faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    edge, edgeCount = edgeIndices(faces, len(verts))
+    order = np.argsort(mortonCodes(verts[faces].mean(axis=1)), kind='stable')
+
+    # Faces around each vertex, in CSR form.
+    corners = faces.reshape(-1)
+    vertexFaces = np.argsort(corners, kind='stable') // 3
+    vertexFaceOffsets = np.zeros(len(verts) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(corners, minlength=len(verts)), out=vertexFaceOffsets[1:])
+
+    shared = SharedArrays()
+    try:
+        shared.add('verts', verts.shape, verts.dtype, verts)
+        shared.add('faces', faces.shape, faces.dtype, faces)
+        shared.add('edge', edge.shape, edge.dtype, edge)
+        shared.add('order', order.shape, order.dtype, order)
+        shared.add('vertexFaces', vertexFaces.shape, vertexFaces.dtype, vertexFaces)
+        shared.add('vertexFaceOffsets', vertexFaceOffsets.shape, vertexFaceOffsets.dtype,
+                   vertexFaceOffsets)
+        newVerts = shared.add('newVerts', (len(verts) + edgeCount, 3), np.float64)
+        newVerts[:len(verts)] = verts
+
+        bounds = np.linspace(0, len(faces), workers * patchesPerWorker + 1).astype(np.int64)
+        with ProcessPoolExecutor(workers, initializer=attachArrays,
+                                 initargs=(shared.specs,)) as pool:
+            computed = sum(pool.map(subdividePatch, bounds[:-1], bounds[1:]))
+        if computed != edgeCount:
+            raise RuntimeError("Patches computed %i of %i edge vertices" % (computed, edgeCount))
+        newVerts = newVerts.copy()
+    finally:
+        shared.close()
+
+    newFaces, newCoords = splitFaces(faces, texCoords, edge, len(verts))
+    return newVerts, newFaces, newCoords
+
+
+# Returns a new Mesh that is mesh butterfly subdivided levels times, with
+# every level done by parallelButterflySubdivide().
+def parallelSubdivideMesh(mesh, levels=1, workers=None):
+    verts = np.array([v.position for v in mesh.verts], dtype=np.float64)
+    faces = np.array(mesh.copyOfIndices(), dtype=np.int64)
+    texCoords = mesh.copyOfTexCoords()
+    for level in range(levels):
+        verts, faces, texCoords = parallelButterflySubdivide(verts, faces, texCoords, workers)
+    return Mesh(verts, faces, texCoords)
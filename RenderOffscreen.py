@@ -0,0 +1,192 @@
+#! /usr/bin/env python3
+#
+# RenderOffscreen.py
+# Created by: Jason Sikes
+#
+
+import os
+import sys
+import time
+import argparse
+import ctypes
+
+# PyOpenGL picks its platform when it is first imported, so this has to
+# happen before ViewMesh (or anything else) imports OpenGL. Mesa needs no
+# X server or GPU on the surfaceless platform.
+os.environ['PYOPENGL_PLATFORM'] = 'egl'
+os.environ.setdefault('EGL_PLATFORM', 'surfaceless')
+
+from OpenGL import EGL
+from OpenGL.GL import *
+from math import radians
+
+import ViewMesh
+from Mesh import loadOpenGLArrays
+
+
+HELP_TEXT = """
+Renders one of the viewer's meshes without opening a window, using an EGL
+pbuffer. The viewer's own initGL(), setMesh() and drawFrame() do the
+drawing, so the images match what ViewMesh.py shows. Writes PNG snapshots
+and reports the frame rate, which makes it usable for reference images and
+throughput measurements on machines without a display.
+"""
+
+# Mesh name on the command line -> mesh family in ViewMesh.
+MESHES = {
+    'bunny': 'Bunny',
+    'tetrahedron': 'Tetrahedron',
+    'cube': 'Triangulated Cube',
+    'quadcube': 'Quad Cube',
+    'loopbunny': 'Loop Limit Bunny',
+}
+
+SHADING_MODES = ['wireframe', 'flat', 'smooth']
+
+
+# Creates an EGL context with a size x size pbuffer and makes it current.
+def createContext(size):
+    display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+    if display == EGL.EGL_NO_DISPLAY:
+        raise RuntimeError("No EGL display available")
+    EGL.eglInitialize(display, None, None)
+
+    configAttributes = (EGL.EGLint * 13)(EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT,
+                                         EGL.EGL_RED_SIZE, 8,
+                                         EGL.EGL_GREEN_SIZE, 8,
+                                         EGL.EGL_BLUE_SIZE, 8,
+                                         EGL.EGL_DEPTH_SIZE, 24,
+                                         EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT,
+                                         EGL.EGL_NONE)
+    config = EGL.EGLConfig()
+    count = EGL.EGLint()
+    EGL.eglChooseConfig(display, configAttributes, ctypes.pointer(config), 1, ctypes.pointer(count))
+    if count.value == 0:
+        raise RuntimeError("No EGL config supports desktop OpenGL pbuffers")
+
+    surfaceAttributes = (EGL.EGLint * 5)(EGL.EGL_WIDTH, size, EGL.EGL_HEIGHT, size, EGL.EGL_NONE)
+    surface = EGL.eglCreatePbufferSurface(display, config, surfaceAttributes)
+    EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+    context = EGL.eglCreateContext(display, config, EGL.EGL_NO_CONTEXT, None)
+    EGL.eglMakeCurrent(display, surface, surface, context)
+    glViewport(0, 0, size, size)
+    return display
+
+
+def readImage(size):
+    from PIL import Image, ImageOps
+    glPixelStorei(GL_PACK_ALIGNMENT, 1)
+    data = glReadPixels(0, 0, size, size, GL_RGB, GL_UNSIGNED_BYTE)
+    return ImageOps.flip(Image.frombytes('RGB', (size, size), data))
+
+
+def snapshotFilename(output, frame, snapshots):
+    if snapshots == 1:
+        return output
+    root, extension = os.path.splitext(output)
+    return "%s_%04i%s" % (root, frame, extension)
+
+
+def parseArguments():
+    parser = argparse.ArgumentParser(description=HELP_TEXT)
+    parser.add_argument('--mesh', choices=sorted(MESHES.keys()), default='tetrahedron')
+    parser.add_argument('--arrays', metavar='BASENAME',
+                        help="render OpenGL arrays saved by Mesh.mapOpenGLArrays() or "
+                             "StreamSubdivide.writeOpenGLFiles() instead of --mesh")
+    parser.add_argument('--shared', metavar='NAME',
+                        help="render a SharedMesh made by another process (see SharedMesh.py)")
+    parser.add_argument('--level', type=int, default=0,
+                        help="subdivision level (0 is the unsubdivided mesh)")
+    parser.add_argument('--shading', choices=SHADING_MODES, default='smooth')
+    parser.add_argument('--texture', action='store_true')
+    parser.add_argument('--shaders', action='store_true',
+                        help="use the GLSL 3.30 render path")
+    parser.add_argument('--compact', action='store_true',
+                        help="use the quantized vertex format")
+    parser.add_argument('--frames', type=int, default=100)
+    parser.add_argument('--spin', type=float, default=1.0,
+                        help="degrees the camera turns between frames")
+    parser.add_argument('--size', type=int, default=700,
+                        help="width and height of the image in pixels")
+    parser.add_argument('--output', default='offscreen.png')
+    parser.add_argument('--snapshots', type=int, default=1,
+                        help="number of evenly spaced frames to save; 0 saves none")
+    return parser.parse_args()
+
+
+def main():
+    args = parseArguments()
+    createContext(args.size)
+    ViewMesh.initGL()
+
+    if args.arrays:
+        mesh = loadOpenGLArrays(args.arrays)
+        centroid = mesh.vboVertices.reshape(-1, 3).mean(axis=0)
+    elif args.shared:
+        from SharedMesh import SharedMesh
+        mesh = SharedMesh.attach(args.shared).openGLArrays()
+        centroid = mesh.vboVertices.reshape(-1, 3).mean(axis=0)
+    else:
+        levels = ViewMesh.loadFamily(MESHES[args.mesh])
+        if not 0 <= args.level < len(levels):
+            sys.exit("%s has levels 0 to %i" % (args.mesh, len(levels) - 1))
+        mesh = levels[args.level]
+        centroid = ViewMesh.familyCentroids[MESHES[args.mesh]]
+
+    ViewMesh.shade = args.shading != 'wireframe'
+    ViewMesh.smooth = args.shading == 'smooth'
+    ViewMesh.texture = args.texture
+    if args.shaders:
+        ViewMesh.setShaders(True)
+    ViewMesh.compact = args.compact
+    if ViewMesh.shade:
+        glPolygonMode(GL_FRONT_AND_BACK, GL_FILL)
+        glEnable(GL_LIGHTING)
+    ViewMesh.setMesh(mesh)
+    ViewMesh.finishUpload()
+    ViewMesh.setView(centroid)
+
+    # One untimed frame, so one-time driver work doesn't count.
+    ViewMesh.drawFrame()
+    glFinish()
+
+    snapshotFrames = set()
+    if args.snapshots > 0:
+        for i in range(args.snapshots):
+            snapshotFrames.add((args.frames - 1) - i * args.frames // args.snapshots)
+    images = []
+
+    # A snapshot must be read back at its frame, but the readback isn't
+    # rendering: the frame is finished first, and the time spent reading
+    # it is left out of the frame rate.
+    readback = 0.0
+    start = time.perf_counter()
+    for frame in range(args.frames):
+        ViewMesh.eyeTheta += radians(args.spin)
+        ViewMesh.setView(None)
+        ViewMesh.drawFrame()
+        if frame in snapshotFrames:
+            glFinish()
+            readStart = time.perf_counter()
+            images.append((frame, readImage(args.size)))
+            readback += time.perf_counter() - readStart
+    glFinish()
+    elapsed = time.perf_counter() - start - readback
+
+    for frame, image in images:
+        filename = snapshotFilename(args.output, frame, args.snapshots)
+        image.save(filename)
+        print("Wrote %s" % filename)
+
+    mesh = ViewMesh.mesh
+    print("Rendered %i frames of %s (%i triangles, %s%s, %s) in %.3f s: %.1f frames per second"
+          % (args.frames, ViewMesh.meshName(mesh), len(mesh.vboVertices) // 9, args.shading,
+             ", textured" if args.texture else "",
+             ("glsl" if ViewMesh.shaders else "fixed-function") + (", compact" if args.compact else ""),
+             elapsed, args.frames / elapsed))
+    ViewMesh.cleanup()
+
+
+if __name__ == "__main__":
+    sys.setrecursionlimit(10000)
+    main()
@@ -0,0 +1,238 @@
+# ShaderRenderer.py
+# Created by: Jason Sikes
+#
+# A GLSL 3.30 render path for the viewer. Every mesh gets its own vertex
+# array object holding positions, smooth normals and texture coordinates.
+# Flat shading derives the face normal in the fragment shader from the
+# screen-space derivatives of the eye-space position, so the flat-normal
+# buffer is never uploaded. The fixed-function light and material settings
+# of the viewer are passed in as uniforms.
+
+import weakref
+from math import *
+from OpenGL.GL import *
+from OpenGL.GL.shaders import compileShader, compileProgram
+import numpy as np
+
+
+VERTEX_SHADER = """
+#version 330 core
+
+layout(location = 0) in vec3 position;
+layout(location = 1) in vec3 normal;
+layout(location = 2) in vec2 texCoord;
+
+uniform mat4 modelView;
+uniform mat4 projection;
+// Decodes quantized positions; 1 and 0 for float positions.
+uniform float positionScale;
+uniform vec3 positionOffset;
+
+out vec3 eyePosition;
+out vec3 eyeNormal;
+out vec2 fragmentTexCoord;
+
+void main()
+{
+    vec4 p = modelView * vec4(position * positionScale + positionOffset, 1.0);
+    eyePosition = p.xyz;
+    // The modelview matrix is a rigid motion, so it can transform normals.
+    eyeNormal = mat3(modelView) * normal;
+    fragmentTexCoord = texCoord;
+    gl_Position = projection * p;
+}
+"""
+
+FRAGMENT_SHADER = """
+#version 330 core
+
+in vec3 eyePosition;
+in vec3 eyeNormal;
+in vec2 fragmentTexCoord;
+
+uniform bool lighting;
+uniform bool smoothShading;
+uniform bool useTexture;
+uniform sampler2D textureSampler;
+
+uniform vec3 lightDirection;
+uniform vec4 lightModelAmbient;
+uniform vec4 lightAmbient;
+uniform vec4 lightDiffuse;
+uniform vec4 lightSpecular;
+uniform vec4 materialAmbient;
+uniform vec4 materialDiffuse;
+uniform vec4 materialSpecular;
+uniform float materialShininess;
+
+out vec4 fragmentColor;
+
+void main()
+{
+    vec4 color = vec4(1.0);
+    if (lighting) {
+        vec3 n;
+        if (smoothShading) {
+            n = normalize(eyeNormal);
+        } else {
+            n = normalize(cross(dFdx(eyePosition), dFdy(eyePosition)));
+        }
+        float diffuse = max(dot(n, lightDirection), 0.0);
+        color = (lightModelAmbient + lightAmbient) * materialAmbient
+              + diffuse * lightDiffuse * materialDiffuse;
+        if (diffuse > 0.0) {
+            // Same half-vector as fixed-function lighting with a non-local viewer.
+            vec3 h = normalize(lightDirection + vec3(0.0, 0.0, 1.0));
+            color += pow(max(dot(n, h), 0.0), materialShininess) * lightSpecular * materialSpecular;
+        }
+        color.a = materialDiffuse.a;
+    }
+    if (useTexture) {
+        color *= texture(textureSampler, fragmentTexCoord);
+    }
+    fragmentColor = color;
+}
+"""
+
+POSITION_LOCATION = 0
+NORMAL_LOCATION = 1
+TEXCOORD_LOCATION = 2
+
+
+# The same matrix as gluLookAt(), as a row-major numpy array.
+def lookAtMatrix(eye, center, up):
+    f = np.asarray(center, dtype=np.float64) - eye
+    f /= np.linalg.norm(f)
+    s = np.cross(f, up)
+    s /= np.linalg.norm(s)
+    u = np.cross(s, f)
+    m = np.identity(4)
+    m[0, :3] = s
+    m[1, :3] = u
+    m[2, :3] = -f
+    m[:3, 3] = -m[:3, :3].dot(eye)
+    return m
+
+# The same matrix as gluPerspective(), as a row-major numpy array.
+def perspectiveMatrix(fovy, aspect, near, far):
+    f = 1.0 / tan(radians(fovy) / 2.0)
+    m = np.zeros((4, 4))
+    m[0, 0] = f / aspect
+    m[1, 1] = f
+    m[2, 2] = (far + near) / (near - far)
+    m[2, 3] = 2.0 * far * near / (near - far)
+    m[3, 2] = -1.0
+    return m
+
+
+# The vertex array object and buffers of one mesh. With compact set, the
+# buffers hold the mesh's compact arrays (see Mesh.createCompactOpenGLArrays).
+class MeshVAO:
+    def __init__(self, mesh, compact=False):
+        self.vao = glGenVertexArrays(1)
+        self.buffers = glGenBuffers(3)
+        self.vertexCount = len(mesh.vboVertices) // 3
+        if compact:
+            self.positionScale = mesh.compactPositionScale
+            self.positionOffset = mesh.compactPositionOffset
+            attributes = ((POSITION_LOCATION, 4, GL_SHORT, GL_FALSE, mesh.vboCompactVertices),
+                          (NORMAL_LOCATION, 4, GL_INT_2_10_10_10_REV, GL_TRUE, mesh.vboCompactSmoothNormals),
+                          (TEXCOORD_LOCATION, 2, GL_HALF_FLOAT, GL_FALSE, mesh.vboCompactTexCoords))
+        else:
+            self.positionScale = 1.0
+            self.positionOffset = (0.0, 0.0, 0.0)
+            attributes = ((POSITION_LOCATION, 3, GL_FLOAT, GL_FALSE, mesh.vboVertices),
+                          (NORMAL_LOCATION, 3, GL_FLOAT, GL_FALSE, mesh.vboSmoothNormals),
+                          (TEXCOORD_LOCATION, 2, GL_FLOAT, GL_FALSE, mesh.vboTexCoords))
+        glBindVertexArray(self.vao)
+        for (location, size, dataType, normalized, data), buffer in zip(attributes, self.buffers):
+            glBindBuffer(GL_ARRAY_BUFFER, buffer)
+            glBufferData(GL_ARRAY_BUFFER, data, GL_STATIC_DRAW)
+            glEnableVertexAttribArray(location)
+            glVertexAttribPointer(location, size, dataType, normalized, 0, None)
+        glBindVertexArray(0)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+    def delete(self):
+        glDeleteVertexArrays(1, [self.vao])
+        glDeleteBuffers(3, self.buffers)
+
+
+class ShaderRenderer:
+    # lightDirection is the direction towards the light in eye coordinates.
+    # The remaining arguments are the viewer's light and material settings.
+    def __init__(self, lightDirection, lightModelAmbient, lightAmbient, lightDiffuse,
+                 lightSpecular, materialAmbient, materialDiffuse, materialSpecular,
+                 materialShininess):
+        self.program = compileProgram(compileShader(VERTEX_SHADER, GL_VERTEX_SHADER),
+                                      compileShader(FRAGMENT_SHADER, GL_FRAGMENT_SHADER))
+        # Mesh -> {compact: MeshVAO}. The VAOs of a mesh that has been
+        # garbage collected wait in deadVAOs until a GL call can delete them.
+        self.meshVAOs = weakref.WeakKeyDictionary()
+        self.deadVAOs = []
+        self.uniforms = {}
+        for name in ('modelView', 'projection', 'positionScale', 'positionOffset', 'lighting',
+                     'smoothShading', 'useTexture', 'textureSampler'):
+            self.uniforms[name] = glGetUniformLocation(self.program, name)
+
+        direction = np.asarray(lightDirection, dtype=np.float64)
+        direction /= np.linalg.norm(direction)
+        glUseProgram(self.program)
+        glUniform3fv(glGetUniformLocation(self.program, 'lightDirection'), 1, direction)
+        for name, value in (('lightModelAmbient', lightModelAmbient),
+                            ('lightAmbient', lightAmbient),
+                            ('lightDiffuse', lightDiffuse),
+                            ('lightSpecular', lightSpecular),
+                            ('materialAmbient', materialAmbient),
+                            ('materialDiffuse', materialDiffuse),
+                            ('materialSpecular', materialSpecular)):
+            glUniform4fv(glGetUniformLocation(self.program, name), 1, value)
+        glUniform1f(glGetUniformLocation(self.program, 'materialShininess'), materialShininess)
+        glUniform1i(self.uniforms['textureSampler'], 0)
+        glUseProgram(0)
+
+    # Returns the VAO of mesh, uploading the mesh the first time it's seen
+    # in the given vertex format.
+    def meshVAO(self, mesh, compact=False):
+        self.deleteDeadVAOs()
+        vaos = self.meshVAOs.get(mesh)
+        if vaos is None:
+            vaos = self.meshVAOs[mesh] = {}
+            weakref.finalize(mesh, self.deadVAOs.append, vaos)
+        meshVAO = vaos.get(compact)
+        if meshVAO is None:
+            meshVAO = vaos[compact] = MeshVAO(mesh, compact)
+        return meshVAO
+
+    def deleteDeadVAOs(self):
+        while self.deadVAOs:
+            for meshVAO in self.deadVAOs.pop().values():
+                meshVAO.delete()
+
+    def draw(self, mesh, compact, modelView, projection, lighting, smooth, texture, textureID):
+        meshVAO = self.meshVAO(mesh, compact)
+        glUseProgram(self.program)
+        glUniformMatrix4fv(self.uniforms['modelView'], 1, GL_TRUE, modelView.astype(np.float32))
+        glUniformMatrix4fv(self.uniforms['projection'], 1, GL_TRUE, projection.astype(np.float32))
+        glUniform1f(self.uniforms['positionScale'], meshVAO.positionScale)
+        glUniform3fv(self.uniforms['positionOffset'], 1, np.asarray(meshVAO.positionOffset, dtype=np.float32))
+        glUniform1i(self.uniforms['lighting'], lighting)
+        glUniform1i(self.uniforms['smoothShading'], smooth)
+        glUniform1i(self.uniforms['useTexture'], texture)
+        if texture:
+            glActiveTexture(GL_TEXTURE0)
+            glBindTexture(GL_TEXTURE_2D, textureID)
+        glBindVertexArray(meshVAO.vao)
+        glDrawArrays(GL_TRIANGLES, 0, meshVAO.vertexCount)
+        glBindVertexArray(0)
+        glUseProgram(0)
+
+    def delete(self):
+        self.deleteDeadVAOs()
+        for vaos in self.meshVAOs.values():
+            for meshVAO in vaos.values():
+                meshVAO.delete()
+            vaos.clear()
+        self.meshVAOs = weakref.WeakKeyDictionary()
+        glDeleteProgram(self.program)
+        self.program = 0
@@ -0,0 +1,208 @@
+# SharedMesh.py
+# Created by: Jason Sikes
+#
+# A triangle mesh in one block of shared memory (multiprocessing.
+# shared_memory), so that a worker process can subdivide a mesh and hand
+# the result to the viewer without pickling it. A Mesh is a graph of Edge,
+# Vertex and Face objects full of reference cycles, which is slow and
+# large to pickle; the shared block holds plain arrays instead: positions,
+# triangle indices, per-corner texture coordinates, vertex normals and the
+# four OpenGL arrays in Mesh's layout. The viewer attaches to the block by
+# name and gets numpy views of it, which glBufferData() can read directly.
+#
+# The block starts with a small header: MAGIC, a ready flag, and the
+# length of a JSON description of where each array lives, relative to the
+# first aligned byte after the description. The flag is set last, after
+# the creating process has filled the arrays.
+
+import json
+import struct
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from Mesh import OPENGL_ARRAY_NAMES, OpenGLArrays
+
+MAGIC = b'SHMESH01'
+HEADER_FORMAT = '8sqq'   # Magic, ready flag, length of the JSON layout
+HEADER_BYTES = struct.calcsize(HEADER_FORMAT)
+READY_OFFSET = 8
+ALIGNMENT = 64
+
+# Name, dtype and shape (in vertices V, triangles F) of each array.
+ARRAYS = (
+    ('positions', '<f8', ('V', 3)),
+    ('indices', '<i8', ('F', 3)),
+    ('texCoords', '<f4', ('F', 3, 2)),
+    ('normals', '<f8', ('V', 3)),
+    ('vboVertices', '<f4', ('F', 9)),
+    ('vboSmoothNormals', '<f4', ('F', 9)),
+    ('vboFlatNormals', '<f4', ('F', 9)),
+    ('vboTexCoords', '<f4', ('F', 6)),
+)
+
+
+# Opens an existing block without registering it with this process's
+# resource tracker, which would otherwise unlink it when this process
+# exits even though another process made it.
+def openBlock(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python before 3.13 has no track argument.
+        block = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(block._name, 'shared_memory')
+        return block
+
+
+# Where the arrays start, after a description of length bytes.
+def alignedStart(length):
+    return (HEADER_BYTES + length + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+class SharedMesh:
+    def __init__(self, block, layout, start):
+        self.block = block
+        self.name = block.name
+        self.vertexCount = layout['vertexCount']
+        self.faceCount = layout['faceCount']
+        self.arrays = {}
+        for name, dtype, shape, offset in layout['arrays']:
+            array = np.ndarray(tuple(shape), dtype=np.dtype(dtype), buffer=block.buf,
+                               offset=start + offset)
+            self.arrays[name] = array
+            setattr(self, name, array)
+
+    # A new, empty shared mesh with room for vertexCount vertices and
+    # faceCount triangles. Whoever creates it owns it and must unlink() it,
+    # unless it hands that over to another process.
+    def create(vertexCount, faceCount, name=None):
+        sizes = {'V': vertexCount, 'F': faceCount}
+        arrays = []
+        offset = 0
+        for arrayName, dtype, shape in ARRAYS:
+            shape = [sizes[n] if n in sizes else n for n in shape]
+            arrays.append((arrayName, dtype, shape, offset))
+            offset += int(np.prod(shape)) * np.dtype(dtype).itemsize
+            offset = (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+        layout = {'vertexCount': vertexCount, 'faceCount': faceCount, 'arrays': arrays}
+        text = json.dumps(layout).encode()
+        start = alignedStart(len(text))
+        block = shared_memory.SharedMemory(name=name, create=True, size=start + offset)
+        block.buf[:HEADER_BYTES] = struct.pack(HEADER_FORMAT, MAGIC, 0, len(text))
+        block.buf[HEADER_BYTES:HEADER_BYTES + len(text)] = text
+        return SharedMesh(block, layout, start)
+    create = staticmethod(create)
+
+    # Attaches to the shared mesh called name, made by another process.
+    def attach(name):
+        block = openBlock(name)
+        magic, ready, length = struct.unpack(HEADER_FORMAT, bytes(block.buf[:HEADER_BYTES]))
+        if (magic != MAGIC):
+            block.close()
+            raise ValueError("%s is not a shared mesh" % name)
+        layout = json.loads(bytes(block.buf[HEADER_BYTES:HEADER_BYTES + length]))
+        return SharedMesh(block, layout, alignedStart(length))
+    attach = staticmethod(attach)
+
+    # A shared mesh holding verts, faces (triangles) and, if given,
+    # texCoords (F x 3 x 2, per corner). The normals and OpenGL arrays
+    # are computed with ParallelNormals on workers threads.
+    def fromArrays(verts, faces, texCoords=None, workers=None, name=None):
+        from ParallelNormals import openGLArrays, vertexNormals
+        verts = np.asarray(verts, dtype=np.float64).reshape(-1, 3)
+        faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)
+        shared = SharedMesh.create(len(verts), len(faces), name)
+        try:
+            shared.positions[...] = verts
+            shared.indices[...] = faces
+            if texCoords is None:
+                shared.texCoords[...] = 0
+            else:
+                shared.texCoords[...] = np.asarray(texCoords).reshape(-1, 3, 2)
+            shared.normals[...] = vertexNormals(verts, faces, workers)
+            openGLArrays((verts, faces, shared.normals, shared.texCoords), workers,
+                         out=[shared.arrays[n].reshape(-1) for n in OPENGL_ARRAY_NAMES])
+        except BaseException:
+            # Nobody else knows the block yet, so it goes with the failure.
+            shared.close()
+            shared.unlink()
+            raise
+        shared.setReady()
+        return shared
+    fromArrays = staticmethod(fromArrays)
+
+    # A shared mesh holding a triangulated Mesh, its normals and its
+    # OpenGL arrays (computed first if they aren't up to date).
+    def fromMesh(mesh, name=None):
+        if (not mesh.isTriangulated()):
+            raise ValueError("Only triangle meshes can be shared")
+        mesh.compact()
+        mesh.ensureNormals()
+        shared = SharedMesh.create(len(mesh.verts), len(mesh.faces), name)
+        shared.positions[...] = mesh.positions()
+        shared.indices[...] = np.array(mesh.copyOfIndices(), dtype=np.int64).reshape(-1, 3)
+        shared.texCoords[...] = mesh.copyOfTexCoords()
+        for v in mesh.verts:
+            shared.normals[v.index] = v.eminatingEdge.smoothNormal
+        for n in OPENGL_ARRAY_NAMES:
+            shared.arrays[n].reshape(-1)[...] = getattr(mesh, n)
+        shared.setReady()
+        return shared
+    fromMesh = staticmethod(fromMesh)
+
+    # The ready flag: set once the arrays have been filled.
+    def setReady(self):
+        self.block.buf[READY_OFFSET:READY_OFFSET + 8] = struct.pack('q', 1)
+
+    def isReady(self):
+        return struct.unpack('q', bytes(self.block.buf[READY_OFFSET:READY_OFFSET + 8]))[0] != 0
+
+    # The OpenGL arrays as an OpenGLArrays object the viewer can draw, with
+    # views of the shared memory rather than copies. The object holds on to
+    # the shared mesh, which must not be closed while it is in use.
+    def openGLArrays(self):
+        arrays = OpenGLArrays()
+        arrays.sharedMesh = self
+        for n in OPENGL_ARRAY_NAMES:
+            setattr(arrays, n, self.arrays[n].reshape(-1))
+        return arrays
+
+    # A new Mesh built from copies of the arrays.
+    def mesh(self):
+        from Mesh import Mesh
+        return Mesh(self.positions.copy(), self.indices.copy(), self.texCoords.copy())
+
+    # Closes this process's view of the block. Every array taken from it
+    # must be dropped first.
+    def close(self):
+        self.arrays = {}
+        for name, dtype, shape in ARRAYS:
+            setattr(self, name, None)
+        self.block.close()
+
+    # Frees the block. Processes that still have it open keep their views.
+    # unlink() also unregisters the block from the resource tracker when it
+    # is tracked, which it may not be here (see openBlock()); registering
+    # it first is harmless if it already is.
+    def unlink(self):
+        if (getattr(self.block, '_track', True)):
+            resource_tracker.register(self.block._name, 'shared_memory')
+        self.block.unlink()
+
+
+# Worker process function: butterfly subdivides verts/faces levels times
+# with MeshArrays and returns the name of a SharedMesh holding the result.
+# The caller attaches to it and unlinks it when done with it.
+def subdivideToSharedMesh(verts, faces, texCoords=None, levels=1, workers=None):
+    from MeshArrays import butterflySubdivideArrays
+    verts = np.asarray(verts, dtype=np.float64).reshape(-1, 3)
+    faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)
+    for level in range(levels):
+        verts, faces, texCoords = butterflySubdivideArrays(verts, faces, texCoords)
+    shared = SharedMesh.fromArrays(verts, faces, texCoords, workers)
+    name = shared.name
+    # The block outlives this process; the caller unlinks it.
+    resource_tracker.unregister(shared.block._name, 'shared_memory')
+    shared.close()
+    return name
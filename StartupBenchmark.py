@@ -0,0 +1,141 @@
+#! /usr/bin/env python3
+#
+# StartupBenchmark.py
+# Created by: Jason Sikes
+#
+
+import os
+import sys
+import csv
+import time
+import argparse
+import tempfile
+import subprocess
+
+
+HELP_TEXT = """
+Measures the viewer's time to first frame. Each run starts a fresh
+interpreter with "python -X importtime" that imports the viewer, creates an
+offscreen EGL context (as RenderOffscreen.py does), runs initGL() and draws
+one frame. Reports the wall time from starting the process to the finished
+frame, how it splits into imports, initGL() and the frame, and the slowest
+imports. With --csv, appends one row per invocation so that startup time
+can be tracked across changes.
+"""
+
+CSV_FIELDS = ['date', 'runs', 'firstFrameSeconds', 'processSeconds', 'importSeconds',
+              'initGLSeconds', 'drawSeconds']
+
+# Printed by the child in front of its own timings.
+MARKER = 'FIRST FRAME'
+
+# The child. It times its phases itself; the parent adds the interpreter's
+# own startup by timing the whole process.
+CHILD_SCRIPT = """
+import sys
+import time
+start = time.perf_counter()
+sys.setrecursionlimit(10000)
+import RenderOffscreen
+import ViewMesh
+from OpenGL.GL import glFinish
+imported = time.perf_counter()
+RenderOffscreen.createContext(%d)
+ViewMesh.initGL()
+initialized = time.perf_counter()
+ViewMesh.drawFrame()
+glFinish()
+drawn = time.perf_counter()
+print(%r, imported - start, initialized - imported, drawn - initialized, flush=True)
+"""
+
+
+# Parses "-X importtime" output into {package: seconds}: the time spent
+# importing the modules of each top-level package (numpy, OpenGL, Mesh,
+# ...), not counting the other packages they import in turn.
+def parseImportTimes(text):
+    times = {}
+    for line in text.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        selfTime, cumulative, name = line[len('import time:'):].split('|')
+        package = name.strip().split('.')[0]
+        times[package] = times.get(package, 0.0) + int(selfTime) / 1e6
+    return times
+
+# Runs the child once. Returns the process wall time, the child's
+# (import, initGL, draw) times, and the import time of each package. The import
+# times go to a file; a pipe that nobody reads while the child runs would
+# fill up and stall it.
+def runOnce(size):
+    directory = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryFile(mode='w+') as stderr:
+        start = time.perf_counter()
+        child = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', CHILD_SCRIPT % (size, MARKER)],
+                                 cwd=directory, stdout=subprocess.PIPE, stderr=stderr, text=True)
+        phases = None
+        for line in child.stdout:
+            if line.startswith(MARKER):
+                firstFrame = time.perf_counter() - start
+                phases = [float(t) for t in line[len(MARKER):].split()]
+        child.wait()
+        stderr.seek(0)
+        text = stderr.read()
+    if phases is None:
+        errors = [line for line in text.splitlines() if not line.startswith('import time:')]
+        sys.exit("The benchmark process failed:\n" + "\n".join(errors))
+    return firstFrame, phases, parseImportTimes(text)
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def parseArguments():
+    parser = argparse.ArgumentParser(description=HELP_TEXT)
+    parser.add_argument('--runs', type=int, default=5,
+                        help="number of processes to start; medians are reported")
+    parser.add_argument('--top', type=int, default=10, help="number of slowest packages to list")
+    parser.add_argument('--size', type=int, default=512, help="pbuffer size in pixels")
+    parser.add_argument('--csv', help="file to append the medians to")
+    return parser.parse_args()
+
+
+def main():
+    args = parseArguments()
+    firstFrames = []
+    phases = []
+    imports = {}
+    for run in range(args.runs):
+        firstFrame, runPhases, runImports = runOnce(args.size)
+        firstFrames.append(firstFrame)
+        phases.append(runPhases)
+        for name, seconds in runImports.items():
+            imports.setdefault(name, []).append(seconds)
+
+    firstFrame = median(firstFrames)
+    importTime, initGLTime, drawTime = [median(p[i] for p in phases) for i in range(3)]
+    processTime = firstFrame - importTime - initGLTime - drawTime
+    print("Time to first frame: %.3f s (median of %i runs)" % (firstFrame, args.runs))
+    print("  interpreter start  %.3f s" % processTime)
+    print("  imports            %.3f s" % importTime)
+    print("  initGL()           %.3f s" % initGLTime)
+    print("  first frame        %.3f s" % drawTime)
+    print("Slowest packages to import (with -X importtime's own overhead):")
+    slowest = sorted(imports.items(), key=lambda item: -median(item[1]))
+    for name, times in slowest[:args.top]:
+        print("  %-28s %.3f s" % (name, median(times)))
+
+    if args.csv:
+        new = not os.path.exists(args.csv)
+        with open(args.csv, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if new:
+                writer.writerow(CSV_FIELDS)
+            writer.writerow([time.strftime('%Y-%m-%d %H:%M:%S'), args.runs] +
+                            ["%.4f" % t for t in (firstFrame, processTime, importTime, initGLTime, drawTime)])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+# StreamSubdivide.py
+# Created by: Jason Sikes
+#
+# Out-of-core butterfly subdivision. The refined mesh is never held in
+# memory as a whole: the base mesh is cut into patches along a Morton
+# curve, and each patch, together with a halo of surrounding faces, is
+# subdivided on its own with MeshArrays.butterflySubdivideArrays(). Only
+# the faces descended from the patch are kept; the halo makes their
+# stencils (and their vertices' smooth normals) the same as in the full
+# mesh. The chunks come out of a generator and can go straight to files
+# or to preallocated (for example np.memmap) OpenGL arrays, so the peak
+# memory depends on the patch size, not on the size of the result.
+#
+# Vertices on the border between two patches are computed in both, with
+# local vertex numbering, so they can differ from each other (and from
+# the full mesh) in the last bit.
+
+import numpy as np
+
+from Mesh import OPENGL_FILE_SUFFIXES
+from MeshArrays import butterflySubdivideArrays, csrEntries
+from ParallelSubdivide import mortonCodes
+
+
+# Unit normals of triangles
+def faceNormals(verts, faces):
+    p = verts[faces]
+    a = p[:,1] - p[:,0]
+    b = p[:,2] - p[:,0]
+    normals = np.stack([a[:,1] * b[:,2] - a[:,2] * b[:,1],
+                        a[:,2] * b[:,0] - a[:,0] * b[:,2],
+                        a[:,0] * b[:,1] - a[:,1] * b[:,0]], axis=1)
+    lengths = np.linalg.norm(normals, axis=1)
+    return normals / np.where(lengths > 0, lengths, 1.0)[:, None]
+
+# Smooth vertex normals like Mesh's: the normalized sum of the unit
+# normals of the faces around each vertex.
+def vertexNormals(verts, faces):
+    normals = np.zeros((len(verts), 3))
+    n = faceNormals(verts, faces)
+    for axis in range(3):
+        normals[:, axis] = np.bincount(faces.reshape(-1), weights=np.repeat(n[:, axis], 3),
+                                       minlength=len(verts))
+    lengths = np.linalg.norm(normals, axis=1)
+    return normals / np.where(lengths > 0, lengths, 1.0)[:, None]
+
+
+# Yields the butterfly subdivision of verts/faces, levels times, as
+# chunks (positions, faces, normals, texCoords). Each chunk holds the
+# descendants of about patchFaces base faces; its faces index its own
+# positions and normals, and texCoords is per corner (None if no
+# texCoords were given). halo is the number of rings of faces around a
+# patch that are subdivided with it; with one per level, and at least two,
+# the chunks are the same as the full subdivision.
+def streamButterflySubdivide(verts, faces, levels, texCoords=None, patchFaces=4096, halo=None):
+    verts = np.asarray(verts, dtype=np.float64)
+    faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)
+    if halo is None:
+        halo = max(levels, 2)
+    order = np.argsort(mortonCodes(verts[faces].mean(axis=1)), kind='stable')
+
+    # Faces around each vertex, in CSR form.
+    corners = faces.reshape(-1)
+    vertexFaces = np.argsort(corners, kind='stable') // 3
+    vertexFaceOffsets = np.zeros(len(verts) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(corners, minlength=len(verts)), out=vertexFaceOffsets[1:])
+
+    children = 4 ** levels
+    for start in range(0, len(faces), patchFaces):
+        owned = np.sort(order[start:start + patchFaces])
+        local = owned
+        for ring in range(halo):
+            entries, counts = csrEntries(vertexFaceOffsets, np.unique(faces[local]))
+            local = np.unique(vertexFaces[entries])
+        localVertices, localFaces = np.unique(faces[local], return_inverse=True)
+        localFaces = localFaces.reshape(-1, 3)
+        localCoords = None if texCoords is None else np.asarray(texCoords)[local]
+
+        positions = verts[localVertices]
+        for level in range(levels):
+            positions, localFaces, localCoords = butterflySubdivideArrays(positions, localFaces,
+                                                                          localCoords)
+        normals = vertexNormals(positions, localFaces)
+
+        # Face i of local has children [i * 4^levels, (i + 1) * 4^levels).
+        kept = np.searchsorted(local, owned)
+        kept = (kept[:, None] * children + np.arange(children)).reshape(-1)
+        keptFaces = localFaces[kept]
+        used, chunkFaces = np.unique(keptFaces, return_inverse=True)
+        yield (positions[used], chunkFaces.reshape(-1, 3), normals[used],
+               None if localCoords is None else localCoords[kept])
+
+
+# Flattens a chunk into Mesh's OpenGL array layout: vertices, smooth
+# normals, flat normals (each 9 floats per triangle) and texture
+# coordinates (6 per triangle, zero if the chunk has none).
+def openGLArrays(chunk):
+    positions, faces, normals, texCoords = chunk
+    vertices = positions[faces].astype(np.float32).reshape(-1)
+    smoothNormals = normals[faces].astype(np.float32).reshape(-1)
+    flatNormals = np.repeat(faceNormals(positions, faces), 3, axis=0).astype(np.float32).reshape(-1)
+    if texCoords is None:
+        coords = np.zeros(6 * len(faces), dtype=np.float32)
+    else:
+        coords = texCoords.astype(np.float32).reshape(-1)
+    return vertices, smoothNormals, flatNormals, coords
+
+# Writes the chunks one after another into four preallocated arrays in
+# openGLArrays() order, sized for 4^levels triangles per base face (for
+# example np.memmap arrays). Returns the number of triangles written.
+def writeOpenGLArrays(chunks, arrays):
+    triangles = 0
+    for chunk in chunks:
+        count = len(chunk[1])
+        for out, values in zip(arrays, openGLArrays(chunk)):
+            width = len(values) // count
+            out[triangles * width : (triangles + count) * width] = values
+        triangles += count
+    return triangles
+
+# Writes the chunks as raw float32 data to basename plus each of
+# Mesh.OPENGL_FILE_SUFFIXES, the layout Mesh.loadOpenGLArrays() opens.
+# Returns the number of triangles written.
+def writeOpenGLFiles(chunks, basename):
+    files = [open(basename + suffix, 'wb') for suffix in OPENGL_FILE_SUFFIXES]
+    triangles = 0
+    try:
+        for chunk in chunks:
+            for f, values in zip(files, openGLArrays(chunk)):
+                values.tofile(f)
+            triangles += len(chunk[1])
+    finally:
+        for f in files:
+            f.close()
+    return triangles
@@ -4,18 +4,28 @@
 # Created by: Jason Sikes
 # 
 
+import os
 import sys
+import time
+import copy
+import weakref
 
 from OpenGL.GL import *
 from OpenGL.GLUT import *
-from OpenGL.GLU import *
-from PIL import Image
 
-from math import *
-from numpy import *
+# Explicit names: "from numpy import *" also imports numpy.testing and
+# numpy.f2py, which is a good part of the startup time. PIL and the Bunny
+# data are imported when first needed.
+from numpy import array, cos, identity, pi, radians, sin, tan, uint8
 
-from Mesh import *
-from Bunny import *
+from Mesh import Mesh, calculateTextureCoordinates
+from FrameStats import FrameStats, FrameSample, GpuTimer
+from ShaderRenderer import ShaderRenderer, lookAtMatrix, perspectiveMatrix
+from BufferUpload import BufferUpload, StagingRing
+from OpenGL.error import NullFunctionError
+# PyOpenGL's wrapper rejects half floats, so the compact path calls the
+# plain entry point.
+from OpenGL.raw.GL.VERSION.GL_1_1 import glTexCoordPointer as rawTexCoordPointer
 
 
 HELP_TEXT = """
@@ -34,40 +44,32 @@ Built-in meshes include:
     The Stanford Bunny
     Tetrahedron
     Cube (subdivided into triangles)
+    Cube (Catmull-Clark subdivided quads)
+    The Stanford Bunny, Loop subdivided and projected onto its limit surface
 
 Use your keyboard to zoom in, zoom out, and quit.
 
 KEYS:
     Z: Zoom in
     X: Zoom out
+    L: Automatic level of detail on/off
+    H: Frame statistics overlay on/off
+    S: Save frame statistics to frame_stats.csv
     Q: Quit
 
 For all other functions and options, right-click and select from the pop-up
 menu.
 """
 
-TEXTURE_FILENAME = 'block_texture.png'
+TEXTURE_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'block_texture.png')
 TEXTURE_ENCODING = GL_RGBA
+FRAME_STATS_FILENAME = 'frame_stats.csv'
 
-# Mesh objects.
-bunny = 0
-subdividedBunny = 0
-subdividedBunny2 = 0
-subdividedBunny3 = 0
-tetrahedron = 0
-subdividedTetrahedron = 0
-subdividedTetrahedron2 = 0
-subdividedTetrahedron3 = 0
-subdividedTetrahedron4 = 0
-triCube = 0
-subdividedTriCube = 0
-subdividedTriCube2 = 0
-subdividedTriCube3 = 0
-mesh = 0
+# URL of a MeshService (MeshService.py) to fetch meshes from, if any.
+MESH_SERVICE = os.environ.get('MESH_SERVICE')
 
-tetrahedronCentroid = 0
-cubeCentroid = 0
-bunnyCentroid = 0
+# The mesh on screen.
+mesh = 0
 
 eyeRadius = 2.5
 eyePhi = pi/4
@@ -75,48 +77,25 @@ eyeTheta = pi/4
 eye = array([0,0,0])
 lookat = array([0,0,0])
 up = array([0,0,1])
-
-
-
-# Creates a 2D numpy array of texture coordinates
-# For use with mesh objects.
-def calculateTextureCoordinates(vertices, indices):
-    ssi  = 0 # Vertex component that is source for texture s component
-    tsi1 = 1 # Vertex component that is part 1 of source for texture t component (for atan2)
-    tsi2 = 2 # Vertex component that is part 2 of source for texture t component (for atan2)
-
-    retval = empty((len(indices), 3, 2), dtype = float32)
-    # This is a modified copy of getCentroid(). Bad, I know.
-    centroid = zeros(3)
-    for vert in vertices:
-        centroid += vert
-    centroid /= len(vertices)
-
-    maxssi = max( [vert[ssi] for vert in vertices] ) * 1.01
-    minssi = min( [vert[ssi] for vert in vertices] ) * 1.01
-
-    retvalIndex = 0
-    for f in range(len(indices)):
-        isInQ1 = False
-        isInQ4 = False
-        for v in range(len(indices[f])):
-            vertex = vertices[indices[f][v]]
-            # s is simply the normalized component
-            retval[f,v,0] = (vertex[ssi] - minssi) / (maxssi - minssi)
-            # t is derived from atan2
-            retval[f,v,1] = atan2(vertex[tsi1] - centroid[tsi1], vertex[tsi2] - centroid[tsi2]) / pi / 2.0 + 0.5
-            if retval[f,v,1] < 0.25:
-                isInQ1 = True
-            if retval[f,v,1] > 0.75:
-                isInQ4 = True
-
-        # Check for texture wrap-around
-        if isInQ1 and isInQ4:
-            for v in range(len(indices[f])):
-                if retval[f,v,1] < 0.25:
-                    retval[f,v,1] += 1
-    return retval
-
+FIELD_OF_VIEW = 40
+viewMatrix = identity(4)
+projectionMatrix = identity(4)
+
+# Automatic level of detail. When it is on, zooming picks the coarsest
+# subdivision level of the current mesh whose average edge projects to no
+# more than LOD_PIXEL_THRESHOLD pixels. LOD_HYSTERESIS widens the band
+# around the threshold so the level doesn't pop back and forth when the
+# camera sits right at a switching distance.
+LOD_PIXEL_THRESHOLD = 16.0
+LOD_HYSTERESIS = 0.2
+lod = False
+
+# The subdivision levels of each mesh family, coarsest first, and the
+# point the camera looks at. A family is built by loadFamily() the first
+# time it is shown.
+familyLevels = {}
+familyCentroids = {}
+edgeLengths = {}
 
 
 def sphericalToCartesian(r, theta, phi):
@@ -124,23 +103,72 @@ def sphericalToCartesian(r, theta, phi):
                 r * sin(theta) * sin(phi),
                 r * cos(phi)])
 
-def getCentroid(m):
-    centroid = zeros(3)
-    for vert in m.verts:
-        centroid += vert.position
-    centroid /= len(m.verts)
-    return centroid
-
 def setView(centroid):
-    global lookat, eyeRadius, eyeTheta, eyePhi
+    global lookat, eyeRadius, eyeTheta, eyePhi, viewMatrix
     if (centroid is not None):
         lookat = centroid
     eye = sphericalToCartesian(eyeRadius, eyeTheta, eyePhi) + lookat
+    viewMatrix = lookAtMatrix(eye, lookat, up)
     glMatrixMode(GL_MODELVIEW)
-    glLoadIdentity()
-    gluLookAt(eye[0], eye[1], eye[2],
-              lookat[0], lookat[1], lookat[2],
-              up[0], up[1], up[2])
+    glLoadMatrixd(viewMatrix.T)
+    if lod and fullDetailMesh is None:
+        updateLevelOfDetail()
+
+# The families built so far, as (name, levels) pairs.
+def meshFamilies():
+    return [(name, familyLevels[name]) for name, build in FAMILIES if name in familyLevels]
+
+# Returns the family of subdivision levels that aMesh belongs to.
+def levelsOf(aMesh):
+    for name, levels in meshFamilies():
+        for m in levels:
+            if m is aMesh:
+                return levels
+    return [aMesh]
+
+def meshName(aMesh):
+    for name, levels in meshFamilies():
+        for i in range(len(levels)):
+            if levels[i] is aMesh:
+                return "%s level %i" % (name, i)
+    return "Mesh"
+
+# Size in pixels of one unit of length at the look-at point.
+def pixelsPerUnit():
+    viewport = glGetIntegerv(GL_VIEWPORT)
+    return viewport[3] / (2.0 * eyeRadius * tan(radians(FIELD_OF_VIEW) / 2.0))
+
+def projectedEdgeLength(aMesh):
+    return edgeLengths[id(aMesh)] * pixelsPerUnit()
+
+# Returns the index of the level to draw, given the index of the level
+# currently drawn. Refining happens once the current level is clearly
+# too coarse, coarsening once a coarser level is clearly fine enough.
+def chooseLevel(levels, current):
+    upper = LOD_PIXEL_THRESHOLD * (1 + LOD_HYSTERESIS)
+    lower = LOD_PIXEL_THRESHOLD * (1 - LOD_HYSTERESIS)
+    if projectedEdgeLength(levels[current]) > upper:
+        for i in range(current + 1, len(levels)):
+            if projectedEdgeLength(levels[i]) <= LOD_PIXEL_THRESHOLD:
+                return i
+        return len(levels) - 1
+    for i in range(current):
+        if projectedEdgeLength(levels[i]) <= lower:
+            return i
+    return current
+
+# Levels are chosen relative to the mesh on its way to the screen, if an
+# upload is in flight, so that it isn't restarted at every frame.
+def updateLevelOfDetail():
+    current = uploadMesh if upload is not None else mesh
+    levels = levelsOf(current)
+    target = levels[chooseLevel(levels, levels.index(current))]
+    if target is current:
+        return
+    if target is mesh:
+        cancelUpload()   # The mesh on screen is right after all
+    else:
+        setMesh(target)
 
 ambient = (0.6, 0.6, 0.6, 1)
 diffuse = (0.5, 0.5, 0.5, 1)
@@ -153,6 +181,7 @@ light0Position = (30, 30, 30, 0)
 light0Ambient = (0.3, 0.3, 0.3, 1)
 light0Diffuse = (1, 1, 1, 1)
 light0Specular = (1, 1, 1, 1)
+lightDirection = light0Position[:3]
 openGLVertexBufferIDs = []
 
 verticesBufferID = 0
@@ -161,10 +190,77 @@ flatNormalsBufferID = 0
 textureBufferID = 0
 textureID = 0
 
+# Frame statistics overlay.
+hud = False
+frameStats = FrameStats()
+gpuTimer = None
+drawCalls = 0
+
+# Optional GLSL render path; see ShaderRenderer.py.
+shaders = False
+shaderRenderer = None
+
+# Quantized vertex attributes; see Mesh.createCompactOpenGLArrays().
+compact = False
+compactReports = weakref.WeakKeyDictionary()   # Mesh -> report
+
+# Meshes whose float arrays are bigger than ASYNC_UPLOAD_BYTES are uploaded
+# into new buffers a slice at a time from idle() (see BufferUpload.py).
+# The current mesh stays on screen until the new one's buffers are
+# complete. The compact and shader paths upload in one go.
+ASYNC_UPLOAD_BYTES = 32 << 20
+stagingRing = None
+upload = None
+uploadMesh = None
+window = 0
+
+# The shader path has no use for flat normals, packed or not, so they are
+# left out when it is the one drawing.
+def createCompactArrays(aMesh):
+    if aMesh in compactReports:
+        return
+    report = compactReports[aMesh] = aMesh.createCompactOpenGLArrays(flatNormals=not shaders)
+    print("Compact vertex format for %s: %i -> %i bytes, max errors: position %.3g, "
+          "normal %.3g degrees, texture coordinate %.3g"
+          % (meshName(aMesh), report['bytes'], report['compactBytes'], report['positionError'],
+             report['normalErrorDegrees'], report['texCoordError']))
+
+def openGLBytes(aMesh):
+    return (aMesh.vboVertices.nbytes + aMesh.vboFlatNormals.nbytes +
+            aMesh.vboSmoothNormals.nbytes + aMesh.vboTexCoords.nbytes)
+
 def setMesh(aMesh):
     global mesh
+    if upload is not None and aMesh is uploadMesh:
+        return   # Already on its way
+    cancelUpload()
+    if (not compact and not shaders and mesh and aMesh is not mesh and
+            openGLBytes(aMesh) > ASYNC_UPLOAD_BYTES):
+        startUpload(aMesh)
+        return
     mesh = aMesh
 
+    if compact:
+        createCompactArrays(mesh)
+
+    if shaders:
+        # The shader path keeps a VAO per mesh, so there is only something
+        # to upload the first time it sees a mesh.
+        shaderRenderer.meshVAO(mesh, compact)
+        return
+
+    if compact:
+        # glNormalPointer has no size argument and packed types need a size
+        # of 4, so fixed-function normals stay float. The shader path uses
+        # the packed ones.
+        for bufferID, data in ((verticesBufferID, mesh.vboCompactVertices),
+                               (flatNormalsBufferID, mesh.vboFlatNormals),
+                               (smoothNormalsBufferID, mesh.vboSmoothNormals),
+                               (textureBufferID, mesh.vboCompactTexCoords)):
+            glBindBuffer(GL_ARRAY_BUFFER, bufferID)
+            glBufferData(GL_ARRAY_BUFFER, data, GL_STATIC_DRAW)
+        return
+
     glBindBuffer(GL_ARRAY_BUFFER, verticesBufferID)
     glBufferData(GL_ARRAY_BUFFER,
                 mesh.vboVertices,
@@ -186,8 +282,68 @@ def setMesh(aMesh):
                 mesh.vboTexCoords,
                 GL_STATIC_DRAW)
 
+def startUpload(aMesh):
+    global stagingRing, upload, uploadMesh
+    if stagingRing is None:
+        stagingRing = StagingRing()
+    upload = BufferUpload((aMesh.vboVertices, aMesh.vboFlatNormals,
+                           aMesh.vboSmoothNormals, aMesh.vboTexCoords), stagingRing)
+    uploadMesh = aMesh
+    if window:
+        glutIdleFunc(idle)
+
+def cancelUpload():
+    global upload, uploadMesh
+    if upload is not None:
+        upload.delete()
+        upload = None
+        uploadMesh = None
+
+# Advances the upload in flight. When it is complete, its buffers replace
+# the current ones and its mesh becomes the current mesh. Returns True
+# while there is still something to upload.
+def pumpUpload():
+    global mesh, upload, uploadMesh
+    global verticesBufferID, flatNormalsBufferID, smoothNormalsBufferID, textureBufferID
+    if upload is None:
+        return False
+    if not upload.step():
+        return True
+    oldBuffers = [verticesBufferID, flatNormalsBufferID, smoothNormalsBufferID, textureBufferID]
+    [verticesBufferID, flatNormalsBufferID, smoothNormalsBufferID, textureBufferID] = upload.buffers
+    glDeleteBuffers(4, oldBuffers)
+    mesh = uploadMesh
+    upload = None
+    uploadMesh = None
+    return False
+
+# Completes the upload in flight right away.
+def finishUpload():
+    while pumpUpload():
+        pass
+
+def setShaders(on):
+    global shaders, shaderRenderer
+    if on and shaderRenderer is None:
+        try:
+            shaderRenderer = ShaderRenderer(lightDirection, lModelAmbient, light0Ambient,
+                                            light0Diffuse, light0Specular, ambient,
+                                            diffuse, specular, shininess)
+        except (RuntimeError, GLError, NullFunctionError) as error:
+            print("GLSL shader pipeline unavailable: %s" % error)
+            return
+    shaders = on
+    setMesh(mesh)
+
+def setCompact(on):
+    global compact
+    compact = on
+    setMesh(mesh)
+
+# Loads the texture. drawFrame() calls this the first time it textures.
 def initTexture():
     global textureID
+    from PIL import Image
     img = Image.open(TEXTURE_FILENAME)
     if img is None:
         print("Failed to load texture!")
@@ -206,15 +362,8 @@ def initTexture():
 
 
 
-def initGL():
-    global bunny, subdividedBunny, subdividedBunny2, subdividedBunny3, bunnyCentroid
-    global mesh, tetrahedron, subdividedTetrahedron, subdividedTetrahedron2
-    global subdividedTetrahedron3, subdividedTetrahedron4, triCube, subdividedTriCube
-    global subdividedTriCube2, subdividedTriCube3, tetrahedronCentroid, cubeCentroid
-    global verticesBufferID, smoothNormalsBufferID, flatNormalsBufferID, textureBufferID
-
-    [verticesBufferID, smoothNormalsBufferID, flatNormalsBufferID, textureBufferID] = glGenBuffers(4)
-    
+def buildBunnyLevels():
+    from Bunny import Bunny
     bunnyTexCoords = calculateTextureCoordinates(Bunny.bunnyVertices, Bunny.bunnyIndices)
     bunny = Mesh(Bunny.bunnyVertices,Bunny.bunnyIndices, bunnyTexCoords)
 
@@ -231,50 +380,121 @@ def initGL():
 
     subdividedBunny2 = Mesh(newVertices, newIndices, newCoords)
     subdividedBunny2.butterflySubdivide()
+    return [bunny, subdividedBunny, subdividedBunny2]
 
-    tetrahedron = Mesh.Tetrahedron(1)
-
-    subdividedTetrahedron = copy.deepcopy(tetrahedron)
-    subdividedTetrahedron.butterflySubdivide()
-
-    subdividedTetrahedron2 = copy.deepcopy(subdividedTetrahedron)
-    subdividedTetrahedron2.butterflySubdivide()
-
-    subdividedTetrahedron3 = copy.deepcopy(subdividedTetrahedron2)
-    subdividedTetrahedron3.butterflySubdivide()
-
-    subdividedTetrahedron4 = copy.deepcopy(subdividedTetrahedron3)
-    subdividedTetrahedron4.butterflySubdivide()
+def buildTetrahedronLevels():
+    levels = [Mesh.Tetrahedron(1)]
+    for i in range(4):
+        subdivided = copy.deepcopy(levels[-1])
+        subdivided.butterflySubdivide()
+        levels.append(subdivided)
+    return levels
 
+def buildTriCubeLevels():
     triCube = Mesh.Cube(1)
     triCube.triangulate()
+    levels = [triCube]
+    for i in range(3):
+        subdivided = copy.deepcopy(levels[-1])
+        subdivided.butterflySubdivide()
+        levels.append(subdivided)
+    return levels
+
+def buildQuadCubeLevels():
+    levels = [Mesh.Cube(1, triangulate=False)]
+    for i in range(3):
+        subdivided = copy.deepcopy(levels[-1])
+        subdivided.catmullClarkSubdivide()
+        levels.append(subdivided)
+    return levels
+
+# Each Loop level is projected on a copy, so the next level still
+# subdivides the control mesh. The camera looks where it does for the bunny.
+def buildLoopLimitBunnyLevels():
+    bunny = loadFamily('Bunny')[0]
+    familyCentroids['Loop Limit Bunny'] = familyCentroids['Bunny']
+    loopBunny = Mesh(bunny.copyOfVertices(), bunny.copyOfIndices(), bunny.copyOfTexCoords())
+    levels = []
+    for i in range(3):
+        limit = Mesh(loopBunny.copyOfVertices(), loopBunny.copyOfIndices(), loopBunny.copyOfTexCoords())
+        limit.projectToLoopLimit()
+        levels.append(limit)
+        if i < 2:
+            loopBunny.loopSubdivide()
+    return levels
+
+# Families a MeshService can build the same way: (mesh, scheme, levels)
+# there. The bunny's levels get new texture coordinates each, which the
+# service doesn't do.
+SERVICE_FAMILIES = {'Tetrahedron': ('tetrahedron', 'butterfly', 5),
+                    'Triangulated Cube': ('cube', 'butterfly', 4),
+                    'Quad Cube': ('quadcube', 'catmullclark', 4),
+                    'Loop Limit Bunny': ('bunny', 'looplimit', 3)}
+
+# The levels of a family from the MeshService at MESH_SERVICE, or None
+# (after saying why) if it can't provide them. The finest level is asked
+# for first, since the service caches every level it computes on the way.
+# The camera looks at the centroid of the base mesh, as it does here.
+def fetchFamily(name):
+    from MeshService import fetchMesh
+    mesh, scheme, count = SERVICE_FAMILIES[name]
+    try:
+        levels = [fetchMesh(MESH_SERVICE, mesh, scheme, i) for i in reversed(range(count))]
+        base = fetchMesh(MESH_SERVICE, mesh, 'butterfly', 0)
+    except (OSError, ValueError, RuntimeError) as error:
+        print("Mesh service at %s: %s. Building %s here." % (MESH_SERVICE, error, name))
+        return None
+    levels.reverse()
+    familyCentroids[name] = base.centroid()
+    return levels
+
+FAMILIES = (('Bunny', buildBunnyLevels),
+            ('Tetrahedron', buildTetrahedronLevels),
+            ('Triangulated Cube', buildTriCubeLevels),
+            ('Quad Cube', buildQuadCubeLevels),
+            ('Loop Limit Bunny', buildLoopLimitBunnyLevels))
+
+# The levels of the family called name, built if they haven't been. The
+# camera looks at the centroid of the coarsest level unless the builder
+# chose another point.
+def loadFamily(name):
+    if name not in familyLevels:
+        levels = None
+        if MESH_SERVICE and name in SERVICE_FAMILIES:
+            levels = fetchFamily(name)
+        if levels is None:
+            levels = dict(FAMILIES)[name]()
+        for m in levels:
+            edgeLengths[id(m)] = m.averageEdgeLength()
+        familyLevels[name] = levels
+        if name not in familyCentroids:
+            familyCentroids[name] = levels[0].centroid()
+    return familyLevels[name]
+
+def showMesh(family, level):
+    setMesh(loadFamily(family)[level])
+    setView(familyCentroids[family])
 
-    subdividedTriCube = copy.deepcopy(triCube)
-    subdividedTriCube.butterflySubdivide()
-
-    subdividedTriCube2 = copy.deepcopy(subdividedTriCube)
-    subdividedTriCube2.butterflySubdivide()
-
-    subdividedTriCube3 = copy.deepcopy(subdividedTriCube2)
-    subdividedTriCube3.butterflySubdivide()
+def initGL():
+    global verticesBufferID, smoothNormalsBufferID, flatNormalsBufferID, textureBufferID
+    global gpuTimer, projectionMatrix, lightDirection
 
-    setMesh(tetrahedron)
+    [verticesBufferID, smoothNormalsBufferID, flatNormalsBufferID, textureBufferID] = glGenBuffers(4)
 
-    tetrahedronCentroid = getCentroid(tetrahedron)
-    cubeCentroid = getCentroid(triCube)
-    bunnyCentroid = getCentroid(bunny)
+    showMesh('Tetrahedron', 0)
 
     glMatrixMode(GL_PROJECTION)
-    glLoadIdentity()
-    gluPerspective(40, 1, 0.1, 30)
-
-    setView(tetrahedronCentroid)
+    projectionMatrix = perspectiveMatrix(FIELD_OF_VIEW, 1, 0.1, 30)
+    glLoadMatrixd(projectionMatrix.T)
 
     glLightModelfv(GL_LIGHT_MODEL_AMBIENT, lModelAmbient)
     glLightfv(GL_LIGHT0, GL_AMBIENT, light0Ambient)
     glLightfv(GL_LIGHT0, GL_DIFFUSE, light0Diffuse)
     glLightfv(GL_LIGHT0, GL_SPECULAR, light0Specular)
     glLightfv(GL_LIGHT0, GL_POSITION, light0Position)
+    # Fixed-function lighting stores the light position in eye coordinates
+    # using the modelview matrix current at this point.
+    lightDirection = viewMatrix[:3,:3].dot(light0Position[:3])
     glEnable(GL_LIGHT0)
 
     glMaterialfv(GL_FRONT, GL_AMBIENT, ambient)
@@ -294,9 +514,72 @@ def initGL():
 
     glPolygonMode(GL_FRONT_AND_BACK, GL_LINE)
     glDisable(GL_LIGHTING)
-    initTexture()
 
-def display():
+    if GpuTimer.isSupported():
+        gpuTimer = GpuTimer()
+
+def drawText(x, y, text):
+    glRasterPos2f(x, y)
+    for cp in text:
+        glutBitmapCharacter(GLUT_BITMAP_8_BY_13, ord(cp))
+
+# Draws the frame statistics in the top-left corner of the window.
+def drawHud():
+    cpuAverage, cpuMax = frameStats.summary('cpuMilliseconds')
+    gpuAverage, gpuMax = frameStats.summary('gpuMilliseconds')
+    sample = frameStats.samples[-1]
+    lines = [meshName(mesh),
+             "%s (%s): %s, %s, %s" % (sample.pipeline, sample.vertexFormat, sample.polygonMode,
+                                      sample.shading, sample.texture),
+             "triangles: %i  draw calls: %i" % (sample.triangles, sample.drawCalls),
+             "cpu: %.2f ms avg, %.2f ms max" % (cpuAverage, cpuMax)]
+    if gpuAverage is None:
+        lines.append("gpu: n/a")
+    else:
+        lines.append("gpu: %.2f ms avg, %.2f ms max" % (gpuAverage, gpuMax))
+
+    viewport = glGetIntegerv(GL_VIEWPORT)
+    lighting = glIsEnabled(GL_LIGHTING)
+    glDisable(GL_LIGHTING)
+    glDisable(GL_TEXTURE_2D)
+    glMatrixMode(GL_PROJECTION)
+    glPushMatrix()
+    glLoadIdentity()
+    glOrtho(0, viewport[2], 0, viewport[3], -1, 1)
+    glMatrixMode(GL_MODELVIEW)
+    glPushMatrix()
+    glLoadIdentity()
+    glColor3f(1, 1, 0)
+    y = viewport[3] - 16
+    for line in lines:
+        drawText(8, y, line)
+        y -= 15
+    glPopMatrix()
+    glMatrixMode(GL_PROJECTION)
+    glPopMatrix()
+    glMatrixMode(GL_MODELVIEW)
+    if lighting:
+        glEnable(GL_LIGHTING)
+
+# Draws one frame into the current framebuffer. display() adds the buffer
+# swap; RenderOffscreen.py calls this directly.
+def drawFrame():
+    global drawCalls
+    frameStart = time.perf_counter()
+    sample = None
+    gpuTimed = False
+    if hud:
+        sample = FrameSample(frameStats.frameCount, meshName(mesh),
+                             "glsl" if shaders else "fixed-function",
+                             "compact" if compact else "float",
+                             "shaded" if shade and not wireframeProxy else "wireframe",
+                             "smooth" if smooth else "flat",
+                             "textured" if texture else "untextured",
+                             len(mesh.vboVertices) // 9)
+        if gpuTimer:
+            gpuTimed = gpuTimer.begin(sample)
+    drawCalls = 0
+
     glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
 
     glEnable(GL_DEPTH_TEST)
@@ -304,45 +587,84 @@ def display():
 
     glColor3f(1,1,1)
 
-    glEnableClientState(GL_VERTEX_ARRAY)
-    glBindBuffer(GL_ARRAY_BUFFER, verticesBufferID)
-    glVertexPointer(3, GL_FLOAT, 0, None)
+    # The texture is loaded the first time it's needed, by either path.
+    if texture and not textureID:
+        initTexture()
 
-    if texture:
-        glBindTexture(GL_TEXTURE_2D, textureID)
-        glEnableClientState(GL_TEXTURE_COORD_ARRAY)
-        glBindBuffer(GL_ARRAY_BUFFER, textureBufferID)
+    if shaders:
+        shaderRenderer.draw(mesh, compact, viewMatrix, projectionMatrix,
+                            shade and not wireframeProxy, smooth, texture, textureID)
+    else:
+        if compact:
+            attributeType = GL_SHORT
+            texCoordType = GL_HALF_FLOAT
+            # Decode the quantized positions with the modelview matrix.
+            glPushMatrix()
+            glTranslated(*mesh.compactPositionOffset)
+            glScaled(mesh.compactPositionScale, mesh.compactPositionScale, mesh.compactPositionScale)
+            glEnable(GL_RESCALE_NORMAL)
+        else:
+            attributeType = GL_FLOAT
+            texCoordType = GL_FLOAT
 
-        glEnableClientState(GL_TEXTURE_COORD_ARRAY)
-        glBindBuffer(GL_ARRAY_BUFFER, textureBufferID)
-        glTexCoordPointer(2, GL_FLOAT, 0, None)
+        glEnableClientState(GL_VERTEX_ARRAY)
+        glBindBuffer(GL_ARRAY_BUFFER, verticesBufferID)
+        if compact:
+            glVertexPointer(4, attributeType, 0, None)
+        else:
+            glVertexPointer(3, attributeType, 0, None)
 
-        glEnable(GL_TEXTURE_2D)
-        glBindTexture(GL_TEXTURE_2D, textureID)
-    else:
-        glDisable(GL_TEXTURE_2D)
+        if texture:
+            glBindTexture(GL_TEXTURE_2D, textureID)
+            glEnableClientState(GL_TEXTURE_COORD_ARRAY)
+            glBindBuffer(GL_ARRAY_BUFFER, textureBufferID)
 
-    if smooth:
-        glBindBuffer(GL_ARRAY_BUFFER, smoothNormalsBufferID)
-    else:
-        glBindBuffer(GL_ARRAY_BUFFER, flatNormalsBufferID)
-    glNormalPointer(GL_FLOAT, 0, None)
+            glEnableClientState(GL_TEXTURE_COORD_ARRAY)
+            glBindBuffer(GL_ARRAY_BUFFER, textureBufferID)
+            rawTexCoordPointer(2, texCoordType, 0, None)
+
+            glEnable(GL_TEXTURE_2D)
+            glBindTexture(GL_TEXTURE_2D, textureID)
+        else:
+            glDisable(GL_TEXTURE_2D)
 
-    glDrawArrays(GL_TRIANGLES, 0, len(mesh.vboVertices) // 3)
+        if smooth:
+            glBindBuffer(GL_ARRAY_BUFFER, smoothNormalsBufferID)
+        else:
+            glBindBuffer(GL_ARRAY_BUFFER, flatNormalsBufferID)
+        glNormalPointer(GL_FLOAT, 0, None)
+
+        glDrawArrays(GL_TRIANGLES, 0, len(mesh.vboVertices) // 3)
+        if compact:
+            glDisable(GL_RESCALE_NORMAL)
+            glPopMatrix()
+    drawCalls += 1
     glDisable(GL_DEPTH_TEST)
 
     if annotate:
         verts = mesh.verts
+        lighting = glIsEnabled(GL_LIGHTING)
         glDisable(GL_LIGHTING)
         for v in verts:
             buf = "v%i" % (v.index)
             glRasterPos3fv(v.position)
             for cp in buf:
                 glutBitmapCharacter(GLUT_BITMAP_8_BY_13, ord(cp))
-        if shade:
+        if lighting:
             glEnable(GL_LIGHTING)
 
+    if sample is not None:
+        if gpuTimed:
+            gpuTimer.end()
+        sample.drawCalls = drawCalls
+        sample.cpuMilliseconds = (time.perf_counter() - frameStart) * 1000.0
+        frameStats.add(sample)
+        drawHud()
+
     # End testTextureSetup
+
+def display():
+    drawFrame()
     glutSwapBuffers()
 
 
@@ -351,40 +673,130 @@ mousex = 0
 mousey = 0
 epsilon = 0.0000001
 
+# Mouse motion is only accumulated as it arrives. The idle callback applies
+# it at most TARGET_FRAME_RATE times a second, so a slow frame never leaves
+# a backlog of motion events (and redraws) behind it.
+TARGET_FRAME_RATE = 60.0
+pendingDx = 0
+pendingDy = 0
+lastFrameTime = 0.0
+frameTimerPending = False
+
+# Cheaper stand-ins drawn while the mouse is dragging. DRAG_LEVEL_DROP is
+# how many subdivision levels the coarser proxy is below the full mesh.
+DRAG_LEVEL_DROP = 1
+dragLowerLevel = False
+dragWireframe = False
+fullDetailMesh = None
+wireframeProxy = False
+
+def beginDragProxy():
+    global fullDetailMesh, wireframeProxy
+    if dragLowerLevel:
+        levels = levelsOf(mesh)
+        level = levels.index(mesh)
+        if level > 0:
+            fullDetailMesh = mesh
+            if level > DRAG_LEVEL_DROP:
+                setMesh(levels[level - DRAG_LEVEL_DROP])
+            else:
+                setMesh(levels[0])
+    if dragWireframe and shade:
+        wireframeProxy = True
+        glPolygonMode(GL_FRONT_AND_BACK, GL_LINE)
+        glDisable(GL_LIGHTING)
+
+def endDragProxy():
+    global fullDetailMesh, wireframeProxy
+    if fullDetailMesh is not None:
+        setMesh(fullDetailMesh)
+        fullDetailMesh = None
+    if wireframeProxy:
+        wireframeProxy = False
+        glPolygonMode(GL_FRONT_AND_BACK, GL_FILL)
+        glEnable(GL_LIGHTING)
+
 def mouse(button, state, x, y):
-    global mouseRotate, mousex, mousey
+    global mouseRotate, mousex, mousey, pendingDx, pendingDy
     if state == GLUT_DOWN:
         if button == GLUT_LEFT_BUTTON:
             mouseRotate = True
             mousex = x
             mousey = y
+            pendingDx = 0
+            pendingDy = 0
+            beginDragProxy()
+            glutIdleFunc(idle)
     elif state == GLUT_UP:
-        mouseRotate = False
+        if mouseRotate:
+            mouseRotate = False
+            glutIdleFunc(idle if upload is not None else None)
+            applyRotation()
+            endDragProxy()
+            glutPostRedisplay()
 
 
 def mouseMotion(x, y):
-    global eyeTheta, eyePhi, mousex, mousey
+    global mousex, mousey, pendingDx, pendingDy
     if mouseRotate:
-        radiansPerPixel = pi / 180
-        dx = x - mousex
-        dy = y - mousey
-        eyeTheta -= dx * radiansPerPixel
-        eyePhi -= dy * radiansPerPixel
-        if eyePhi >= pi:
-            eyePhi = pi - epsilon
-        elif eyePhi <= 0:
-            eyePhi = epsilon
-
-        eye = sphericalToCartesian(eyeRadius, eyeTheta, eyePhi)
-        eye += lookat
-        glMatrixMode(GL_MODELVIEW)
-        glLoadIdentity()
-        gluLookAt(eye[0], eye[1], eye[2],
-                lookat[0], lookat[1], lookat[2],
-                up[0], up[1], up[2])
+        pendingDx += x - mousex
+        pendingDy += y - mousey
         mousex = x
         mousey = y
+        glutIdleFunc(idle)
+
+# Turns the accumulated mouse motion into one camera move. Returns False
+# if there was nothing to apply.
+def applyRotation():
+    global eyeTheta, eyePhi, pendingDx, pendingDy
+    if pendingDx == 0 and pendingDy == 0:
+        return False
+    radiansPerPixel = pi / 180
+    eyeTheta -= pendingDx * radiansPerPixel
+    eyePhi -= pendingDy * radiansPerPixel
+    if eyePhi >= pi:
+        eyePhi = pi - epsilon
+    elif eyePhi <= 0:
+        eyePhi = epsilon
+    pendingDx = 0
+    pendingDy = 0
+    setView(None)
+    return True
+
+def idle():
+    global lastFrameTime, frameTimerPending
+    if upload is not None and not pumpUpload():
         glutPostRedisplay()
+        if not mouseRotate:
+            glutIdleFunc(None)
+    if not mouseRotate:
+        return
+    if pendingDx == 0 and pendingDy == 0:
+        # Nothing to draw until the mouse moves, and mouseMotion() brings
+        # the idle callback back then.
+        if upload is None:
+            glutIdleFunc(None)
+        return
+    wait = lastFrameTime + 1.0 / TARGET_FRAME_RATE - time.perf_counter()
+    if wait > 0:
+        # Too soon for another frame. Sleeping here would hold up the event
+        # loop, so park the idle callback and let a timer bring it back.
+        if not frameTimerPending:
+            frameTimerPending = True
+            glutTimerFunc(int(wait * 1000) + 1, frameTimer, 0)
+        if upload is None:
+            glutIdleFunc(None)
+        return
+    if applyRotation():
+        lastFrameTime = time.perf_counter()
+        glutPostRedisplay()
+
+# Brings the idle callback back once the next frame of a drag is due.
+def frameTimer(value):
+    global frameTimerPending
+    frameTimerPending = False
+    if mouseRotate:
+        glutIdleFunc(idle)
 
 
 # Menu Enumerations
@@ -405,9 +817,44 @@ MENU_CULL_BACKFACES = 14
 MENU_ANNOTATE = 15
 MENU_SMOOTH_SHADING = 16
 MENU_TEXTURE = 17
+MENU_LOD = 18
+MENU_HUD = 19
+MENU_SAVE_STATS = 20
+MENU_DRAG_LOWER_LEVEL = 21
+MENU_DRAG_WIREFRAME = 22
+MENU_SHADERS = 23
+MENU_COMPACT = 24
+MENU_QUAD_CUBE = 25
+MENU_SUBDIVIDED_QUAD_CUBE = 26
+MENU_SUBDIVIDED_QUAD_CUBE2 = 27
+MENU_SUBDIVIDED_QUAD_CUBE3 = 28
+MENU_LOOP_LIMIT_BUNNY = 29
+MENU_LOOP_LIMIT_BUNNY2 = 30
+MENU_LOOP_LIMIT_BUNNY3 = 31
 MENU_DIVIDER = 888
 MENU_QUIT = 999
 
+# The family and level each mesh item shows.
+MENU_MESHES = {MENU_BUNNY: ('Bunny', 0),
+               MENU_SUBDIVIDED_BUNNY: ('Bunny', 1),
+               MENU_SUBDIVIDED_BUNNY2: ('Bunny', 2),
+               MENU_TETRAHEDRON: ('Tetrahedron', 0),
+               MENU_SUBDIVIDED_TETRAHEDRON: ('Tetrahedron', 1),
+               MENU_SUBDIVIDED_TETRAHEDRON2: ('Tetrahedron', 2),
+               MENU_SUBDIVIDED_TETRAHEDRON3: ('Tetrahedron', 3),
+               MENU_SUBDIVIDED_TETRAHEDRON4: ('Tetrahedron', 4),
+               MENU_TRI_CUBE: ('Triangulated Cube', 0),
+               MENU_SUBDIVIDED_TRI_CUBE: ('Triangulated Cube', 1),
+               MENU_SUBDIVIDED_TRI_CUBE2: ('Triangulated Cube', 2),
+               MENU_SUBDIVIDED_TRI_CUBE3: ('Triangulated Cube', 3),
+               MENU_QUAD_CUBE: ('Quad Cube', 0),
+               MENU_SUBDIVIDED_QUAD_CUBE: ('Quad Cube', 1),
+               MENU_SUBDIVIDED_QUAD_CUBE2: ('Quad Cube', 2),
+               MENU_SUBDIVIDED_QUAD_CUBE3: ('Quad Cube', 3),
+               MENU_LOOP_LIMIT_BUNNY: ('Loop Limit Bunny', 0),
+               MENU_LOOP_LIMIT_BUNNY2: ('Loop Limit Bunny', 1),
+               MENU_LOOP_LIMIT_BUNNY3: ('Loop Limit Bunny', 2)}
+
 shade = False
 cull = False
 annotate = False
@@ -415,54 +862,10 @@ smooth = False
 texture = False
 
 def menu(value):
-    global mesh, shade, cull, annotate, smooth, window, texture
-    if value == MENU_BUNNY:
-        setMesh(bunny)
-        setView(bunnyCentroid)
-        glutPostRedisplay()
-    if value == MENU_SUBDIVIDED_BUNNY:
-        setMesh(subdividedBunny)
-        setView(bunnyCentroid)
-        glutPostRedisplay()
-    if value == MENU_SUBDIVIDED_BUNNY2:
-        setMesh(subdividedBunny2)
-        setView(bunnyCentroid)
-        glutPostRedisplay()
-    if value == MENU_TETRAHEDRON:
-        setMesh(tetrahedron)
-        setView(tetrahedronCentroid)
-        glutPostRedisplay()
-    if value == MENU_SUBDIVIDED_TETRAHEDRON:
-        setMesh(subdividedTetrahedron)
-        setView(tetrahedronCentroid)
-        glutPostRedisplay()
-    if value == MENU_SUBDIVIDED_TETRAHEDRON2:
-        setMesh(subdividedTetrahedron2)
-        setView(tetrahedronCentroid)
-        glutPostRedisplay()
-    if value == MENU_SUBDIVIDED_TETRAHEDRON3:
-        setMesh(subdividedTetrahedron3)
-        setView(tetrahedronCentroid)
-        glutPostRedisplay()
-    if value == MENU_SUBDIVIDED_TETRAHEDRON4:
-        setMesh(subdividedTetrahedron4)
-        setView(tetrahedronCentroid)
-        glutPostRedisplay()
-    if value == MENU_TRI_CUBE:
-        setMesh(triCube)
-        setView(cubeCentroid)
-        glutPostRedisplay()
-    if value == MENU_SUBDIVIDED_TRI_CUBE:
-        setMesh(subdividedTriCube)
-        setView(cubeCentroid)
-        glutPostRedisplay()
-    if value == MENU_SUBDIVIDED_TRI_CUBE2:
-        setMesh(subdividedTriCube2)
-        setView(cubeCentroid)
-        glutPostRedisplay()
-    if value == MENU_SUBDIVIDED_TRI_CUBE3:
-        setMesh(subdividedTriCube3)
-        setView(cubeCentroid)
+    global mesh, shade, cull, annotate, smooth, window, texture, lod, hud
+    global dragLowerLevel, dragWireframe
+    if value in MENU_MESHES:
+        showMesh(*MENU_MESHES[value])
         glutPostRedisplay()
     if value == MENU_SMOOTH_SHADING:
         smooth = not smooth
@@ -489,13 +892,36 @@ def menu(value):
     if value == MENU_TEXTURE:
         texture = not texture
         glutPostRedisplay()
+    if value == MENU_LOD:
+        lod = not lod
+        setView(None)
+        glutPostRedisplay()
+    if value == MENU_HUD:
+        hud = not hud
+        glutPostRedisplay()
+    if value == MENU_SAVE_STATS:
+        saveFrameStats()
+    if value == MENU_DRAG_LOWER_LEVEL:
+        dragLowerLevel = not dragLowerLevel
+    if value == MENU_DRAG_WIREFRAME:
+        dragWireframe = not dragWireframe
+    if value == MENU_SHADERS:
+        setShaders(not shaders)
+        glutPostRedisplay()
+    if value == MENU_COMPACT:
+        setCompact(not compact)
+        glutPostRedisplay()
     if value == MENU_QUIT:
         if window:
             glutDestroyWindow(window)
     return 0
 
+def saveFrameStats():
+    count = frameStats.writeCSV(FRAME_STATS_FILENAME)
+    print("Wrote %i frames to %s" % (count, FRAME_STATS_FILENAME))
+
 def keyboard(key, x, y):
-    global window, eyeRadius
+    global window, eyeRadius, lod, hud
     if (key == as_8_bit('z')) or (key == as_8_bit('Z')):
         eyeRadius *= 0.95
         setView(None)
@@ -504,12 +930,22 @@ def keyboard(key, x, y):
         eyeRadius *= 1.05
         setView(None)
         glutPostRedisplay()
+    if (key == as_8_bit('l')) or (key == as_8_bit('L')):
+        lod = not lod
+        setView(None)
+        glutPostRedisplay()
+    if (key == as_8_bit('h')) or (key == as_8_bit('H')):
+        hud = not hud
+        glutPostRedisplay()
+    if (key == as_8_bit('s')) or (key == as_8_bit('S')):
+        saveFrameStats()
     if (key == as_8_bit('q')) or (key == as_8_bit('Q')):
         if window:
             glutDestroyWindow(window)
 
 def cleanup():
     global verticesBufferID, smoothNormalsBufferID, flatNormalsBufferID, textureBufferID, textureID
+    global gpuTimer, shaderRenderer, stagingRing
     if verticesBufferID:
         glDeleteBuffers(1, [verticesBufferID])
     if smoothNormalsBufferID:
@@ -520,6 +956,16 @@ def cleanup():
         glDeleteBuffers(1, [textureBufferID])
     if textureID:
         glDeleteTextures(1, [textureID])
+    if gpuTimer:
+        gpuTimer.delete()
+        gpuTimer = None
+    if shaderRenderer:
+        shaderRenderer.delete()
+        shaderRenderer = None
+    cancelUpload()
+    if stagingRing:
+        stagingRing.delete()
+        stagingRing = None
 
 def main():
     global window
@@ -535,6 +981,9 @@ def main():
         glutAddMenuEntry("Low-Res Bunny", MENU_BUNNY)
         glutAddMenuEntry("Low-Res Bunny Subdivided 1 iteration", MENU_SUBDIVIDED_BUNNY)
         glutAddMenuEntry("Low-Res Bunny Subdivided 2 iterations", MENU_SUBDIVIDED_BUNNY2)
+        glutAddMenuEntry("Low-Res Bunny Loop Limit", MENU_LOOP_LIMIT_BUNNY)
+        glutAddMenuEntry("Low-Res Bunny Loop Limit 1 iteration", MENU_LOOP_LIMIT_BUNNY2)
+        glutAddMenuEntry("Low-Res Bunny Loop Limit 2 iterations", MENU_LOOP_LIMIT_BUNNY3)
         glutAddMenuEntry("----------------------------", MENU_DIVIDER)
         glutAddMenuEntry("Tetrahedron", MENU_TETRAHEDRON)
         glutAddMenuEntry("Tetrahedron Subdivided 1 iteration", MENU_SUBDIVIDED_TETRAHEDRON)
@@ -547,11 +996,23 @@ def main():
         glutAddMenuEntry("Triangulated Cube Subdivided 2 iterations", MENU_SUBDIVIDED_TRI_CUBE2)
         glutAddMenuEntry("Triangulated Cube Subdivided 3 iterations", MENU_SUBDIVIDED_TRI_CUBE3)
         glutAddMenuEntry("----------------------------", MENU_DIVIDER)
+        glutAddMenuEntry("Quad Cube", MENU_QUAD_CUBE)
+        glutAddMenuEntry("Quad Cube Catmull-Clark 1 iteration", MENU_SUBDIVIDED_QUAD_CUBE)
+        glutAddMenuEntry("Quad Cube Catmull-Clark 2 iterations", MENU_SUBDIVIDED_QUAD_CUBE2)
+        glutAddMenuEntry("Quad Cube Catmull-Clark 3 iterations", MENU_SUBDIVIDED_QUAD_CUBE3)
+        glutAddMenuEntry("----------------------------", MENU_DIVIDER)
         glutAddMenuEntry("Shading on/off", MENU_SHADE)
         glutAddMenuEntry("Cull backfaces on/off", MENU_CULL_BACKFACES)
         glutAddMenuEntry("Vertex annotation on/off", MENU_ANNOTATE)
         glutAddMenuEntry("Smooth shading on/off", MENU_SMOOTH_SHADING)
         glutAddMenuEntry("Texture on/off", MENU_TEXTURE)
+        glutAddMenuEntry("Automatic level of detail on/off", MENU_LOD)
+        glutAddMenuEntry("Frame statistics on/off", MENU_HUD)
+        glutAddMenuEntry("Save frame statistics", MENU_SAVE_STATS)
+        glutAddMenuEntry("Coarser level while dragging on/off", MENU_DRAG_LOWER_LEVEL)
+        glutAddMenuEntry("Wireframe while dragging on/off", MENU_DRAG_WIREFRAME)
+        glutAddMenuEntry("GLSL shader pipeline on/off", MENU_SHADERS)
+        glutAddMenuEntry("Compact vertex format on/off", MENU_COMPACT)
         glutAddMenuEntry("----------------------------", MENU_DIVIDER)
         glutAddMenuEntry("Quit", MENU_QUIT)
         glutAttachMenu(GLUT_RIGHT_BUTTON)